@@ -0,0 +1,107 @@
+import os
+import os.path as op
+import time
+import numpy as np
+from scipy.special import ndtr
+
+parameter_names = ['bias', 'noise', 'regression']
+
+
+class AdaptiveDesign(object):
+    """ Grid posterior over the parameters of a log-normal estimation model, and the choice
+    of the numerosity that maximizes the expected information gain about them.
+
+    The model (as LogNormalObserver in simulation.py): the log estimate of n is
+    (1 - regression) * log(n) + regression * log(centre of the range) + bias, plus
+    Gaussian noise with sd noise; responses are estimates rounded to the slider's integers
+    and clipped to the range. """
+
+    def __init__(self, range_, bias=(-.3, .3, 13), noise=(.05, .5, 12), regression=(0., .8, 9), seed=None):
+        # Noise is spaced logarithmically
+        self.grid = np.meshgrid(np.linspace(*bias), np.geomspace(*noise), np.linspace(*regression), indexing='ij')
+        self.grid = [values.ravel() for values in self.grid]
+
+        self.log_posterior = np.full(len(self.grid[0]), -np.log(len(self.grid[0])))
+        self.rng = np.random.default_rng(seed)
+
+        self.trials = []
+        self.set_range(range_)
+
+    def set_range(self, range_):
+        """ Precomputes p(response | n, parameters) for every n and response in range_
+        (arrays of n x parameters x responses) and the entropies of these distributions. """
+
+        self.range = range_
+        self.ns = np.arange(range_[0], range_[1] + 1)
+
+        bias, noise, regression = self.grid
+        means = (1 - regression) * np.log(self.ns[:, np.newaxis]) + regression * np.mean(np.log(range_)) + bias
+
+        # Responses are rounded estimates; the extreme responses include everything beyond the range
+        edges = np.log(np.concatenate(([1e-9], self.ns[1:] - .5, [1e9])))
+        cdf = ndtr((edges[np.newaxis, np.newaxis, :] - means[..., np.newaxis]) / noise[np.newaxis, :, np.newaxis])
+
+        self.likelihood = np.maximum(np.diff(cdf, axis=2), 1e-12).astype(np.float32)
+        self.log_likelihood = np.log(self.likelihood)
+        self.conditional_entropy = -(self.likelihood * self.log_likelihood).sum(2)
+
+    @property
+    def posterior(self):
+        posterior = np.exp(self.log_posterior - self.log_posterior.max())
+        return posterior / posterior.sum()
+
+    def get_information_gain(self):
+        """ Expected information gain (nats) about the parameters of a trial with every n. """
+
+        posterior = self.posterior.astype(np.float32)
+        marginal = np.einsum('p,npr->nr', posterior, self.likelihood)
+
+        return -(marginal * np.log(marginal)).sum(1) - self.conditional_entropy @ posterior
+
+    def select(self):
+        """ The numerosity with the highest expected information gain (ties broken at random). """
+
+        t0 = time.perf_counter()
+        information_gain = self.get_information_gain()
+        best = np.flatnonzero(information_gain >= information_gain.max() - 1e-6)
+        n = int(self.ns[self.rng.choice(best)])
+        self.selection_time = time.perf_counter() - t0
+
+        return n
+
+    def update(self, n, response=None):
+        """ Adds a trial; trials without response (None or NaN) do not change the posterior. """
+
+        if response is not None and not np.isnan(response):
+            response = int(np.clip(np.round(response), self.range[0], self.range[1]))
+            self.log_posterior = self.log_posterior + self.log_likelihood[n - self.range[0], :, response - self.range[0]]
+            self.log_posterior -= self.log_posterior.max()
+
+        self.trials.append((n, np.nan if response is None else response, self.posterior.astype(np.float32)))
+
+    def get_summary(self):
+        """ Posterior mean and sd of every parameter, as {'<parameter>_mean': ..., '<parameter>_sd': ...}. """
+
+        posterior = self.posterior
+        summary = {}
+
+        for name, values in zip(parameter_names, self.grid):
+            mean = posterior @ values
+            summary[f'{name}_mean'] = mean
+            summary[f'{name}_sd'] = np.sqrt(posterior @ (values - mean)**2)
+
+        return summary
+
+    def save(self, output_dir, output_str):
+        """ Writes the grid and the posterior after every trial to <output_str>_posterior.npz. """
+
+        if len(self.trials) == 0:
+            return
+
+        ns, responses, posteriors = zip(*self.trials)
+
+        os.makedirs(output_dir, exist_ok=True)
+        np.savez(op.join(output_dir, f'{output_str}_posterior.npz'), n=np.array(ns), response=np.array(responses),
+                 posterior=np.stack(posteriors), **dict(zip(parameter_names, self.grid)))
+
+        self.trials = []
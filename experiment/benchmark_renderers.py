@@ -0,0 +1,83 @@
+import argparse
+import time
+import numpy as np
+import yaml
+import os.path as op
+from psychopy import monitors
+from psychopy.visual import Window
+from utils import _sample_dot_positions, RadialStimArray, DotArrayStim, RasterizedDotArray
+from rasterize import TextureCache
+
+
+def time_renderer(win, stimulus, n_frames):
+    """ Returns the draw time and the frame time (draw + flip) per frame, in ms. """
+
+    draw_times = np.zeros(n_frames)
+    frame_times = np.zeros(n_frames)
+
+    # Warm up (first draws upload textures/vertices)
+    for _ in range(10):
+        stimulus.draw()
+        win.flip()
+
+    for i in range(n_frames):
+        t0 = time.perf_counter()
+        stimulus.draw()
+        t1 = time.perf_counter()
+        win.flip()
+        t2 = time.perf_counter()
+
+        draw_times[i] = t1 - t0
+        frame_times[i] = t2 - t0
+
+    return draw_times * 1000., frame_times * 1000.
+
+
+def main(settings, ns, n_frames=300, wait_blanking=False):
+
+    settings_fn = op.join(op.dirname(__file__), 'settings', f'{settings}.yml')
+
+    with open(settings_fn, 'r') as f:
+        settings = yaml.safe_load(f)
+
+    monitor = monitors.Monitor(settings['monitor']['name'], width=settings['monitor']['width'],
+                               distance=settings['monitor']['distance'])
+    monitor.setSizePix(settings['window']['size'])
+
+    # Without waiting for the blanking interval the frame time shows the actual rendering cost
+    win = Window(size=settings['window']['size'], monitor=monitor, units='deg', color=settings['window']['color'],
+                 fullscr=settings['window']['fullscr'], winType=settings['window']['winType'],
+                 waitBlanking=wait_blanking)
+
+    aperture_radius = settings['cloud'].get('aperture_radius')
+    dot_radius = settings['cloud'].get('dot_radius')
+
+    texture_cache = TextureCache(lambda stimulus: stimulus.create_texture(), max_size=1)
+
+    renderers = {'RadialStimArray': lambda xys: RadialStimArray(win, xys, dot_radius),
+                 'DotArrayStim': lambda xys: DotArrayStim(win, xys, dot_radius),
+                 'RasterizedDotArray': lambda xys: RasterizedDotArray(win, xys, dot_radius, aperture_radius, texture_cache)}
+
+    print(f"{'n':>5} {'renderer':>18} {'draw (ms)':>10} {'frame (ms)':>11} {'max frame (ms)':>15}")
+
+    for n in ns:
+        xys = _sample_dot_positions(n, aperture_radius, dot_radius)
+
+        for name, renderer in renderers.items():
+            stimulus = renderer(xys.copy())
+            draw_times, frame_times = time_renderer(win, stimulus, n_frames)
+            print(f'{n:>5} {name:>18} {np.median(draw_times):>10.3f} '
+                  f'{np.median(frame_times):>11.3f} {frame_times.max():>15.3f}')
+
+    win.close()
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument('--settings', type=str, help='Settings label', default='default')
+    argparser.add_argument('--ns', type=int, nargs='+', default=[10, 25, 50, 100, 150, 200])
+    argparser.add_argument('--n_frames', type=int, default=300)
+    argparser.add_argument('--wait_blanking', action='store_true')
+    args = argparser.parse_args()
+
+    main(args.settings, args.ns, args.n_frames, args.wait_blanking)
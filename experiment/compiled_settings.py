@@ -0,0 +1,220 @@
+import functools
+import os.path as op
+from types import SimpleNamespace
+import numpy as np
+import yaml
+from layout_features import feature_names
+
+# Settings every session needs, per section (sections with an empty list just have to exist)
+_required = {'window': ['size', 'color', 'fullscr', 'winType'],
+             'monitor': ['name', 'width', 'distance'],
+             'mri': ['TR', 'sync', 'n_dummy_scans'],
+             'cloud': ['aperture_radius', 'dot_radius', 'stimulus_series'],
+             'slider': ['max_length', 'max_range', 'height', 'color', 'feedbackColor', 'borderColor', 'markerColor',
+                        'borderWidth', 'text_height'],
+             'various': ['text_width', 'text_height', 'text_color'],
+             'examples': ['n_examples'],
+             'feedback': ['n_examples'],
+             'task': ['n_trials'],
+             'ranges': [],
+             'durations': ['first_fixation', 'second_fixation', 'array_duration', 'isi', 'response_screen', 'feedback'],
+             'fixation_lines': [],
+             'interface': ['mouse_multiplier'],
+             'score': ['no_response_penalty', 'max_reward', 'reward_slope']}
+
+_renderers = ['element_array', 'circles', 'texture']
+_transforms = ['identity', 'mirror_x', 'mirror_y', 'new']
+
+# Phases of FeedbackTrial, which waits up to 2 minutes for a response
+feedback_phase_names = ['fixation1', 'fixation2', 'stimulus', 'response', 'feedback']
+feedback_response_window = 120.
+
+
+def get_series(cloud_settings):
+    """ Durations (fractions of array_duration) and layout transforms of the sub-phases of a stimulus series. """
+
+    durations = np.asarray(cloud_settings.get('series_durations', [.25, .25, .25, .25]), dtype=float)
+    transforms = cloud_settings.get('series_transforms', ['identity', 'mirror_x', 'rotate_180', 'mirror_y'])
+
+    if len(durations) != len(transforms):
+        raise ValueError(f'cloud: series_durations ({len(durations)} sub-phases) and series_transforms '
+                         f'({len(transforms)} sub-phases) should have the same length')
+
+    return durations / durations.sum(), transforms
+
+
+def get_phase_names(n_stimulus_phases=1):
+    """ Phase names of a TaskTrial whose stimulus is shown in n_stimulus_phases sub-phases. """
+
+    stimulus = ['stimulus'] if n_stimulus_phases == 1 else [f'stimulus{i + 1}' for i in range(n_stimulus_phases)]
+    return ['fixation1', 'fixation2'] + stimulus + ['jitter', 'response', 'feedback', 'iti']
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _is_transform(transform):
+    if transform in _transforms:
+        return True
+
+    try:
+        return transform.startswith('rotate_') and np.isfinite(float(transform[len('rotate_'):]))
+    except (AttributeError, ValueError):
+        return False
+
+
+def validate_settings(settings):
+    """ Every problem with a settings dictionary (missing or invalid values), as a list of strings. """
+
+    problems = []
+
+    for section, keys in _required.items():
+        if not isinstance(settings.get(section), dict):
+            problems.append(f'missing section {section}')
+            continue
+
+        problems += [f'missing {section}: {key}' for key in keys if key not in settings[section]]
+
+    if problems:
+        return problems
+
+    durations = settings['durations']
+
+    for key in ['first_fixation', 'second_fixation', 'array_duration', 'response_screen', 'feedback']:
+        if not (_is_number(durations[key]) and durations[key] >= 0):
+            problems.append(f'durations: {key} should be a duration (s), not {durations[key]!r}')
+
+    isi = durations['isi'] if isinstance(durations['isi'], list) else [durations['isi']]
+    if not all(_is_number(value) and value >= 0 for value in isi):
+        problems.append(f'durations: isi should be a list of durations (s), not {durations["isi"]!r}')
+
+    if not (_is_number(settings['mri']['TR']) and settings['mri']['TR'] > 0):
+        problems.append(f'mri: TR should be positive, not {settings["mri"]["TR"]!r}')
+
+    if not (isinstance(settings['mri']['n_dummy_scans'], int) and settings['mri']['n_dummy_scans'] >= 0):
+        problems.append(f'mri: n_dummy_scans should be a number of scans, not {settings["mri"]["n_dummy_scans"]!r}')
+
+    for section in ['examples', 'feedback']:
+        if not (isinstance(settings[section]['n_examples'], int) and settings[section]['n_examples'] > 0):
+            problems.append(f'{section}: n_examples should be a positive number of trials')
+
+    if not (isinstance(settings['task']['n_trials'], int) and settings['task']['n_trials'] > 0):
+        problems.append('task: n_trials should be a positive number of trials')
+
+    max_range = settings['slider']['max_range']
+    if not (isinstance(max_range, list) and len(max_range) == 2 and max_range[0] < max_range[1]):
+        problems.append(f'slider: max_range should be [low, high], not {max_range!r}')
+        max_range = None
+
+    for label, range_ in settings['ranges'].items():
+        if not (isinstance(range_, list) and len(range_) == 2 and all(isinstance(n, int) for n in range_) and
+                range_[0] < range_[1]):
+            problems.append(f'ranges: {label} should be [low, high] (numbers of dots), not {range_!r}')
+        elif (max_range is not None) and ((range_[0] < max_range[0]) or (range_[1] > max_range[1])):
+            problems.append(f'ranges: {label} ({range_}) is not within slider: max_range ({max_range})')
+
+    cloud = settings['cloud']
+
+    if not (_is_number(cloud['dot_radius']) and _is_number(cloud['aperture_radius']) and
+            0 < cloud['dot_radius'] < cloud['aperture_radius']):
+        problems.append(f'cloud: dot_radius ({cloud["dot_radius"]!r}) should be positive and smaller than '
+                        f'aperture_radius ({cloud["aperture_radius"]!r})')
+
+    if cloud.get('renderer', 'element_array') not in _renderers:
+        problems.append(f'cloud: renderer should be one of {_renderers}, not {cloud["renderer"]!r}')
+
+    try:
+        series_durations, series_transforms = get_series(cloud)
+        if not np.all(series_durations > 0):
+            problems.append('cloud: series_durations should all be positive')
+        problems += [f'cloud: unknown series transform {transform!r}' for transform in series_transforms
+                     if not _is_transform(transform)]
+
+        # Every sub-array of a series is drawn from the texture cache on every frame of its trial
+        texture_cache_size = cloud.get('texture_cache_size', 4)
+        if (cloud.get('renderer') == 'texture') and cloud.get('stimulus_series', False) and \
+                not (isinstance(texture_cache_size, int) and texture_cache_size >= len(series_durations)):
+            problems.append(f'cloud: texture_cache_size ({texture_cache_size!r}) should be at least the number of '
+                            f'sub-phases of the stimulus series ({len(series_durations)})')
+    except (ValueError, TypeError) as e:
+        problems.append(str(e))
+
+    problems += [f'cloud: cannot decorrelate unknown layout feature {name!r} (one of {feature_names})'
+                 for name in cloud.get('decorrelate', []) if name not in feature_names]
+
+    return problems
+
+
+class CompiledSettings(object):
+    """ Validated settings: every section as a namespace (settings.durations.array_duration),
+    plus the values derived from them (range bounds, slider lengths, phase durations and
+    names of every trial type). """
+
+    def __init__(self, settings, fn=None):
+        problems = validate_settings(settings)
+
+        if problems:
+            raise ValueError(f'Invalid settings{"" if fn is None else " in " + fn}:\n' +
+                             '\n'.join(f'- {problem}' for problem in problems))
+
+        self.raw = settings
+        self.fn = fn
+
+        for section, values in settings.items():
+            setattr(self, section, SimpleNamespace(**values) if isinstance(values, dict) else values)
+
+        self.ranges = {label: tuple(range_) for label, range_ in settings['ranges'].items()}
+        self._slider_lengths = {range_: self._get_slider_length(range_) for range_ in self.ranges.values()}
+
+        self.series_durations, self.series_transforms = get_series(settings['cloud'])
+
+        d = self.durations
+        self.phase_names = {'task': get_phase_names(1),
+                            'task_series': get_phase_names(len(self.series_durations)),
+                            'feedback': feedback_phase_names}
+        self._phase_durations = {
+            'task': np.array([d.first_fixation, d.second_fixation, d.array_duration, 0., d.response_screen,
+                              d.feedback, 0.]),
+            'task_series': np.concatenate(([d.first_fixation, d.second_fixation],
+                                           d.array_duration * self.series_durations,
+                                           [0., d.response_screen, d.feedback, 0.])),
+            'feedback': np.array([d.first_fixation, d.second_fixation, d.array_duration, feedback_response_window,
+                                  d.feedback])}
+
+    def _get_slider_length(self, range_):
+        # The slider of the widest possible range (slider: max_range) is max_length long
+        max_range = self.slider.max_range
+        return (range_[1] - range_[0]) / (max_range[1] - max_range[0]) * self.slider.max_length
+
+    def get_slider_length(self, range_):
+        """ Length (deg) of the response slider for range_. """
+        range_ = tuple(range_)
+        return self._slider_lengths[range_] if range_ in self._slider_lengths else self._get_slider_length(range_)
+
+    def get_phase_durations(self, trial_type, jitter=0.):
+        """ Phase durations of a trial type (task, task_series or feedback); task trials get their jitter. """
+
+        phase_durations = self._phase_durations[trial_type].copy()
+
+        if trial_type != 'feedback':
+            phase_durations[self.phase_names[trial_type].index('jitter')] = jitter
+
+        return phase_durations.tolist()
+
+
+@functools.lru_cache(maxsize=None)
+def _load_settings(fn, mtime):
+    with open(fn, 'r') as f:
+        return CompiledSettings(yaml.safe_load(f), fn)
+
+
+def get_settings_fn(settings):
+    """ The file of a settings label (settings/<label>.yml), or settings itself if it is a .yml file. """
+    return settings if settings.endswith('.yml') else op.join(op.dirname(__file__), 'settings', f'{settings}.yml')
+
+
+def load_settings(settings):
+    """ Compiled settings of a label or .yml file, parsed and validated once (until the file changes). """
+    fn = op.abspath(get_settings_fn(settings))
+    return _load_settings(fn, op.getmtime(fn))
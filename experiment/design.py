@@ -0,0 +1,198 @@
+import argparse
+import os
+import os.path as op
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import yaml
+
+# Designs are generated in chunks with a seed of their own, so design ix of a seed
+# does not depend on how many designs were generated (or on the number of workers)
+_CHUNK_SIZE = 1000
+
+design_columns = ['trial_nr', 'n', 'jitter', 'start_marker_position', 'layout_seed']
+
+# Trial parameters of feedback trials (which have no jitter); layout_ix is optional (see Session.assign_layouts)
+feedback_columns = ['n', 'start_marker_position', 'layout_seed', 'layout_ix']
+
+
+def _get_range(settings, range):
+    return settings['ranges'][range] if isinstance(range, str) else range
+
+
+def _create_design_chunk(settings, task, range, seed_seq):
+    """ _CHUNK_SIZE designs as a dictionary of (designs x trials) arrays. """
+
+    rng = np.random.default_rng(seed_seq)
+    range_ = _get_range(settings, range)
+
+    if task == 'feedback':
+        n_trials = settings['feedback']['n_examples']
+        jitters = np.zeros((_CHUNK_SIZE, n_trials))
+    else:
+        n_trials = settings['task']['n_trials']
+        if settings.get('no_isi_no_jitter', False):
+            jitters = np.zeros((_CHUNK_SIZE, n_trials))
+        else:
+            # Every ISI equally often (up to the remainder), in random order
+            jitters = rng.permuted(np.tile(np.resize(np.asarray(settings['durations']['isi'], dtype=float), n_trials),
+                                           (_CHUNK_SIZE, 1)), axis=1)
+
+    return {'n': rng.integers(range_[0], range_[1] + 1, (_CHUNK_SIZE, n_trials)),
+            'jitter': jitters,
+            'start_marker_position': rng.integers(range_[0], range_[1] + 1, (_CHUNK_SIZE, n_trials)),
+            'layout_seed': rng.integers(0, 2**31, (_CHUNK_SIZE, n_trials))}
+
+
+def _create_design_chunk_args(args):
+    return _create_design_chunk(*args)
+
+
+def _get_seed_sequence(seed):
+    return seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+
+
+def create_designs(settings, n_designs, task='estimation_task', range='narrow', seed=None, n_workers=1):
+    """ n_designs run designs as a dictionary of (designs x trials) arrays (n, jitter,
+    start_marker_position, layout_seed). range is a label in the settings or (low, high). """
+
+    seed_seq = _get_seed_sequence(seed)
+    n_chunks = int(np.ceil(n_designs / _CHUNK_SIZE))
+    chunk_args = [(settings, task, range, chunk_seed) for chunk_seed in seed_seq.spawn(n_chunks)]
+
+    if n_workers != 1 and n_chunks > 1:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            chunks = list(executor.map(_create_design_chunk_args, chunk_args))
+    else:
+        chunks = [_create_design_chunk(*args) for args in chunk_args]
+
+    return {key: np.concatenate([chunk[key] for chunk in chunks])[:n_designs] for key in chunks[0]}
+
+
+def get_design_table(designs, ix, seed=None, design_ix=None):
+    """ The table (one row per trial) of design ix, labelled with the seed and index it can be recreated from. """
+
+    design = pd.DataFrame({key: values[ix] for key, values in designs.items()})
+    design.insert(0, 'trial_nr', np.arange(1, len(design) + 1))
+
+    if seed is not None:
+        design['design_seed'] = seed
+        design['design_ix'] = ix if design_ix is None else design_ix
+
+    return design
+
+
+def create_design(settings, task='estimation_task', range='narrow', seed=None, ix=0):
+    """ The table of design ix of seed (with a fresh seed if seed is None, which is kept in the table). """
+
+    if seed is None:
+        seed = np.random.SeedSequence().entropy
+
+    seed_seq = np.random.SeedSequence(seed)
+    chunk = _create_design_chunk(settings, task, range, seed_seq.spawn(ix // _CHUNK_SIZE + 1)[-1])
+
+    return get_design_table(chunk, ix % _CHUNK_SIZE, seed, ix)
+
+
+def check_design(design, range_, adaptive=False):
+    """ Raises a ValueError for a design that cannot be run. With adaptive, the numerosities of the design are
+    replaced (see adaptive.py), so they may be blank, as in the designs that adaptive runs save. """
+    if not set(design_columns).issubset(design.columns):
+        raise ValueError(f'A design needs the columns {design_columns} (not {list(design.columns)})')
+
+    if adaptive:
+        return
+
+    if design['n'].isna().any():
+        raise ValueError(f'{design["n"].isna().sum()} trials of the design have no numerosity (as in designs saved '
+                         f'by adaptive runs), so it can only be run with adaptive: enabled: True')
+
+    if (design['n'].min() < range_[0]) or (design['n'].max() > range_[1]):
+        raise ValueError(f'The numerosities of the design ({design["n"].min()}-{design["n"].max()}) '
+                         f'are not in the range of the session ({range_[0]}-{range_[1]})')
+
+
+def get_trial_parameters(design, columns=design_columns[1:] + ['layout_ix']):
+    """ (trial_nr, parameters) of every trial of a design table, for the columns it has. """
+    columns = [column for column in columns if column in design]
+    return [(int(trial_nr), parameters)
+            for trial_nr, parameters in zip(design['trial_nr'], design[columns].to_dict('records'))]
+
+
+def write_design(design, output_dir, output_str, suffix='design'):
+    os.makedirs(output_dir, exist_ok=True)
+    design.to_csv(op.join(output_dir, f'{output_str}_{suffix}.tsv'), sep='\t', index=False)
+
+
+def read_design(fn):
+    return pd.read_csv(fn, sep='\t')
+
+
+def get_balance(designs, range):
+    """ Balance statistics of every design (rows): the largest deviation of the count of a
+    numerosity from a uniform distribution, and the correlations of n with the jitter and
+    with the n of the previous trial. """
+
+    ns, jitters = designs['n'], designs['jitter']
+    n_designs, n_trials = ns.shape
+    n_values = range[1] - range[0] + 1
+
+    # Counts of every numerosity in every design, with one bincount
+    labels = (ns - range[0]) + np.arange(n_designs)[:, np.newaxis] * n_values
+    counts = np.bincount(labels.ravel(), minlength=n_designs * n_values).reshape(n_designs, n_values)
+
+    def correlation(x, y):
+        x = x - x.mean(1, keepdims=True)
+        y = y - y.mean(1, keepdims=True)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return (x * y).sum(1) / np.sqrt((x**2).sum(1) * (y**2).sum(1))
+
+    return pd.DataFrame({'n_imbalance': np.abs(counts - n_trials / n_values).max(1),
+                         'mean_n': ns.mean(1),
+                         'jitter_n_correlation': correlation(ns.astype(float), jitters),
+                         'n_autocorrelation': correlation(ns[:, 1:].astype(float), ns[:, :-1].astype(float))})
+
+
+def main(settings, n_designs, task='estimation_task', range='narrow', seed=None, n_workers=None, output=None):
+
+    settings_fn = op.join(op.dirname(__file__), 'settings', f'{settings}.yml')
+
+    with open(settings_fn, 'r') as f:
+        settings = yaml.safe_load(f)
+
+    if seed is None:
+        seed = np.random.SeedSequence().entropy
+
+    t0 = time.perf_counter()
+    designs = create_designs(settings, n_designs, task, range, seed, n_workers)
+    balance = get_balance(designs, _get_range(settings, range))
+    duration = time.perf_counter() - t0
+
+    print(f'{n_designs} designs in {duration:.2f} s ({n_designs / duration:.0f} designs/s), seed {seed}')
+
+    # Most balanced: fewest excess repetitions of a numerosity, then the smallest correlations
+    score = balance['n_imbalance'] + balance['jitter_n_correlation'].abs().fillna(0) + \
+        balance['n_autocorrelation'].abs()
+    best = int(score.values.argmin())
+
+    print(balance.describe().loc[['mean', 'min', 'max']].to_string(float_format='%.3f'))
+    print(f'Most balanced: design {best}')
+    print(balance.iloc[best].to_string(float_format='%.3f'))
+
+    if output is not None:
+        get_design_table(designs, best, seed).to_csv(output, sep='\t', index=False)
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument('--settings', type=str, help='Settings label', default='default')
+    argparser.add_argument('--task', choices=['estimation_task', 'feedback'], default='estimation_task')
+    argparser.add_argument('--range', choices=['narrow', 'wide'], default='narrow')
+    argparser.add_argument('--n_designs', type=int, default=10000)
+    argparser.add_argument('--seed', type=int, default=None)
+    argparser.add_argument('--n_workers', type=int, default=None)
+    argparser.add_argument('--output', type=str, default=None, help='Write the most balanced design (tsv) here')
+    args = argparser.parse_args()
+
+    main(args.settings, args.n_designs, args.task, args.range, args.seed, args.n_workers, args.output)
@@ -0,0 +1,216 @@
+import argparse
+import math
+import os.path as op
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import yaml
+from design import create_designs, get_design_table, _get_range, _get_seed_sequence
+
+
+def double_gamma_hrf(t, peak=6., undershoot=16., ratio=1 / 6.):
+    """ Canonical (SPM) haemodynamic response at times t (s) after an event; 0 before it. """
+
+    t = np.maximum(t, 0.)
+
+    with np.errstate(divide='ignore'):
+        log_t = np.log(t)
+
+    return np.where(t > 0,
+                    np.exp((peak - 1) * log_t - t) / math.gamma(peak) -
+                    ratio * np.exp((undershoot - 1) * log_t - t) / math.gamma(undershoot),
+                    0.)
+
+
+def get_event_onsets(jitters, durations):
+    """ Onsets (s) of the stimulus and of the response screen of every trial, for (designs x trials) jitters.
+
+    Like TaskTrial with a jitter, every trial lasts as long as without a response. """
+
+    stimulus_delay = durations['first_fixation'] + durations['second_fixation']
+    trial_durations = stimulus_delay + durations['array_duration'] + jitters + durations['response_screen'] + \
+        durations['feedback']
+
+    trial_onsets = np.cumsum(trial_durations, axis=1) - trial_durations
+    stimulus_onsets = trial_onsets + stimulus_delay
+    response_onsets = stimulus_onsets + durations['array_duration'] + jitters
+
+    return stimulus_onsets, response_onsets, trial_onsets[:, -1] + trial_durations[:, -1]
+
+
+def get_drift_regressors(n_scans, tr, cutoff=128.):
+    """ Constant and discrete cosine drifts up to the high-pass cutoff (s), as in SPM. """
+
+    n_regressors = int(2 * n_scans * tr / cutoff) + 1
+    scans = np.arange(n_scans)
+    return np.stack([np.cos(np.pi * k * (scans + .5) / n_scans) for k in range(n_regressors)], 1)
+
+
+def get_design_matrices(ns, jitters, durations, tr, modulator='log', tail=16.):
+    """ Design matrices (designs x scans x regressors) of a batch of designs: the stimulus events,
+    the stimulus events modulated by (mean-centred) numerosity, the response screens and the drifts.
+
+    Events are sticks convolved with the canonical HRF, sampled at the middle of every scan. """
+
+    stimulus_onsets, response_onsets, run_durations = get_event_onsets(jitters, durations)
+
+    n_scans = int(np.ceil((run_durations.max() + tail) / tr))
+    scan_times = (np.arange(n_scans) + .5) * tr
+
+    # (designs x scans x trials) responses to every event
+    stimulus_hrf = double_gamma_hrf(scan_times[np.newaxis, :, np.newaxis] - stimulus_onsets[:, np.newaxis, :])
+    response_hrf = double_gamma_hrf(scan_times[np.newaxis, :, np.newaxis] - response_onsets[:, np.newaxis, :])
+
+    modulation = np.log(ns) if modulator == 'log' else ns.astype(float)
+    modulation = modulation - modulation.mean(1, keepdims=True)
+
+    drifts = get_drift_regressors(n_scans, tr)
+    drifts = np.broadcast_to(drifts, (len(ns),) + drifts.shape)
+
+    return np.concatenate((stimulus_hrf.sum(2)[..., np.newaxis],
+                           np.einsum('dst,dt->ds', stimulus_hrf, modulation)[..., np.newaxis],
+                           response_hrf.sum(2)[..., np.newaxis],
+                           drifts), 2)
+
+
+def get_efficiency(ns, jitters, durations, tr, contrast=None, modulator='log'):
+    """ Estimation efficiency, 1 / (c (X'X)^-1 c'), of every design in a batch (rows of ns and jitters).
+
+    The default contrast is the numerosity modulator. """
+
+    X = get_design_matrices(ns, jitters, durations, tr, modulator)
+
+    if contrast is None:
+        contrast = np.zeros(X.shape[2])
+        contrast[1] = 1.
+    else:
+        contrast = np.concatenate((contrast, np.zeros(X.shape[2] - len(contrast))))
+
+    XtX = np.einsum('dsi,dsj->dij', X, X)
+    solved = np.linalg.solve(XtX, np.broadcast_to(contrast, XtX.shape[:2])[..., np.newaxis])[..., 0]
+
+    return 1. / (solved @ contrast)
+
+
+def _balanced_ns(rng, range_, n_designs, n_trials):
+    # Every numerosity equally often (up to the remainder), in random order
+    return rng.permuted(np.tile(np.resize(np.arange(range_[0], range_[1] + 1), n_trials), (n_designs, 1)), axis=1)
+
+
+def _swap(rng, values):
+    """ Swaps two random trials in every row (in place). """
+    rows = np.arange(len(values))
+    ixs = rng.integers(0, values.shape[1], (2, len(values)))
+    values[rows, ixs[0]], values[rows, ixs[1]] = values[rows, ixs[1]], values[rows, ixs[0]].copy()
+
+
+def search_design(settings, range='narrow', n_generations=200, population_size=1000, n_parents=100, seed=None,
+                  modulator='log'):
+    """ Evolutionary search over the order of numerosities and ISIs (their counts stay balanced).
+
+    Returns the designs (as from create_designs) of the final population, sorted from most
+    to least efficient, their efficiencies and the efficiencies of the random initial population. """
+
+    design_seed, search_seed = _get_seed_sequence(seed).spawn(2)
+    rng = np.random.default_rng(search_seed)
+
+    durations, tr = settings['durations'], settings['mri']['TR']
+    range_ = _get_range(settings, range)
+
+    designs = create_designs(settings, population_size, 'estimation_task', range, design_seed)
+    designs['n'] = _balanced_ns(rng, range_, *designs['n'].shape)
+
+    efficiency = get_efficiency(designs['n'], designs['jitter'], durations, tr, modulator=modulator)
+    baseline = efficiency.copy()
+
+    n_children = population_size - n_parents
+
+    for _ in np.arange(n_generations):
+        order = np.argsort(efficiency)[::-1]
+        parents = order[:n_parents]
+
+        # The best designs survive; children are their copies with two trials swapped in n or in jitter
+        children = {key: values[parents[rng.integers(0, n_parents, n_children)]].copy()
+                    for key, values in designs.items()}
+
+        swap_n = rng.random(n_children) < .5
+        n_swapped, jitter_swapped = children['n'][swap_n], children['jitter'][~swap_n]
+        _swap(rng, n_swapped)
+        _swap(rng, jitter_swapped)
+        children['n'][swap_n], children['jitter'][~swap_n] = n_swapped, jitter_swapped
+
+        designs = {key: np.concatenate((values[parents], children[key])) for key, values in designs.items()}
+        efficiency = np.concatenate((efficiency[parents],
+                                     get_efficiency(children['n'], children['jitter'], durations, tr,
+                                                    modulator=modulator)))
+
+    order = np.argsort(efficiency)[::-1]
+
+    return {key: values[order] for key, values in designs.items()}, efficiency[order], baseline
+
+
+def _search_design_args(args):
+    return search_design(*args)
+
+
+def main(settings, range='narrow', n_searches=4, n_generations=200, population_size=1000, seed=None,
+         modulator='log', n_workers=None, output=None):
+
+    settings_fn = op.join(op.dirname(__file__), 'settings', f'{settings}.yml')
+
+    with open(settings_fn, 'r') as f:
+        settings = yaml.safe_load(f)
+
+    if seed is None:
+        seed = np.random.SeedSequence().entropy
+
+    t0 = time.perf_counter()
+
+    # Independent searches, one per process
+    search_args = [(settings, range, n_generations, population_size, population_size // 10, search_seed, modulator)
+                   for search_seed in np.random.SeedSequence(seed).spawn(n_searches)]
+
+    if n_workers != 1 and n_searches > 1:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            results = list(executor.map(_search_design_args, search_args))
+    else:
+        results = [search_design(*args) for args in search_args]
+
+    best = int(np.argmax([efficiency[0] for _, efficiency, _ in results]))
+    designs, efficiency, _ = results[best]
+    baseline = np.concatenate([baseline for _, _, baseline in results])
+
+    n_evaluated = n_searches * (population_size + n_generations * (population_size - population_size // 10))
+    print(f'{n_evaluated} designs evaluated in {time.perf_counter() - t0:.1f} s, seed {seed}')
+    print(f'Efficiency of the numerosity modulator ({modulator}): random designs median {np.median(baseline):.3f} '
+          f'(best {baseline.max():.3f}), optimized {efficiency[0]:.3f} '
+          f'({efficiency[0] / np.median(baseline):.2f}x the median)')
+
+    # The design is recreated by rerunning the search with the same seed and search settings (not by
+    # create_design, hence no design_seed/design_ix); search_ix is the index of the winning search
+    design = get_design_table(designs, 0)
+    design = design.assign(search_seed=seed, search_ix=best, modulator=modulator, efficiency=efficiency[0],
+                           n_searches=n_searches, n_generations=n_generations, population_size=population_size)
+
+    if output is not None:
+        design.to_csv(output, sep='\t', index=False)
+        print(f'Wrote the design to {output} (run it with task.py --design {output})')
+
+    return design
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument('--settings', type=str, help='Settings label', default='scanner')
+    argparser.add_argument('--range', choices=['narrow', 'wide'], default='narrow')
+    argparser.add_argument('--n_searches', type=int, default=4, help='Number of independent searches (in parallel)')
+    argparser.add_argument('--n_generations', type=int, default=200)
+    argparser.add_argument('--population_size', type=int, default=1000)
+    argparser.add_argument('--modulator', choices=['log', 'linear'], default='log', help='Numerosity modulator')
+    argparser.add_argument('--seed', type=int, default=None)
+    argparser.add_argument('--n_workers', type=int, default=None)
+    argparser.add_argument('--output', type=str, default=None, help='Write the most efficient design (tsv) here')
+    args = argparser.parse_args()
+
+    main(args.settings, args.range, args.n_searches, args.n_generations, args.population_size, args.seed,
+         args.modulator, args.n_workers, args.output)
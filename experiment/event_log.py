@@ -0,0 +1,185 @@
+import json
+import numbers
+import os
+import os.path as op
+import queue
+import threading
+import numpy as np
+import pandas as pd
+
+# Events logged by Trial.get_events() rather than at the start of a phase
+input_event_types = ['response', 'trigger', 'pulse']
+
+
+def _is_number(value):
+    return isinstance(value, numbers.Real) and not isinstance(value, (bool, np.bool_))
+
+
+def _json_value(value):
+    if isinstance(value, (np.integer, np.bool_)):
+        return value.item()
+    if isinstance(value, (float, np.floating)):
+        return None if np.isnan(value) else float(value)
+    return value
+
+
+class _LocIndexer(object):
+
+    def __init__(self, log, positional=False):
+        self.log = log
+        self.positional = positional
+
+    def __setitem__(self, key, value):
+        ix, column = key
+        self.log.set(ix, column, value)
+
+    def __getitem__(self, key):
+        if self.positional:
+            # Slices, lists and (row, column) pairs are not supported, unlike DataFrame.iloc
+            if not isinstance(key, (int, np.integer)) or isinstance(key, (bool, np.bool_)):
+                raise TypeError(f'EventLog.iloc only takes a row number (iloc[int]), not {key!r}; '
+                                f'use to_frame().iloc for anything else')
+
+            ix = key + self.log.n_rows if key < 0 else key
+            return self.log.get_row(ix)
+
+        ix, column = key
+        return self.log.get(ix, column)
+
+
+class EventLog(object):
+    """ Append-only events log, with one preallocated numpy array per column.
+
+    Supports the parts of the DataFrame interface that exptools2 uses for
+    Session.global_log (global_log.shape, global_log.loc[ix, column] = value,
+    with ix == number of rows for a new row) at O(1) per value, with the same
+    column types as the DataFrame would have.
+
+    If fn is given, every row is copied as soon as the next row starts and
+    written to fn (JSON lines) by a background thread, so a crash does not lose
+    the run. """
+
+    def __init__(self, columns=('trial_nr', 'onset', 'event_type', 'phase', 'response', 'nr_frames'),
+                 capacity=1024, fn=None):
+        self.capacity = capacity
+        self.n_rows = 0
+        self.columns = {}
+
+        for column in columns:
+            self._add_column(column, object)
+
+        self.loc = _LocIndexer(self)
+        self.iloc = _LocIndexer(self, positional=True)
+
+        self._last_onsets = {}
+
+        self.fn = fn
+        self._queue = None
+        self._writer = None
+
+        if fn is not None:
+            self._queue = queue.Queue()
+            self._writer = threading.Thread(target=self._write_rows, daemon=True)
+            self._writer.start()
+
+    @property
+    def shape(self):
+        return self.n_rows, len(self.columns)
+
+    def __len__(self):
+        return self.n_rows
+
+    def _add_column(self, column, dtype):
+        self.columns[column] = np.full(self.capacity, np.nan, dtype=dtype)
+
+    def _grow(self):
+        self.capacity *= 2
+        for column, values in self.columns.items():
+            grown = np.full(self.capacity, np.nan, dtype=values.dtype)
+            grown[:self.n_rows] = values[:self.n_rows]
+            self.columns[column] = grown
+
+    def set(self, ix, column, value):
+        if ix == self.n_rows:
+            if self.n_rows == self.capacity:
+                self._grow()
+            self.n_rows += 1
+
+            # The previous row is complete. It is copied here, as the columns can be replaced (see _grow)
+            # while the writer thread runs
+            if self._queue is not None and ix > 0:
+                self._queue.put(self.get_row(ix - 1))
+
+        elif not 0 <= ix < self.n_rows:
+            raise IndexError(f'Can only set existing rows or append row {self.n_rows} (not {ix})')
+
+        # Like DataFrame.loc: new columns of numbers are float64, anything else makes them object columns
+        if column not in self.columns:
+            self._add_column(column, float if _is_number(value) else object)
+        elif self.columns[column].dtype != object and not _is_number(value):
+            self.columns[column] = self.columns[column].astype(object)
+
+        self.columns[column][ix] = value
+
+        if column in ('onset', 'event_type', 'nr_frames'):
+            self._update_last_onset(ix)
+
+    def _update_last_onset(self, ix):
+        # Phase starts (logged by Trial.log_phase_info) are the rows with a frame count
+        event_type = self.columns['event_type'][ix]
+        if isinstance(event_type, str) and not pd.isnull(self.columns['nr_frames'][ix]):
+            self._last_onsets[event_type] = self.columns['onset'][ix]
+
+    def last_onset(self, phase_name):
+        """ Onset of the last phase start with this name (None if there was none). """
+        return self._last_onsets.get(phase_name)
+
+    def get(self, ix, column):
+        if not 0 <= ix < self.n_rows:
+            raise IndexError(ix)
+        return self.columns[column][ix]
+
+    def get_row(self, ix):
+        if not 0 <= ix < self.n_rows:
+            raise IndexError(ix)
+        return {column: values[ix] for column, values in list(self.columns.items())}
+
+    def to_frame(self):
+        """ DataFrame of all rows so far. It shares memory with the log (until the log has to grow). """
+        return pd.DataFrame({column: values[:self.n_rows] for column, values in self.columns.items()}, copy=False)
+
+    def _write_rows(self):
+        f = None
+
+        while True:
+            row = self._queue.get()
+
+            if row is None:
+                break
+
+            if f is None:
+                os.makedirs(op.dirname(op.abspath(self.fn)), exist_ok=True)
+                f = open(self.fn, 'w')
+
+            row = {column: _json_value(value) for column, value in row.items()}
+            f.write(json.dumps(row, default=str) + '\n')
+
+            if self._queue.empty():
+                f.flush()
+
+        if f is not None:
+            f.close()
+
+    def close(self):
+        """ Writes the last row and stops the writer thread. """
+
+        if self._writer is None:
+            return
+
+        if self.n_rows > 0:
+            self._queue.put(self.get_row(self.n_rows - 1))
+
+        self._queue.put(None)
+        self._writer.join()
+        self._writer = None
+        self._queue = None
@@ -1,8 +1,7 @@
 from session import EstimationSession
 from exptools2.core import Trial
 import numpy as np
-from utils import _create_stimulus_array, get_output_dir_str, get_settings
-from psychopy.visual import TextStim
+from utils import get_output_dir_str, get_settings, TrialSpec, LazyTrialList
 import os.path as op
 import argparse
 from instruction import InstructionTrial
@@ -17,13 +16,11 @@ class ExampleTrial(Trial):
 
         self.parameters['n'] = n
 
-        aperture_radius = self.session.settings['cloud'].get('aperture_radius')
-        dot_radius = self.session.settings['cloud'].get('dot_radius')
-
-        self.stimulus_array = _create_stimulus_array(self.session.win, n, aperture_radius, dot_radius)
+        self.stimulus_array = self.session.create_stimulus_array(n)
 
+        aperture_radius = self.session.settings['cloud'].get('aperture_radius')
         text_pos = (0, -aperture_radius * 1.3)
-        self.n_text_stimulus = TextStim(self.session.win, text=n, pos=text_pos, color=(-1, 1, -1))
+        self.n_text_stimulus = self.session.text_pool.get(n, pos=text_pos, color=(-1, 1, -1))
 
     def draw(self):
         #self.session.mouse.clickReset()
@@ -55,7 +52,9 @@ class ExampleSession(EstimationSession):
         ns[0] = self.settings['range'][0]
         ns[1] = self.settings['range'][1]
 
-        self.trials += [ExampleTrial(self, i+1, n=n) for i, n in enumerate(ns)]
+        self.trials += [TrialSpec(ExampleTrial, i+1, dict(n=n)) for i, n in enumerate(ns)]
+
+        self.trials = LazyTrialList(self, self.trials)
 
 
 if __name__ == '__main__':
@@ -1,44 +1,53 @@
 from session import EstimationSession
+from stimuli import render_state
 from exptools2.core import Trial
 import numpy as np
-from utils import _create_stimulus_array, get_output_dir_str, OutroTrial, get_settings
-from psychopy.visual import TextStim
+from utils import get_output_dir_str, OutroTrial, get_settings, TrialSpec, LazyTrialList
 import os.path as op
 import argparse
 from instruction import InstructionTrial
 import yaml
 from score import ScoreTrial
+from design import create_design, check_design, read_design, get_trial_parameters, feedback_columns
 
 class FeedbackTrial(Trial):
 
-    def __init__(self, session, trial_nr, n=15, **kwargs):
+    def __init__(self, session, trial_nr, n=15, start_marker_position=None, layout_seed=None, layout_ix=None,
+                 **kwargs):
 
-        phase_durations = [session.settings['durations']['first_fixation'],  # 0
-                            session.settings['durations']['second_fixation'],# 1
-                            session.settings['durations']['array_duration'], # 2
-                            120,                                            # 3             
-                            session.settings['durations']['feedback']]    # 4
+        phase_durations = session.compiled_settings.get_phase_durations('feedback')
+        phase_names = session.compiled_settings.phase_names['feedback']
+        self.stimulus_phase = phase_names.index('stimulus')
+        self.response_phase = phase_names.index('response')
+        self.feedback_phase = phase_names.index('feedback')
 
-        phase_names = ['fixation1', 'fixation2', 'stimulus', 'response', 'feedback']
         super().__init__(session, trial_nr, phase_durations, phase_names=phase_names, **kwargs)
 
-        self.parameters['n'] = n
+        # The first adaptive trial of a run (see session.update_adaptive_design)
+        if n is None:
+            n = self.session.select_n(self)
 
-        aperture_radius = self.session.settings['cloud'].get('aperture_radius')
-        dot_radius = self.session.settings['cloud'].get('dot_radius')
+        self.parameters['n'] = n
+        self.parameters['layout_seed'] = layout_seed
+        self.parameters['layout_ix'] = layout_ix
 
-        self.stimulus_array = _create_stimulus_array(self.session.win, n, aperture_radius, dot_radius)
+        self.stimulus_array = self.session.create_stimulus_array(n, layout_seed, layout_ix, None, self.parameters)
 
         text_pos = (0, self.session.response_slider.height * 1.5)
 
-        self.n_text_stimulus = TextStim(self.session.win, text=n, pos=text_pos, color=(-1, 1, -1),
-                                        height=self.session.settings['slider'].get('text_height'))
+        self.n_text_stimulus = self.session.text_pool.get(n, pos=text_pos, color=(-1, 1, -1),
+                                                          height=self.session.compiled_settings.slider.text_height)
 
-        self.start_marker_position = np.random.randint(self.session.settings['range'][0], self.session.settings['range'][1] + 1)
+        if start_marker_position is None:
+            start_marker_position = np.random.randint(self.session.settings['range'][0], self.session.settings['range'][1] + 1)
+
+        self.start_marker_position = start_marker_position
 
 
     def draw(self):
 
+        render_state.new_frame()
+
         #self.session.mouse.clickReset()
 
         if self.session.win.mouseVisible:
@@ -49,6 +58,7 @@ class FeedbackTrial(Trial):
         if self.phase == 0:
             self.session.fixation_lines.setColor((-1, .5, -1), fixation_cross_only=True)
             self.session.fixation_lines.draw()
+            self.stimulus_array.prepare()
 
         elif self.phase == 1:
             self.session.fixation_lines.setColor((1, -1, -1), fixation_cross_only=True)
@@ -63,16 +73,43 @@ class FeedbackTrial(Trial):
 
         # Show slider
         elif self.phase == 3:
-            response_slider.marker.inner_color = self.session.settings['slider'].get('color')
+            response_slider.marker.inner_color = self.session.compiled_settings.slider.color
             self.session.fixation_lines.draw()
             response_slider.draw()
 
         elif self.phase == 4:
             self.session.fixation_lines.draw()
-            response_slider.marker.inner_color = self.session.settings['slider'].get('feedbackColor')
+            response_slider.marker.inner_color = self.session.compiled_settings.slider.feedbackColor
             response_slider.draw()
             self.n_text_stimulus.draw()
 
+    @staticmethod
+    def get_stimulus_parameters(session, n=None, layout_seed=None, layout_ix=None, **kwargs):
+        """ Arguments of session.create_stimulus_array for a trial with these parameters (to prefetch its stimulus). """
+        return dict(n=n, layout_seed=layout_seed, layout_ix=layout_ix, transforms=None)
+
+    def log_phase_info(self, phase=None):
+        phase = self.phase if phase is None else phase
+
+        # Before logging, so the row of the phase after the stimulus has the fixation parameters
+        self.session.monitor_fixation(self, phase, [self.stimulus_phase])
+
+        # The next trial's stimulus is prepared in the background during the response phase
+        if phase == self.response_phase:
+            self.session.prefetch_next()
+
+        if phase == self.feedback_phase:
+            self.session.update_adaptive_design(self)
+            self.session.add_to_score(self)
+            # With an adaptive design, the n of the next trial is only known now
+            self.session.prefetch_next()
+
+        super().log_phase_info(phase=phase)
+
+        # Feedback trials have no ITI, so the next trial is built while the feedback is shown
+        if phase == self.feedback_phase:
+            self.session.build_next_trial()
+
     def get_events(self):
 
         _ = super().get_events()
@@ -114,7 +151,7 @@ class FeedbackSession(EstimationSession):
         # self.response_slider.pos = (0, -aperture_radius * 1.5)
 
 
-    def create_trials(self):
+    def create_trials(self, design=None, seed=None):
 
         instruction_trial1 = InstructionTrial(self, 0, self.instructions['intro_part2'])
         instruction_trial2 = InstructionTrial(self, 0, self.instructions['intro_block'].format(range_low=self.settings['range'][0],
@@ -122,16 +159,29 @@ class FeedbackSession(EstimationSession):
                                                                                                
         self.trials = [instruction_trial1, instruction_trial2]
         """Create trials."""
-        n_examples = self.settings['feedback'].get('n_examples')
-        ns = np.random.randint(self.settings['range'][0], self.settings['range'][1] + 1, n_examples)
+        if design is None:
+            design = create_design(self.settings, 'feedback', self.settings['range'], seed)
+
+        check_design(design, self.settings['range'], adaptive=self.adaptive_design is not None)
 
-        self.trials += [FeedbackTrial(self, i+1, n=n) for i, n in enumerate(ns)]
+        # Adaptive trials get their n once the trial before them has a response
+        if self.adaptive_design is not None:
+            design = design.assign(n=None)
+
+        design = self.assign_layouts(design)
+        self.save_design(design)
+
+        self.trials += [TrialSpec(FeedbackTrial, trial_nr, parameters)
+                        for trial_nr, parameters in get_trial_parameters(design, feedback_columns)]
 
         if not self.settings.get('skip_outro', False):
             self.trials.append(OutroTrial(session=self))
 
         self.trials.append(ScoreTrial(self, 0))
 
+        # Feedback trials build their successor during their feedback phase (see session.build_next_trial)
+        self.trials = LazyTrialList(self, self.trials, lookahead=0)
+
 
 if __name__ == '__main__':
 
@@ -142,6 +192,7 @@ if __name__ == '__main__':
     parser.add_argument('range', choices=['narrow', 'wide'], help='Range (either narrow or wide)')
     parser.add_argument('--settings', type=str, default='default', help='Which settings to use (default=default)')
     parser.add_argument('--calibrate_eyetracker', action='store_true', dest='calibrate_eyetracker')
+    parser.add_argument('--design', type=str, default=None, help='Design table (tsv) to run (see design.py)')
 
     args = parser.parse_args()
     output_dir, output_str = get_output_dir_str(args.subject, args.session, 'feedback', args.run)
@@ -154,5 +205,5 @@ if __name__ == '__main__':
                               eyetracker_on=use_eyetracker, output_dir=output_dir, settings_file=settings_fn, run=args.run,
                               calibrate_eyetracker=args.calibrate_eyetracker)
 
-    session.create_trials()
+    session.create_trials(design=None if args.design is None else read_design(args.design))
     session.run()
\ No newline at end of file
@@ -0,0 +1,216 @@
+import functools
+import threading
+import time
+import numpy as np
+from psychopy.tools.monitorunittools import pix2deg
+
+# pylink's value for missing gaze data (e.g., during blinks)
+_MISSING_DATA = -32768.
+
+
+class LockedTracker(object):
+    """ Proxy of a pylink EyeLink whose methods hold a lock, so that the session (e.g., sendMessage
+    in exptools2's log_phase_info) and the gaze monitor thread do not use the link at the same time. """
+
+    def __init__(self, tracker):
+        self._tracker = tracker
+        self.lock = threading.RLock()
+
+    def __getattr__(self, name):
+        attr = getattr(self._tracker, name)
+
+        if not callable(attr):
+            return attr
+
+        @functools.wraps(attr)
+        def locked(*args, **kwargs):
+            with self.lock:
+                return attr(*args, **kwargs)
+
+        return locked
+
+
+class EyeLinkSource(object):
+    """ Gaze samples of a (recording) pylink EyeLink, in deg from the centre of the window.
+
+    Every read empties the link buffer, so no sample is dropped between polls (the
+    tracker has to send samples over the link, as exptools2 sets it up to do). """
+
+    def __init__(self, tracker, win, clock):
+        from pylink import SAMPLE_TYPE
+
+        self.tracker = tracker if isinstance(tracker, LockedTracker) else LockedTracker(tracker)
+        self.clock = clock
+        self.monitor = win.monitor
+        self.half_size = np.array(win.size) / 2.
+        self._sample_type = SAMPLE_TYPE
+
+    def read(self):
+        sample_times, gazes = [], []
+
+        with self.tracker.lock:
+            while True:
+                item_type = self.tracker.getNextData()
+
+                if not item_type:
+                    break
+
+                # Events (fixations, saccades, ...) are skipped
+                if item_type != self._sample_type:
+                    continue
+
+                sample = self.tracker.getFloatData()
+                sample_times.append(sample.getTime())
+
+                if sample.isRightSample():
+                    gazes.append(sample.getRightEye().getGaze())
+                elif sample.isLeftSample():
+                    gazes.append(sample.getLeftEye().getGaze())
+                else:
+                    gazes.append((_MISSING_DATA, _MISSING_DATA))
+
+            if len(sample_times) == 0:
+                return np.zeros(0), np.zeros(0), np.zeros(0)
+
+            tracker_time = self.tracker.trackerTime()
+            session_time = self.clock.getTime()
+
+        # Sample times are on the tracker clock (ms)
+        times = session_time - (tracker_time - np.array(sample_times, dtype=float)) / 1000.
+        gazes = np.array(gazes, dtype=float)
+
+        # EyeLink screen coordinates have their origin top left
+        positions = pix2deg(np.stack((gazes[:, 0] - self.half_size[0], self.half_size[1] - gazes[:, 1]), 1),
+                            self.monitor)
+        positions[(gazes <= _MISSING_DATA).any(1)] = np.nan
+
+        return times, positions[:, 0], positions[:, 1]
+
+
+class ReplaySource(object):
+    """ Streams recorded or synthetic gaze samples (times on the session clock, in s; x and y in deg)
+    as the session clock passes their timestamps. Stands in for EyeLinkSource without a tracker. """
+
+    def __init__(self, times, xs, ys, clock):
+        self.times = np.asarray(times, dtype=float)
+        self.xs = np.asarray(xs, dtype=float)
+        self.ys = np.asarray(ys, dtype=float)
+        self.clock = clock
+        self._next = 0
+
+    @classmethod
+    def from_file(cls, fn, clock):
+        """ Samples from a .npy file with an array of (time, x, y) rows. """
+        samples = np.load(fn)
+        return cls(samples[:, 0], samples[:, 1], samples[:, 2], clock)
+
+    def read(self):
+        now = self.clock.getTime()
+
+        # The session clock was reset (e.g., a new block): continue from the new time
+        if self._next > 0 and now < self.times[self._next - 1]:
+            self._next = np.searchsorted(self.times, now, side='right')
+
+        end = np.searchsorted(self.times, now, side='right')
+        ixs = slice(self._next, max(self._next, end))
+        self._next = max(self._next, end)
+        return self.times[ixs], self.xs[ixs], self.ys[ixs]
+
+
+def synthetic_gaze(duration, rate=500., noise=0.2, break_rate=0.05, break_duration=0.3, break_distance=3., seed=None):
+    """ Fixation with Gaussian noise (deg) and, on average every 1 / break_rate seconds,
+    a break of break_duration seconds to break_distance deg away. Returns times, xs, ys. """
+
+    rng = np.random.default_rng(seed)
+
+    times = np.arange(0, duration, 1. / rate)
+    xs = rng.normal(0, noise, len(times))
+    ys = rng.normal(0, noise, len(times))
+
+    break_onsets = np.cumsum(rng.exponential(1. / break_rate, int(duration * break_rate * 2) + 1))
+    break_onsets = break_onsets[break_onsets < duration]
+    directions = rng.uniform(0, 2 * np.pi, len(break_onsets))
+
+    starts = np.searchsorted(times, break_onsets)
+    ends = np.searchsorted(times, break_onsets + break_duration)
+
+    for start, end, direction in zip(starts, ends, directions):
+        xs[start:end] += break_distance * np.cos(direction)
+        ys[start:end] += break_distance * np.sin(direction)
+
+    return times, xs, ys
+
+
+class GazeMonitor(object):
+    """ Polls a gaze source on a background thread into a ring buffer of (time, x, y) samples.
+
+    Trials mark the sample number at the start of the stimulus (start_interval) and
+    ask at its end whether the gaze left fixation in between (check_fixation). """
+
+    def __init__(self, source, rate=500., max_distance=1.5, capacity=2**14):
+        self.source = source
+        self.interval = 1. / rate
+        self.max_distance = max_distance
+        self.capacity = capacity
+
+        self.times = np.zeros(capacity)
+        self.positions = np.zeros((capacity, 2))
+        self.n_samples = 0
+
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._poll_continuously, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+
+    def poll(self):
+        """ Moves all new samples of the source into the buffer. """
+
+        with self._lock:
+            times, xs, ys = self.source.read()
+            ixs = np.arange(self.n_samples, self.n_samples + len(times)) % self.capacity
+
+            self.times[ixs] = times
+            self.positions[ixs, 0] = xs
+            self.positions[ixs, 1] = ys
+            self.n_samples += len(times)
+
+    def _poll_continuously(self):
+        next_poll = time.perf_counter()
+
+        while not self._stop.is_set():
+            self.poll()
+            next_poll += self.interval
+            time.sleep(max(0., next_poll - time.perf_counter()))
+
+    def start_interval(self):
+        """ Sample number from which check_fixation looks. """
+        self.poll()
+        return self.n_samples
+
+    def check_fixation(self, start):
+        """ Returns whether the gaze left fixation (or was missing) since sample number start
+        and the largest distance from fixation; (None, nan) if there were no samples. """
+
+        self.poll()
+
+        start = max(start, self.n_samples - self.capacity)
+        positions = self.positions[np.arange(start, self.n_samples) % self.capacity]
+
+        if len(positions) == 0:
+            return None, np.nan
+
+        distances = np.sqrt((positions ** 2).sum(1))
+        valid_distances = distances[~np.isnan(distances)]
+        max_distance = valid_distances.max() if len(valid_distances) > 0 else np.nan
+
+        # Missing gaze (blinks) counts as a break, too
+        broken = bool((len(valid_distances) < len(distances)) or (max_distance > self.max_distance))
+
+        return broken, max_distance
@@ -0,0 +1,352 @@
+import argparse
+import os.path as op
+import sys
+import time
+from contextlib import contextmanager
+import numpy as np
+import pandas as pd
+import yaml
+import pyglet
+
+# Without a display, importing psychopy.visual fails while pyglet creates its shadow window
+pyglet.options['shadow_window'] = False
+
+from psychopy import event
+from psychopy import logging as psychopy_logging
+from exptools2.core import PylinkEyetrackerSession, Trial
+import utils
+import stimuli
+from task import TaskSession
+
+
+class VirtualTime(object):
+    """ Time source shared by the headless window, clocks and input devices. """
+
+    def __init__(self):
+        self.now = 0.0
+
+
+class VirtualClock(object):
+    """ Stand-in for psychopy.core.Clock that runs on virtual time. """
+
+    def __init__(self, virtual_time):
+        self._virtual_time = virtual_time
+        self._time_at_last_reset = virtual_time.now
+
+    def getTime(self, *args, **kwargs):
+        return self._virtual_time.now - self._time_at_last_reset
+
+    def reset(self, newT=0.0):
+        self._time_at_last_reset = self._virtual_time.now + newT
+
+    def addTime(self, t):
+        self._time_at_last_reset -= t
+
+    def add(self, t):
+        self._time_at_last_reset += t
+
+
+class HeadlessWindow(object):
+    """ Stand-in for psychopy.visual.Window: every flip advances virtual time by one frame. """
+
+    def __init__(self, virtual_time, size=(1200, 1200), framerate=60.):
+        self._virtual_time = virtual_time
+        self.size = np.array(size)
+        self.frame_duration = 1. / framerate
+        self.units = 'deg'
+        self.monitor = None
+        self.mouseVisible = False
+        self.recordFrameIntervals = False
+        self.frameIntervals = []
+        self._to_call = []
+
+    def callOnFlip(self, function, *args, **kwargs):
+        self._to_call.append((function, args, kwargs))
+
+    def flip(self, clearBuffer=True):
+        self._virtual_time.now += self.frame_duration
+
+        to_call, self._to_call = self._to_call, []
+        for function, args, kwargs in to_call:
+            function(*args, **kwargs)
+
+        if self.recordFrameIntervals:
+            self.frameIntervals.append(self.frame_duration)
+
+        return self._virtual_time.now
+
+    def setMouseVisible(self, visible):
+        self.mouseVisible = visible
+
+    def close(self):
+        pass
+
+
+class NullStim(object):
+    """ Stand-in for psychopy stimuli: keeps attributes, draws nothing. """
+
+    def __init__(self, *args, **kwargs):
+        self.__dict__.update(kwargs)
+
+    def draw(self, *args, **kwargs):
+        pass
+
+    def setAutoDraw(self, value):
+        pass
+
+
+class ClickResponder(object):
+    """ Clicks the left mouse button for one frame every interval seconds. """
+
+    def __init__(self, interval=1.0):
+        self.interval = interval
+
+    def update(self, mouse, session, t):
+        mouse.pressed = (t % self.interval) < session.win.frame_duration
+
+
+class SyntheticMouse(object):
+    """ Stand-in for psychopy.event.Mouse whose position and buttons are set by a responder. """
+
+    def __init__(self, backend, *args, **kwargs):
+        self.backend = backend
+        self.x = 0.0
+        self.pressed = False
+        self._last_update = None
+
+    def _update(self):
+        t = self.backend.virtual_time.now
+        if t != self._last_update:
+            self.backend.responder.update(self, self.backend.session, t)
+            self._last_update = t
+
+    def getPos(self):
+        self._update()
+        return np.array([self.x, 0.0])
+
+    def setPos(self, pos=(0, 0)):
+        self.x = pos[0]
+
+    def getPressed(self, getTime=False):
+        self._update()
+        return [self.pressed, False, False]
+
+    def clickReset(self, buttons=(0, 1, 2)):
+        pass
+
+    def setVisible(self, visible):
+        pass
+
+
+class ScannerTriggers(object):
+    """ Synthetic scanner triggers: key every tr seconds, starting at onset. """
+
+    def __init__(self, key, tr=2.0, onset=1.0, jitter=0.0, seed=None):
+        self.key = key
+        self.tr = tr
+        self.onset = onset
+        self.jitter = jitter
+        self.rng = np.random.default_rng(seed)
+        self._next = 0
+
+    def keys_until(self, t):
+        keys = []
+        while self.onset + self._next * self.tr <= t:
+            keys.append((self.key, self.onset + self._next * self.tr + self.rng.normal(0, self.jitter)))
+            self._next += 1
+        return keys
+
+
+class SyntheticKeyboard(object):
+    """ Stand-in for psychopy.event.getKeys that replays keys from a list of sources. """
+
+    def __init__(self, backend, sources=()):
+        self.backend = backend
+        self.sources = list(sources)
+
+    def getKeys(self, keyList=None, timeStamped=False, *args, **kwargs):
+        now = self.backend.virtual_time.now
+        keys = sorted((key for source in self.sources for key in source.keys_until(now)), key=lambda key: key[1])
+
+        if keyList is not None:
+            keys = [key for key in keys if key[0] in keyList]
+
+        if timeStamped is False:
+            return [key for key, t in keys]
+
+        if timeStamped is True:
+            return [(key, t) for key, t in keys]
+
+        # Timestamps on the given clock
+        return [(key, timeStamped.getTime() - (now - t)) for key, t in keys]
+
+
+class HeadlessBackend(object):
+    """ Virtual-clock replacement for the window, mouse, keyboard and session clocks.
+
+    Within `with backend.activate():` sessions from this repository run without
+    a display, as fast as the trial logic allows, and write the same events.tsv. """
+
+    def __init__(self, framerate=60., responder=None, key_sources=None, pix_per_deg=40., trigger_tr=None,
+                 trigger_jitter=0.0):
+        self.virtual_time = VirtualTime()
+        # HeadlessWindow.flip() returns the virtual time itself
+        self.flip_clock = VirtualClock(self.virtual_time)
+        self.framerate = framerate
+        self.responder = responder if responder is not None else ClickResponder()
+        self.key_sources = key_sources
+        self.trigger_tr = trigger_tr
+        self.trigger_jitter = trigger_jitter
+        self.pix_per_deg = pix_per_deg
+        self.session = None
+        self.keyboard = None
+
+    def _session_init(self, session, output_str, output_dir=None, settings_file=None, eyetracker_on=False, **kwargs):
+        """ Replaces Session.__init__: sets up the attributes trials and sessions rely on.
+
+        This is a stand-in, not exptools2: the settings are the yml file as is, without exptools2's
+        default settings merged in (so every setting the sessions use must be in the file), only the
+        attributes of exptools2's sessions that this repository uses are set, and _close saves the events
+        without exptools2's own close. Sessions that rely on more of exptools2 need a real window. """
+
+        with open(settings_file, 'r') as f:
+            session.settings = yaml.safe_load(f)
+
+        session.output_str = output_str
+        session.output_dir = output_dir if output_dir is not None else op.join(op.dirname(__file__), 'logs')
+        session.settings_file = settings_file
+
+        session.clock = VirtualClock(self.virtual_time)
+        session.timer = VirtualClock(self.virtual_time)
+        session.win = HeadlessWindow(self.virtual_time, size=session.settings['window']['size'], framerate=self.framerate)
+        session.mouse = SyntheticMouse(self)
+        session.actual_framerate = self.framerate
+        session.mri_trigger = str(session.settings['mri']['sync'])
+        session.mri_simulator = None
+        session.eyetracker_on = False
+        session.tracker = None
+
+        session.global_log = pd.DataFrame(columns=['trial_nr', 'onset', 'event_type', 'phase', 'response', 'nr_frames'])
+        session.nr_frames = 0
+        session.first_trial = True
+        session.exp_start = None
+        session.exp_stop = None
+        session.closed = False
+
+        if self.key_sources is None:
+            # The scanner's actual TR can differ from the nominal one in the settings
+            tr = self.trigger_tr if self.trigger_tr is not None else session.settings['mri'].get('TR', 2.0)
+            self.keyboard = SyntheticKeyboard(self, [ScannerTriggers(session.mri_trigger, tr=tr,
+                                                                     jitter=self.trigger_jitter)])
+        else:
+            self.keyboard = SyntheticKeyboard(self, self.key_sources)
+
+        self.session = session
+
+    def _start_experiment(self, session, *args, **kwargs):
+        def set_exp_start():
+            session.exp_start = self.virtual_time.now
+            session.clock.reset()
+            session.timer.reset()
+
+        session.win.callOnFlip(set_exp_start)
+        session.win.flip()
+
+    def _close(self, session):
+        if session.closed:
+            return
+
+        session.exp_stop = session.clock.getTime()
+        session.global_log = session.save_events()
+        session.closed = True
+
+    def _quit(self, session):
+        sys.exit(0)
+
+    @contextmanager
+    def activate(self):
+        backend = self
+        patches = [(PylinkEyetrackerSession, '__init__', lambda session, *args, **kwargs: backend._session_init(session, *args, **kwargs)),
+                   (PylinkEyetrackerSession, 'start_experiment', lambda session, *args, **kwargs: backend._start_experiment(session)),
+                   (PylinkEyetrackerSession, 'close', lambda session: backend._close(session)),
+                   (PylinkEyetrackerSession, 'quit', lambda session: backend._quit(session)),
+                   (event, 'Mouse', lambda *args, **kwargs: SyntheticMouse(backend)),
+                   (event, 'getKeys', lambda *args, **kwargs: backend.keyboard.getKeys(*args, **kwargs)),
+                   (utils, 'deg2pix', lambda degrees, monitor: degrees * backend.pix_per_deg),
+                   # The clock of the flip times that HeadlessWindow.flip() returns (see FrameRecorder)
+                   (psychopy_logging, 'defaultClock', backend.flip_clock)]
+
+        # In case the trial module imported getKeys directly
+        trial_module = sys.modules[Trial.__module__]
+        if hasattr(trial_module, 'getKeys'):
+            patches.append((trial_module, 'getKeys', lambda *args, **kwargs: backend.keyboard.getKeys(*args, **kwargs)))
+
+        for module in (utils, stimuli):
+            for name in ('ElementArrayStim', 'RadialStim', 'Circle', 'GratingStim', 'Line', 'Rect', 'TextStim', 'ShapeStim'):
+                if hasattr(module, name):
+                    patches.append((module, name, NullStim))
+
+        originals = [(target, name, target.__dict__.get(name, None), name in target.__dict__)
+                     for target, name, _ in patches]
+
+        try:
+            for target, name, replacement in patches:
+                setattr(target, name, replacement)
+            yield self
+        finally:
+            for target, name, original, existed in originals:
+                if existed:
+                    setattr(target, name, original)
+                else:
+                    delattr(target, name)
+
+
+def run_headless_session(session_cls, task='estimation_task', settings='default', subject='headless', session=None,
+                         run=1, range='narrow', output_dir=None, backend=None, create_trials_kwargs=None):
+    """ Creates, fills and runs a session on a headless backend. Returns the session. """
+
+    if backend is None:
+        backend = HeadlessBackend()
+
+    if create_trials_kwargs is None:
+        create_trials_kwargs = {}
+
+    settings_fn = op.join(op.dirname(__file__), 'settings', f'{settings}.yml')
+    output_dir_, output_str = utils.get_output_dir_str(subject, session, task, run)
+
+    if output_dir is None:
+        output_dir = output_dir_
+
+    with backend.activate():
+        session_ = session_cls(output_str=output_str, subject=subject, output_dir=output_dir,
+                               settings_file=settings_fn, run=run, range=range)
+        session_.create_trials(**create_trials_kwargs)
+        session_.run()
+
+    return session_
+
+
+def main(settings, n_runs, output_dir, framerate, trigger_tr=None, trigger_jitter=0.0):
+
+    for run in range(1, n_runs+1):
+        backend = HeadlessBackend(framerate=framerate, trigger_tr=trigger_tr, trigger_jitter=trigger_jitter)
+
+        t0 = time.perf_counter()
+        session = run_headless_session(TaskSession, settings=settings, run=run, output_dir=output_dir, backend=backend)
+        wall_time = time.perf_counter() - t0
+
+        print(f'Run {run}: {backend.virtual_time.now:.1f} s of session time in {wall_time:.2f} s '
+              f'({backend.virtual_time.now / wall_time:.0f}x real time), log in {session.output_dir}')
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument('--settings', type=str, help='Settings label', default='default')
+    argparser.add_argument('--n_runs', type=int, default=1)
+    argparser.add_argument('--output_dir', type=str, default=None)
+    argparser.add_argument('--framerate', type=float, default=60.)
+    argparser.add_argument('--trigger_tr', type=float, default=None, help='TR of the synthetic triggers (default: mri.TR)')
+    argparser.add_argument('--trigger_jitter', type=float, default=0.0, help='SD (s) of the synthetic trigger times')
+    args = argparser.parse_args()
+
+    main(args.settings, args.n_runs, args.output_dir, args.framerate, args.trigger_tr, args.trigger_jitter)
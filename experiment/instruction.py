@@ -1,4 +1,3 @@
-from psychopy.visual import TextStim
 from exptools2.core import Trial
 import numpy as np
 
@@ -21,15 +20,17 @@ class InstructionTrial(Trial):
         txt_width = self.session.settings['various'].get('text_width')
         txt_color = self.session.settings['various'].get('text_color')
 
-        self.text = TextStim(session.win, txt,
-                             pos=(0.0, 0.0), height=txt_height, wrapWidth=txt_width, color=txt_color)
+        self.text_kwargs = dict(height=txt_height, wrapWidth=txt_width, color=txt_color)
+        self.set_text(txt)
 
         if bottom_txt is None:
             bottom_txt = "Press any button to continue"
 
-        self.text2 = TextStim(session.win, bottom_txt, pos=(
-            0.0, -6.0), height=txt_height, wrapWidth=txt_width,
-            color=txt_color)
+        self.text2 = self.session.text_pool.get(bottom_txt, pos=(0.0, -6.0), **self.text_kwargs)
+
+    def set_text(self, txt):
+        # Texts come from the session's shared pool, so swap the stimulus instead of changing its text
+        self.text = self.session.text_pool.get(txt, pos=(0.0, 0.0), **self.text_kwargs)
 
     def get_events(self):
 
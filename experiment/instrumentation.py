@@ -0,0 +1,165 @@
+import os
+import os.path as op
+import time
+import numpy as np
+import pandas as pd
+from psychopy import logging as psychopy_logging
+
+
+class FrameRecorder(object):
+    """ Records every flip (timestamp, trial, phase) and the draw time of every
+    instrumented stimulus class during that frame.
+
+    Everything is kept in preallocated numpy arrays (grown by doubling), so
+    recording a frame costs a handful of array writes. """
+
+    def __init__(self, session, capacity=2**15, max_n_classes=16):
+        self.session = session
+        self.stimulus_classes = []
+        self.max_n_classes = max_n_classes
+
+        self.flip_times = np.zeros(capacity)
+        self.trial_ixs = np.zeros(capacity, dtype=np.int32)
+        self.trial_nrs = np.zeros(capacity, dtype=np.int32)
+        self.phases = np.zeros(capacity, dtype=np.int16)
+        self.draw_times = np.zeros((capacity, max_n_classes), dtype=np.float32)
+
+        self.n_frames = 0
+        self._frame_draw_times = np.zeros(max_n_classes)
+        self.planned_durations = []
+
+    def reset(self):
+        self.n_frames = 0
+        self._frame_draw_times[:] = 0
+        self.planned_durations = []
+
+    def _grow(self):
+        capacity = len(self.flip_times) * 2
+        self.flip_times = np.resize(self.flip_times, capacity)
+        self.trial_ixs = np.resize(self.trial_ixs, capacity)
+        self.trial_nrs = np.resize(self.trial_nrs, capacity)
+        self.phases = np.resize(self.phases, capacity)
+        self.draw_times = np.resize(self.draw_times, (capacity, self.max_n_classes))
+
+    def instrument(self, stimulus):
+        """ Times every draw() of stimulus (per stimulus class). """
+
+        name = type(stimulus).__name__
+
+        if name not in self.stimulus_classes:
+            if len(self.stimulus_classes) == self.max_n_classes:
+                return stimulus
+            self.stimulus_classes.append(name)
+
+        ix = self.stimulus_classes.index(name)
+        draw = stimulus.draw
+        frame_draw_times = self._frame_draw_times
+
+        def timed_draw(*args, **kwargs):
+            t0 = time.perf_counter()
+            draw(*args, **kwargs)
+            frame_draw_times[ix] += time.perf_counter() - t0
+
+        stimulus.draw = timed_draw
+        return stimulus
+
+    def instrument_window(self, win):
+        """ Records a frame after every win.flip(). """
+
+        flip = win.flip
+
+        # win.flip() returns the time of the flip (with waitBlanking) on psychopy's default clock
+        flip_clock = psychopy_logging.defaultClock
+
+        def recorded_flip(*args, **kwargs):
+            result = flip(*args, **kwargs)
+
+            if result is None:
+                self.record_flip()
+            else:
+                # Clocks can be reset (e.g., at the first flip of a block), so map onto the session clock every flip
+                self.record_flip(result + self.session.clock.getTime() - flip_clock.getTime())
+
+            return result
+
+        win.flip = recorded_flip
+
+    def record_flip(self, flip_time=None):
+        """ Records a frame that flipped at flip_time on the session clock (default: now). """
+
+        if self.n_frames == len(self.flip_times):
+            self._grow()
+
+        ix = self.n_frames
+        trial = getattr(self.session, 'current_trial', None)
+
+        self.flip_times[ix] = self.session.clock.getTime() if flip_time is None else flip_time
+        self.trial_ixs[ix] = getattr(self.session, 'current_trial_ix', -1)
+        self.trial_nrs[ix] = trial.trial_nr if trial is not None else -1
+        self.phases[ix] = trial.phase if trial is not None else -1
+        self.draw_times[ix] = self._frame_draw_times
+
+        self._frame_draw_times[:] = 0
+        self.n_frames += 1
+
+    def record_trial(self, trial_ix, trial):
+        """ Stores the planned phase durations of a trial that has run. """
+        for phase, (phase_name, duration) in enumerate(zip(trial.phase_names, trial.phase_durations)):
+            self.planned_durations.append((trial_ix, trial.trial_nr, phase, phase_name, duration))
+
+    def get_frames(self):
+        n = self.n_frames
+        frames = pd.DataFrame({'flip_time': self.flip_times[:n], 'trial_ix': self.trial_ixs[:n],
+                               'trial_nr': self.trial_nrs[:n], 'phase': self.phases[:n]})
+
+        for ix, name in enumerate(self.stimulus_classes):
+            frames[f'draw_{name}'] = self.draw_times[:n, ix]
+
+        return frames
+
+    def get_summary(self, frame_duration=None):
+        """ Measured vs. planned phase durations and dropped frames per phase. """
+
+        n = self.n_frames
+        planned = pd.DataFrame(self.planned_durations,
+                               columns=['trial_ix', 'trial_nr', 'phase', 'phase_name', 'planned_duration'])
+
+        if n == 0:
+            return planned.iloc[:0]
+
+        intervals = np.diff(self.flip_times[:n], prepend=np.nan)
+
+        if frame_duration is None:
+            frame_duration = np.nanmedian(intervals)
+
+        # A frame was dropped if it came (much) later than one refresh after the previous one
+        dropped = (intervals > 1.5 * frame_duration).astype(int)
+
+        segment_start = np.flatnonzero((np.diff(self.trial_ixs[:n], prepend=-2) != 0) |
+                                       (np.diff(self.phases[:n], prepend=-2) != 0))
+        segment_end = np.append(self.flip_times[segment_start[1:]], self.flip_times[n-1] + frame_duration)
+
+        summary = pd.DataFrame({'trial_ix': self.trial_ixs[segment_start],
+                                'trial_nr': self.trial_nrs[segment_start],
+                                'phase': self.phases[segment_start],
+                                'measured_duration': segment_end - self.flip_times[segment_start],
+                                'n_frames': np.diff(np.append(segment_start, n)),
+                                'n_dropped_frames': np.add.reduceat(dropped, segment_start)})
+
+        return summary.merge(planned, on=['trial_ix', 'trial_nr', 'phase'], how='left')
+
+    def save(self, output_dir, output_str, frame_duration=None):
+        os.makedirs(output_dir, exist_ok=True)
+
+        n = self.n_frames
+        np.savez(op.join(output_dir, f'{output_str}_frames.npz'),
+                 flip_time=self.flip_times[:n], trial_ix=self.trial_ixs[:n], trial_nr=self.trial_nrs[:n],
+                 phase=self.phases[:n], draw_times=self.draw_times[:n, :len(self.stimulus_classes)],
+                 stimulus_classes=np.array(self.stimulus_classes))
+
+        summary = self.get_summary(frame_duration)
+        summary.to_csv(op.join(output_dir, f'{output_str}_frames_summary.tsv'), sep='\t', index=False)
+
+        print(f'Frames: {n} recorded, {summary["n_dropped_frames"].sum()} dropped')
+
+        return summary
@@ -0,0 +1,198 @@
+import argparse
+import logging
+import os.path as op
+import struct
+import threading
+import time
+import zipfile
+import numpy as np
+import yaml
+from layout_features import sample_layouts, get_features, feature_names, LayoutIndex
+
+
+def create_layout_bank(ns, n_layouts, aperture_radius, dot_radius, seed=None, max_n_batches=10):
+    """ Samples n_layouts dot layouts for every numerosity in ns, in batches, and computes their features.
+
+    Layouts are stored in one array of shape (len(ns), n_layouts, max(ns), 2);
+    rows beyond the numerosity of a layout are NaN. Features (see layout_features.py)
+    are stored in an array of shape (len(ns), n_layouts, len(feature_names)). """
+
+    rng = np.random.default_rng(seed)
+    ns = np.sort(np.unique(ns))
+    layouts = np.full((len(ns), n_layouts, ns.max(), 2), np.nan, dtype=np.float32)
+    features = np.zeros((len(ns), n_layouts, len(feature_names)), dtype=np.float32)
+
+    for i, n in enumerate(ns):
+        batch = np.zeros((0, n, 2))
+
+        for _ in np.arange(max_n_batches):
+            if len(batch) == n_layouts:
+                break
+            batch = np.concatenate((batch, sample_layouts(n, n_layouts - len(batch), aperture_radius, dot_radius,
+                                                          rng=rng)))
+
+        if len(batch) < n_layouts:
+            raise RuntimeError(f'Could only complete {len(batch)} out of {n_layouts} layouts with {n} dots')
+
+        layouts[i, :, :n] = batch
+        batch_features = get_features(batch)
+        features[i] = np.stack([batch_features[name] for name in feature_names], 1)
+
+    return ns, layouts, features
+
+
+def save_layout_bank(fn, ns, layouts, aperture_radius, dot_radius, features=None):
+    # np.savez stores the arrays uncompressed, which is what lets us memory-map them
+    if features is None:
+        np.savez(fn, ns=ns, layouts=layouts, aperture_radius=aperture_radius, dot_radius=dot_radius)
+    else:
+        np.savez(fn, ns=ns, layouts=layouts, aperture_radius=aperture_radius, dot_radius=dot_radius,
+                 features=features, feature_names=feature_names)
+
+
+def _memmap_npz_array(fn, key):
+    """ Memory-maps an array stored (uncompressed) in an .npz file. """
+
+    with zipfile.ZipFile(fn) as zf:
+        info = zf.getinfo(f'{key}.npy')
+
+    if info.compress_type != zipfile.ZIP_STORED:
+        raise ValueError(f'{key} in {fn} is compressed and cannot be memory-mapped')
+
+    with open(fn, 'rb') as f:
+        # Skip the local zip header of the member to get to the .npy data
+        f.seek(info.header_offset)
+        local_header = f.read(30)
+        name_length, extra_length = struct.unpack('<HH', local_header[26:30])
+        f.seek(info.header_offset + 30 + name_length + extra_length)
+
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+        offset = f.tell()
+
+    return np.memmap(fn, dtype=dtype, mode='r', shape=shape, offset=offset,
+                     order='F' if fortran_order else 'C')
+
+
+class LayoutBank(object):
+    """ Memory-mapped bank of precomputed dot layouts. """
+
+    def __init__(self, fn):
+        with np.load(fn) as bank:
+            self.ns = bank['ns']
+            self.aperture_radius = float(bank['aperture_radius'])
+            self.dot_radius = float(bank['dot_radius'])
+
+            # Banks made before layout features were added have no index
+            if 'features' in bank:
+                self.index = LayoutIndex(self.ns, {name: bank['features'][..., i]
+                                                   for i, name in enumerate(bank['feature_names'])})
+            else:
+                self.index = None
+
+        self.fn = fn
+        self.layouts = _memmap_npz_array(fn, 'layouts')
+        self.n_layouts = self.layouts.shape[1]
+
+        self._index = {n: i for i, n in enumerate(self.ns)}
+        # Layouts drawn without a seed come from one shuffled order per n, shared with the prefetch thread
+        self._order = {}
+        self._order_lock = threading.Lock()
+
+    def __contains__(self, n):
+        return n in self._index
+
+    def check_geometry(self, aperture_radius, dot_radius):
+        if not (np.isclose(aperture_radius, self.aperture_radius) and np.isclose(dot_radius, self.dot_radius)):
+            raise ValueError(f'Layout bank {self.fn} was made for aperture_radius={self.aperture_radius}, '
+                             f'dot_radius={self.dot_radius}, not {aperture_radius}, {dot_radius}')
+
+    def get_run_layouts(self, ns, seed=None):
+        """ Layout indices for the trials of a run with numerosities ns: every n takes its layouts from
+        a permutation of the bank (from seed), so no layout repeats within the run unless it has more
+        than n_layouts trials with the same n. """
+
+        rng = np.random.default_rng(seed)
+        ns = np.asarray(ns)
+        layout_ixs = np.zeros(len(ns), dtype=int)
+
+        for n in np.unique(ns):
+            trials = np.flatnonzero(ns == n)
+            n_permutations = int(np.ceil(len(trials) / self.n_layouts))
+            permutations = np.concatenate([rng.permutation(self.n_layouts) for _ in np.arange(n_permutations)])
+            layout_ixs[trials] = permutations[:len(trials)]
+
+        return layout_ixs.tolist()
+
+    def get_ixs(self, n, n_draws=1, rng=None, ix=None):
+        """ Indices of n_draws different layouts with n dots; the first one is ix if given. The others
+        are picked by rng (a numpy Generator) if given, or else drawn without replacement over the session. """
+
+        if n not in self:
+            raise ValueError(f'Layout bank {self.fn} has no layouts with {n} dots')
+
+        ixs = [] if ix is None else [ix]
+
+        if rng is not None:
+            candidates = np.setdiff1d(np.arange(self.n_layouts), ixs)
+            return ixs + rng.choice(candidates, n_draws - len(ixs), replace=False).tolist()
+
+        with self._order_lock:
+            while len(ixs) < n_draws:
+                order = self._order.get(n)
+
+                if not order:
+                    if order is not None:
+                        logging.warning(f'All {self.n_layouts} layouts with {n} dots have been used, reshuffling')
+                    order = list(np.random.permutation(self.n_layouts))
+                    self._order[n] = order
+
+                ixs.append(int(order.pop()))
+
+        return ixs
+
+    def draw(self, n, rng=None, ix=None, n_draws=1):
+        """ n_draws different layouts with n dots (see get_ixs), as a list of (n x 2) arrays. """
+        return [np.array(self.layouts[self._index[n], ix_, :n], dtype=float)
+                for ix_ in self.get_ixs(n, n_draws, rng, ix)]
+
+def main(fn, settings, ranges=None, n_layouts=500, aperture_radius=None, dot_radius=None, seed=None):
+
+    settings_fn = op.join(op.dirname(__file__), 'settings', f'{settings}.yml')
+
+    with open(settings_fn, 'r') as f:
+        settings = yaml.safe_load(f)
+
+    if ranges is None:
+        ranges = list(settings['ranges'].keys())
+
+    if aperture_radius is None:
+        aperture_radius = settings['cloud'].get('aperture_radius')
+
+    if dot_radius is None:
+        dot_radius = settings['cloud'].get('dot_radius')
+
+    ns = np.concatenate([np.arange(settings['ranges'][r][0], settings['ranges'][r][1] + 1) for r in ranges])
+
+    t0 = time.perf_counter()
+    ns, layouts, features = create_layout_bank(ns, n_layouts, aperture_radius, dot_radius, seed)
+    save_layout_bank(fn, ns, layouts, aperture_radius, dot_radius, features)
+
+    print(f'Wrote {n_layouts} layouts for n={ns.min()}-{ns.max()} to {fn} ({time.perf_counter() - t0:.1f} s)')
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument('fn', type=str, help='Output file (.npz)')
+    argparser.add_argument('--settings', type=str, help='Settings label', default='default')
+    argparser.add_argument('--ranges', nargs='+', default=None, help='Ranges to include (default: all ranges in the settings)')
+    argparser.add_argument('--n_layouts', type=int, default=500, help='Number of layouts per numerosity')
+    argparser.add_argument('--aperture_radius', type=float, default=None)
+    argparser.add_argument('--dot_radius', type=float, default=None)
+    argparser.add_argument('--seed', type=int, default=None)
+    args = argparser.parse_args()
+
+    main(args.fn, args.settings, args.ranges, args.n_layouts, args.aperture_radius, args.dot_radius, args.seed)
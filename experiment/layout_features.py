@@ -0,0 +1,164 @@
+import argparse
+import numpy as np
+import pandas as pd
+
+feature_names = ['hull_area', 'mean_distance', 'density', 'mean_eccentricity']
+
+# Directions at which the convex hull is probed; a hull vertex is only missed if its
+# exterior angle is below 360 / _N_HULL_DIRECTIONS degrees (then it barely adds area)
+_N_HULL_DIRECTIONS = 360
+
+
+def sample_layouts(n, n_layouts, circle_radius=2.5, dot_radius=.1, min_ecc=0.2, rng=None, n_candidates=16,
+                   max_rounds=None):
+    """ Samples dot layouts like _sample_dot_positions (in utils.py), n_layouts at once.
+
+    Every round, each unfinished layout gets n_candidates candidate dots and keeps the first
+    one that does not overlap its dots so far. Returns the layouts that were completed
+    within max_rounds rounds, as an array of (layouts x n x 2). """
+
+    rng = np.random.default_rng(rng)
+
+    if max_rounds is None:
+        max_rounds = 100 * n
+
+    min_distance = (dot_radius * 2) * 1.1
+    min_ecc_frac = min_ecc / circle_radius
+    max_ecc = circle_radius - dot_radius
+
+    layouts = np.full((n_layouts, n, 2), np.nan)
+    n_dots = np.zeros(n_layouts, dtype=int)
+
+    for _ in np.arange(max_rounds):
+        active = np.flatnonzero(n_dots < n)
+
+        if len(active) == 0:
+            break
+
+        angles = rng.random((len(active), n_candidates)) * np.pi * 2
+        ecc = np.sqrt((rng.random((len(active), n_candidates)) + min_ecc_frac) / (1. + min_ecc_frac)) * max_ecc
+        candidates = np.stack((np.cos(angles), np.sin(angles)), 2) * ecc[..., np.newaxis]
+
+        # (layouts x candidates x dots) distances; dots that were not placed yet are NaN and never conflict
+        distances = np.sqrt(((layouts[active, np.newaxis] - candidates[:, :, np.newaxis])**2).sum(3))
+        free = ~(distances <= min_distance).any(2)
+
+        placed = free.any(1)
+        rows = active[placed]
+        layouts[rows, n_dots[rows]] = candidates[placed, free[placed].argmax(1)]
+        n_dots[rows] += 1
+
+    return layouts[n_dots == n]
+
+
+def get_features(layouts):
+    """ Non-numerical features of a batch of layouts ((layouts x dots x 2), rows of NaN for
+    missing dots): convex hull area, mean distance between dots, density (dots per unit of hull
+    area) and mean eccentricity. Returns a dictionary of arrays. """
+
+    layouts = np.asarray(layouts, dtype=float)
+    valid = ~np.isnan(layouts[..., 0])
+    n = valid.sum(1)
+    xys = np.where(valid[..., np.newaxis], layouts, 0.)
+
+    # The hull vertices in counter-clockwise order are the dots that lie furthest in every direction
+    angles = np.linspace(0, 2 * np.pi, _N_HULL_DIRECTIONS, endpoint=False)
+    projections = np.where(valid[..., np.newaxis], xys @ np.stack((np.cos(angles), np.sin(angles))), -np.inf)
+    hull = np.take_along_axis(xys, projections.argmax(1)[..., np.newaxis], 1)
+    next_hull = np.roll(hull, -1, axis=1)
+    hull_area = .5 * (hull[..., 0] * next_hull[..., 1] - hull[..., 1] * next_hull[..., 0]).sum(1)
+
+    distances = np.sqrt(((xys[:, :, np.newaxis] - xys[:, np.newaxis, :])**2).sum(3))
+    pairs = valid[:, :, np.newaxis] & valid[:, np.newaxis, :]
+    mean_distance = (distances * pairs).sum((1, 2)) / np.maximum(n * (n - 1), 1)
+
+    with np.errstate(divide='ignore'):
+        density = n / hull_area
+
+    return {'hull_area': hull_area,
+            'mean_distance': mean_distance,
+            'density': density,
+            'mean_eccentricity': np.sqrt((xys**2).sum(2)).sum(1) / n}
+
+
+def get_correlations(ns, features):
+    """ Pearson correlation of every feature with n (features: dictionary of arrays). """
+    return {name: np.corrcoef(ns, values)[0, 1] for name, values in features.items()}
+
+
+class LayoutIndex(object):
+    """ Features of a set of candidate layouts per numerosity (dictionary of (numerosities x
+    layouts) arrays), standardized over all candidates, to pick unused layouts close to
+    target feature values. """
+
+    def __init__(self, ns, features):
+        self.ns = np.asarray(ns)
+        self.names = list(features.keys())
+        values = np.stack([features[name] for name in self.names], 2)
+
+        self.mean = values.mean((0, 1))
+        self.sd = values.std((0, 1))
+        self.z = (values - self.mean) / self.sd
+
+        self._index = {n: i for i, n in enumerate(self.ns)}
+        self.used = np.zeros(values.shape[:2], dtype=bool)
+
+    def get_features(self, n, ix):
+        return dict(zip(self.names, self.z[self._index[n], ix] * self.sd + self.mean))
+
+    def select(self, n, targets):
+        """ Index of the unused layout with n dots nearest to the targets ({feature: z-score}); marks it as used. """
+
+        i = self._index[n]
+        columns = [self.names.index(name) for name in targets]
+        distances = ((self.z[i][:, columns] - np.array(list(targets.values())))**2).sum(1)
+
+        if self.used[i].all():
+            self.used[i] = False
+
+        ix = int(np.argmin(np.where(self.used[i], np.inf, distances)))
+        self.used[i, ix] = True
+
+        return ix
+
+    def decorrelate(self, ns, names, rng=None):
+        """ Layout indices for a run with numerosities ns whose features (names) do not depend on n.
+
+        Every trial targets the features of a random layout of the median numerosity of the run,
+        which keeps the targets jointly plausible (e.g., hull area and mean distance go together),
+        and gets the layout of its own numerosity that is nearest to them. """
+
+        rng = np.random.default_rng(rng)
+        columns = [self.names.index(name) for name in names]
+
+        reference = self.z[self._index[self.ns[np.abs(self.ns - np.median(ns)).argmin()]]][:, columns]
+        targets = reference[rng.integers(len(reference), size=len(ns))]
+
+        return [self.select(n, dict(zip(names, target))) for n, target in zip(ns, targets)]
+
+
+def report(fns):
+    """ Correlations of the layout features with n in every design table (runs). """
+
+    rows = []
+
+    for fn in fns:
+        design = pd.read_csv(fn, sep='\t')
+        features = {name: design[name].values for name in feature_names if name in design}
+
+        if len(features) == 0:
+            print(f'{fn} has no layout features (the session had no layout bank with features)')
+            continue
+
+        rows.append(dict(run=fn, **get_correlations(design['n'].values, features)))
+
+    return pd.DataFrame(rows).set_index('run') if rows else pd.DataFrame()
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument('designs', nargs='+', help='Design tables (<run>_design.tsv)')
+    args = argparser.parse_args()
+
+    print('Correlation of every layout feature with n:')
+    print(report(args.designs).to_string(float_format='%.3f'))
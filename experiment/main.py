@@ -2,68 +2,45 @@ import argparse
 from examples import ExampleSession
 from feedback import FeedbackSession
 from task import TaskSession
-from utils import get_output_dir_str, get_settings
-import os.path as op
+from utils import get_settings
 from score import ScoreSession
+from runner import Block, BlockSession
 
-def main(subject, session, start_run, stimulus_range, settings, n_runs=None,
-         run_examples=True, run_feedback=True):
 
-    run = start_run
+def get_blocks(session, start_run, stimulus_range, n_runs=4, run_examples=True, run_feedback=True):
 
-    if n_runs is None:
-        n_runs = 4
+    blocks = []
 
-    output_dir, output_str = get_output_dir_str(subject, session, 'examples', run=run)
+    if run_examples:
+        blocks.append(Block('examples', start_run, stimulus_range, ExampleSession.create_trials, {}))
 
-    settings_fn, use_eyetracker = get_settings(settings)
+    if run_feedback:
+        blocks.append(Block('feedback', start_run, stimulus_range, FeedbackSession.create_trials, {}))
 
+    for run in range(start_run, start_run+n_runs):
+        blocks.append(Block('estimation_task', run, stimulus_range, TaskSession.create_trials, {}))
 
-    sessions = []
+    return blocks
 
-    if run_examples:
-        example_session = ExampleSession(output_str=output_str,
-                                        subject=subject,
-                                        output_dir=output_dir,
-                                        settings_file=settings_fn,
-                                        run=run,
-                                        range=stimulus_range,
-                                        eyetracker_on=use_eyetracker) 
-        example_session.create_trials()
-        example_session.run()
 
+def main(subject, session, start_run, stimulus_range, settings, n_runs=None,
+         run_examples=True, run_feedback=True, second_range=None, calibrate_eyetracker=False):
 
-    if run_feedback:
-        output_dir, output_str = get_output_dir_str(subject, session, 'feedback', run=run)
-        feedback_session = FeedbackSession(output_str=output_str,
-                                        subject=subject,
-                                        output_dir=output_dir,
-                                        settings_file=settings_fn,
-                                        run=run,
-                                        range=stimulus_range,
-                                        eyetracker_on=use_eyetracker)
-
-        feedback_session.create_trials()
-        feedback_session.run()
-    
-    for run in range(start_run, start_run+n_runs):
-        output_dir, output_str = get_output_dir_str(subject, session, 'estimation_task', run=run)
-        task_session = TaskSession(output_str=output_str, subject=subject,
-                        output_dir=output_dir, settings_file=settings_fn, 
-                        run=run, range=stimulus_range, eyetracker_on=use_eyetracker)
+    if n_runs is None:
+        n_runs = 4
+
+    settings_fn, use_eyetracker = get_settings(settings)
 
-        task_session.create_trials()
-        task_session.run()
+    blocks = get_blocks(session, start_run, stimulus_range, n_runs, run_examples, run_feedback)
 
-    output_dir, output_str = get_output_dir_str(subject, session, 'score', run=0)
+    if second_range is not None:
+        blocks += get_blocks(session, start_run + n_runs, second_range, n_runs, run_examples, run_feedback)
 
-    score_session = ScoreSession(output_str=output_str,
-                            range='narrow',
-                            subject=subject, output_dir=output_dir, eyetracker_on=use_eyetracker,
-                            settings_file=settings_fn)
+    blocks.append(Block('score', 0, 'narrow', ScoreSession.create_trials, {'session': session}))
 
-    score_session.create_trials(session)
-    score_session.run()
+    block_session = BlockSession(blocks, subject, session, settings_file=settings_fn,
+                                 eyetracker_on=use_eyetracker, calibrate_eyetracker=calibrate_eyetracker)
+    block_session.run()
 
 
 if __name__ == "__main__":
@@ -73,9 +50,13 @@ if __name__ == "__main__":
     argparser.add_argument('start_run', type=int, help='Run')
     argparser.add_argument('range', choices=['narrow', 'wide'], help='Range (either narrow or wide)')
     argparser.add_argument('--settings', type=str, help='Settings label', default='default')
-    argparser.add_argument('--n_runs', type=int, default=4, help='n_runs_to_run') 
+    argparser.add_argument('--n_runs', type=int, default=4, help='n_runs_to_run')
     argparser.add_argument('--no_examples', action='store_false', help='Do not run examples block')
     argparser.add_argument('--no_feedback', action='store_false', help='Do not run feedback block')
+    argparser.add_argument('--second_range', choices=['narrow', 'wide'], default=None,
+                           help='Run examples, feedback and task blocks for a second range afterwards')
+    argparser.add_argument('--calibrate_eyetracker', action='store_true', dest='calibrate_eyetracker')
     args = argparser.parse_args()
     main(args.subject, args.session, args.start_run, args.range, args.settings, args.n_runs,
-         run_examples=args.no_examples, run_feedback=args.no_feedback)
\ No newline at end of file
+         run_examples=args.no_examples, run_feedback=args.no_feedback, second_range=args.second_range,
+         calibrate_eyetracker=args.calibrate_eyetracker)
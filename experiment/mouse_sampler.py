@@ -0,0 +1,164 @@
+import os
+import os.path as op
+import sys
+import threading
+import time
+import numpy as np
+
+trajectory_dtype = np.dtype([('trial_ix', 'i4'), ('trial_nr', 'i4'), ('time', 'f8'),
+                             ('x', 'f4'), ('y', 'f4'), ('pressed', '?')])
+
+
+def _get_cursor_reader(win, mouse):
+    """ Returns a function that reads (x, y, left button pressed) of the mouse, in window units,
+    and that is safe to call from another thread than the one drawing (None where there is none). """
+
+    if sys.platform == 'win32' and hasattr(getattr(win, 'winHandle', None), '_hwnd'):
+        import ctypes
+        import ctypes.wintypes
+
+        user32 = ctypes.windll.user32
+        hwnd = win.winHandle._hwnd
+        point = ctypes.wintypes.POINT()
+        half_size = np.array(win.size) / 2.
+
+        # The cursor and button state of the OS, independent of pyglet's event dispatching
+        def read():
+            user32.GetCursorPos(ctypes.byref(point))
+            user32.ScreenToClient(hwnd, ctypes.byref(point))
+            pos = mouse._pix2windowUnits(np.array([point.x - half_size[0], half_size[1] - point.y]))
+            return pos[0], pos[1], bool(user32.GetAsyncKeyState(0x01) & 0x8000)
+
+        return read
+
+    return None
+
+
+class MouseSampler(object):
+    """ Reads the mouse into a ring buffer of timestamped samples (times on the session clock).
+
+    On Windows, the OS cursor is read at a fixed rate on a background thread, for sub-frame
+    click onsets. Elsewhere, pyglet is not thread-safe and only updates the cursor position and
+    buttons when the drawing thread dispatches window events, so the mouse is read after every
+    win.flip() instead (one sample per frame, whatever the rate).
+
+    Trials query the onset of the last button press (get_press_onset), the session
+    keeps the samples of every trial and saves them per run (save). """
+
+    def __init__(self, win, mouse, clock, rate=500., capacity=2**16):
+        self.win = win
+        self.mouse = mouse
+        self.clock = clock
+        self.interval = 1. / rate
+        self.capacity = capacity
+
+        self.times = np.zeros(capacity)
+        self.positions = np.zeros((capacity, 2), dtype=np.float32)
+        self.pressed = np.zeros(capacity, dtype=bool)
+
+        # Total number of samples taken; the last capacity of them are in the buffer
+        self.n_samples = 0
+        self.last_press_onset = None
+        self._was_pressed = False
+
+        self._read = _get_cursor_reader(win, mouse)
+        self.threaded = self._read is not None
+        self._trajectories = []
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True) if self.threaded else None
+
+    def start(self):
+        if self.threaded:
+            self._thread.start()
+            return
+
+        flip = self.win.flip
+
+        def sampled_flip(*args, **kwargs):
+            result = flip(*args, **kwargs)
+            pos = self.mouse.getPos()
+            self._add_sample(self.clock.getTime(), pos[0], pos[1], bool(self.mouse.getPressed()[0]))
+            return result
+
+        self.win.flip = sampled_flip
+
+    def stop(self):
+        self._stop.set()
+        if self.threaded and self._thread.is_alive():
+            self._thread.join()
+
+    def _add_sample(self, t, x, y, pressed):
+        ix = self.n_samples % self.capacity
+        self.times[ix] = t
+        self.positions[ix] = x, y
+        self.pressed[ix] = pressed
+
+        if pressed and not self._was_pressed:
+            self.last_press_onset = t
+        self._was_pressed = pressed
+
+        # Only written here, after the sample, so readers never see a half-written sample
+        self.n_samples += 1
+
+    def _sample(self):
+        # The session clock can be reset while sampling (BlockSession resets it every block), so the
+        # thread uses a monotonic clock, and times are moved to the session clock when they are read
+        next_sample = time.perf_counter()
+
+        while not self._stop.is_set():
+            x, y, pressed = self._read()
+            self._add_sample(time.perf_counter(), x, y, pressed)
+
+            next_sample += self.interval
+            time.sleep(max(0., next_sample - time.perf_counter()))
+
+    def _to_session_time(self, times):
+        if not self.threaded:
+            return times
+        return times + (self.clock.getTime() - time.perf_counter())
+
+    def get_press_onset(self, since):
+        """ Onset of the last button press, if it came after since (else None). """
+        onset = self.last_press_onset
+
+        if onset is None:
+            return None
+
+        onset = self._to_session_time(onset)
+        return onset if onset >= since else None
+
+    def get_samples(self, start, end=None):
+        """ Samples start up to end (sample numbers, see n_samples) that are still in the buffer. """
+
+        if end is None:
+            end = self.n_samples
+
+        start = max(start, end - self.capacity)
+        ixs = np.arange(start, end) % self.capacity
+
+        return self._to_session_time(self.times[ixs]), self.positions[ixs], self.pressed[ixs]
+
+    def record_trial(self, trial_ix, trial_nr, start):
+        """ Keeps the samples from sample number start up to now as the trajectory of a trial. """
+
+        times, positions, pressed = self.get_samples(start)
+
+        trajectory = np.zeros(len(times), dtype=trajectory_dtype)
+        trajectory['trial_ix'] = trial_ix
+        trajectory['trial_nr'] = trial_nr
+        trajectory['time'] = times
+        trajectory['x'] = positions[:, 0]
+        trajectory['y'] = positions[:, 1]
+        trajectory['pressed'] = pressed
+
+        self._trajectories.append(trajectory)
+
+    def save(self, output_dir, output_str):
+        """ Writes the trajectories of all recorded trials to <output_str>_mouse.npy. """
+
+        if len(self._trajectories) == 0:
+            return
+
+        os.makedirs(output_dir, exist_ok=True)
+        np.save(op.join(output_dir, f'{output_str}_mouse.npy'), np.concatenate(self._trajectories))
+        self._trajectories = []
@@ -0,0 +1,258 @@
+import argparse
+import os
+import os.path as op
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import yaml
+
+log_fn_reg = re.compile(r'.*[/\\]sub-(?P<subject>.+)_ses-(?P<session>[0-9]+)_task-(?P<task>[a-zA-Z_]+)_run-(?P<run>[0-9]+)_events.tsv')
+
+tasks = ['feedback', 'estimation_task']
+
+# Column suffix (in get_subject_stats) of every task
+task_labels = {'feedback': 'feedback', 'estimation_task': 'estimation'}
+
+
+def _get_stats_from_sums(n_trials, n_no_responses, sum_error, sum_abs_error, sum_squared_error, sum_reward,
+                         no_response_penalty):
+    """ The statistics of get_error_stats from the sums over the trials with a response. """
+
+    stats = {}
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        stats['mean_error'] = np.divide(sum_error, n_trials)
+        stats['mean_abs_error'] = np.divide(sum_abs_error, n_trials)
+        stats['mean_squared_error'] = np.divide(sum_squared_error, n_trials)
+
+    stats['n_no_responses'] = n_no_responses
+    # no_response_penalty is a positive amount, subtracted for every trial without a response
+    stats['total_reward'] = sum_reward - n_no_responses * no_response_penalty
+    stats['total_n_trials'] = n_trials
+
+    return stats
+
+
+def get_error_stats(error, max_reward=.1, reward_slope=.025, no_response_penalty=0.1, groups=None):
+    """ Error and reward statistics of n - response (NaN: no response).
+
+    With integer group labels (0, 1, ...) for every error, returns arrays with the statistics of every group. """
+
+    error = np.ravel(np.asarray(error, dtype=float))
+    labels = np.zeros(len(error), dtype=int) if groups is None else np.ravel(groups)
+    n_groups = 1 if groups is None else labels.max() + 1
+
+    no_response = np.isnan(error)
+    responded_labels = labels[~no_response]
+    responded_error = error[~no_response]
+
+    stats = _get_stats_from_sums(np.bincount(responded_labels, minlength=n_groups),
+                                 np.bincount(labels[no_response], minlength=n_groups),
+                                 np.bincount(responded_labels, responded_error, minlength=n_groups),
+                                 np.bincount(responded_labels, np.abs(responded_error), minlength=n_groups),
+                                 np.bincount(responded_labels, responded_error**2, minlength=n_groups),
+                                 np.bincount(responded_labels, max_reward - responded_error**2 * reward_slope,
+                                             minlength=n_groups),
+                                 no_response_penalty)
+
+    if groups is None:
+        stats = {key: value[0] for key, value in stats.items()}
+
+    return stats
+
+
+class ScoreAccumulator(object):
+    """ Running error and reward statistics, updated one trial at a time.
+
+    Sums the same per-trial terms, in the same order, as get_error_stats does
+    over the feedback rows of the log, so get_stats() gives the same numbers. """
+
+    def __init__(self, max_reward=.1, reward_slope=.025, no_response_penalty=0.1):
+        self.max_reward = max_reward
+        self.reward_slope = reward_slope
+        self.no_response_penalty = no_response_penalty
+        self.reset()
+
+    def reset(self):
+        self.n_trials = 0
+        self.n_no_responses = 0
+        self.sum_error = 0.
+        self.sum_abs_error = 0.
+        self.sum_squared_error = 0.
+        self.sum_reward = 0.
+
+    def add(self, n, response=None):
+        """ Adds a trial; response None (or NaN) is a trial without response. """
+
+        if response is None or np.isnan(response):
+            self.n_no_responses += 1
+            return
+
+        error = float(n) - float(response)
+
+        self.n_trials += 1
+        self.sum_error += error
+        self.sum_abs_error += abs(error)
+        self.sum_squared_error += error**2
+        self.sum_reward += self.max_reward - error**2 * self.reward_slope
+
+    def get_stats(self):
+        return _get_stats_from_sums(self.n_trials, self.n_no_responses, self.sum_error, self.sum_abs_error,
+                                    self.sum_squared_error, self.sum_reward, self.no_response_penalty)
+
+
+def _empty_feedback_rows():
+    return pd.DataFrame({'subject': pd.Series(dtype=str), 'session': pd.Series(dtype=str),
+                         'task': pd.Series(dtype=str), 'run': pd.Series(dtype=int),
+                         'trial_nr': pd.Series(dtype=int), 'n': pd.Series(dtype=float),
+                         'response': pd.Series(dtype=float), 'path': pd.Series(dtype=str)})
+
+
+def read_feedback_rows(fn):
+    """ trial_nr, n and response of the feedback rows (one per trial) of an events.tsv. """
+
+    d = pd.read_csv(fn, sep='\t', usecols=lambda column: column in ('trial_nr', 'event_type', 'n', 'response'))
+    d = d[d['event_type'] == 'feedback']
+
+    response = d['response'].values.astype(float) if 'response' in d else np.full(len(d), np.nan)
+
+    return d['trial_nr'].values.astype(int), d['n'].values.astype(float), response
+
+
+def find_event_logs(log_dir, tasks=tasks):
+    """ Returns {filename: modification time} of all events.tsv files of the given tasks under log_dir. """
+
+    logs = {}
+
+    for root, _, fns in os.walk(log_dir):
+        for fn in fns:
+            if fn.endswith('_events.tsv'):
+                fn = op.join(root, fn)
+                match = log_fn_reg.match(fn)
+                if match and match.group('task') in tasks:
+                    logs[fn] = os.stat(fn).st_mtime_ns
+
+    return logs
+
+
+def read_event_logs(fns, n_workers=None):
+    """ The feedback rows of all files in one table, labelled with subject, session, task, run
+    and path (files are read in parallel if there are many). """
+
+    if len(fns) == 0:
+        return _empty_feedback_rows()
+
+    if len(fns) > 16 and n_workers != 1:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            columns = list(executor.map(read_feedback_rows, fns, chunksize=32))
+    else:
+        columns = [read_feedback_rows(fn) for fn in fns]
+
+    trial_nrs, ns, responses = (np.concatenate(column) for column in zip(*columns))
+    n_rows = [len(trial_nr) for trial_nr, _, _ in columns]
+    labels = pd.DataFrame([log_fn_reg.match(fn).groupdict() for fn in fns]).assign(path=fns)
+
+    feedback = labels.loc[labels.index.repeat(n_rows)].reset_index(drop=True)
+    feedback['run'] = feedback['run'].astype(int)
+    feedback['trial_nr'] = trial_nrs
+    feedback['n'] = ns
+    feedback['response'] = responses
+
+    return feedback[['subject', 'session', 'task', 'run', 'trial_nr', 'n', 'response', 'path']]
+
+
+class FeedbackCache(object):
+    """ The feedback rows of every events.tsv under a log directory, cached on disk
+    (one table with a row per trial) and keyed by path and modification time.
+    update() only reads the files that are new or changed since the last update. """
+
+    def __init__(self, fn):
+        self.fn = fn
+
+        if op.exists(fn):
+            cache = pd.read_pickle(fn)
+            self.mtimes = cache.attrs['mtimes']
+            self.feedback = cache
+        else:
+            self.mtimes = {}
+            self.feedback = _empty_feedback_rows()
+
+    def update(self, log_dir, n_workers=None):
+        """ Reads new and changed logs, drops removed ones. Returns the number of files read. """
+
+        logs = find_event_logs(log_dir)
+        changed = [fn for fn, mtime in logs.items() if self.mtimes.get(fn) != mtime]
+
+        keep = self.feedback['path'].isin(logs) & ~self.feedback['path'].isin(changed)
+        self.feedback = pd.concat([self.feedback[keep], read_event_logs(changed, n_workers)], ignore_index=True)
+        self.mtimes = logs
+
+        return len(changed)
+
+    def save(self):
+        os.makedirs(op.dirname(op.abspath(self.fn)), exist_ok=True)
+
+        for column in ('subject', 'session', 'task', 'path'):
+            self.feedback[column] = self.feedback[column].astype('category')
+
+        self.feedback.attrs['mtimes'] = self.mtimes
+        self.feedback.to_pickle(self.fn)
+
+
+def get_stats(feedback, max_reward=.1, reward_slope=.025, no_response_penalty=0.1):
+    """ Statistics of all subjects/sessions, with the columns of get_subject_stats and their total bonus. """
+
+    grouped = feedback.groupby(['subject', 'session', 'task'], observed=True)
+    error = feedback['n'] - feedback['response']
+
+    stats = pd.DataFrame(get_error_stats(error, max_reward, reward_slope, no_response_penalty, groups=grouped.ngroup()),
+                         index=grouped.size().index).unstack('task')
+
+    stats.columns = [f'total_n_{task_labels[task]}_trials' if key == 'total_n_trials' else f'{key}_{task_labels[task]}'
+                     for key, task in stats.columns]
+
+    reward_columns = [f'total_reward_{label}' for label in task_labels.values() if f'total_reward_{label}' in stats]
+    stats['bonus'] = stats[reward_columns].sum(axis=1)
+
+    return stats
+
+
+def main(log_dir, settings, cache_fn=None, n_workers=None, output=None):
+
+    settings_fn = op.join(op.dirname(__file__), 'settings', f'{settings}.yml')
+
+    with open(settings_fn, 'r') as f:
+        settings = yaml.safe_load(f)
+
+    if cache_fn is None:
+        cache_fn = op.join(log_dir, 'feedback_cache.pkl')
+
+    t0 = time.perf_counter()
+
+    cache = FeedbackCache(cache_fn)
+    n_read = cache.update(log_dir, n_workers)
+    cache.save()
+
+    stats = get_stats(cache.feedback, settings['score']['max_reward'], settings['score']['reward_slope'],
+                      settings['score']['no_response_penalty'])
+
+    print(f'{len(cache.mtimes)} logs ({n_read} read), {len(stats)} subject/sessions in {time.perf_counter() - t0:.2f} s')
+    print(stats[['total_n_feedback_trials', 'total_n_estimation_trials', 'n_no_responses_feedback',
+                 'n_no_responses_estimation', 'mean_abs_error_estimation', 'bonus']].to_string(float_format='%.2f'))
+
+    if output is not None:
+        stats.to_csv(output, sep='\t')
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument('--log_dir', type=str, default=op.join(op.dirname(__file__), 'logs'))
+    argparser.add_argument('--settings', type=str, help='Settings label (for the score parameters)', default='default')
+    argparser.add_argument('--cache', type=str, default=None, help='Cache file (default: <log_dir>/feedback_cache.pkl)')
+    argparser.add_argument('--n_workers', type=int, default=None)
+    argparser.add_argument('--output', type=str, default=None, help='Write the payout table (tsv) here')
+    args = argparser.parse_args()
+
+    main(args.log_dir, args.settings, args.cache, args.n_workers, args.output)
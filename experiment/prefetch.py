@@ -0,0 +1,66 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+
+class Prefetcher(object):
+    """ Prepares the CPU side of the stimulus of the next trial (layouts, images) on a worker
+    thread while the current trial runs; the trial then only has to create its GL objects.
+
+    prepare is called with the keyword arguments given to submit(); get() with the same
+    arguments returns the result, waiting for it if it is not ready yet. """
+
+    def __init__(self, prepare):
+        self.prepare = prepare
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='prefetch')
+        self._futures = {}
+
+        self.prep_times = []
+        self.waits = []
+        self.n_misses = 0
+
+    @staticmethod
+    def _get_key(kwargs):
+        return tuple(sorted((key, tuple(value) if isinstance(value, list) else value) for key, value in kwargs.items()))
+
+    def _prepare(self, kwargs):
+        t0 = time.perf_counter()
+        prepared = self.prepare(**kwargs)
+        return prepared, time.perf_counter() - t0
+
+    def submit(self, **kwargs):
+        key = self._get_key(kwargs)
+
+        if key not in self._futures:
+            self._futures[key] = self._executor.submit(self._prepare, kwargs)
+
+    def get(self, **kwargs):
+        """ (prepared, prep_time, wait): the result, how long preparing it took on the worker thread
+        and how long get() had to wait for it (s); None if it was not submitted. """
+
+        future = self._futures.pop(self._get_key(kwargs), None)
+
+        if future is None:
+            self.n_misses += 1
+            return None
+
+        t0 = time.perf_counter()
+        prepared, prep_time = future.result()
+        wait = time.perf_counter() - t0
+
+        self.prep_times.append(prep_time)
+        self.waits.append(wait)
+
+        return prepared, prep_time, wait
+
+    def get_summary(self):
+        if len(self.prep_times) == 0:
+            return f'Prefetch: no trials prefetched ({self.n_misses} prepared on the main thread)'
+
+        return (f'Prefetch: {len(self.prep_times)} trials prefetched ({self.n_misses} prepared on the main thread), '
+                f'prep time median {np.median(self.prep_times) * 1000:.1f} ms '
+                f'(max {np.max(self.prep_times) * 1000:.1f} ms), waited for it at most {np.max(self.waits) * 1000:.1f} ms')
+
+    def close(self):
+        self._futures = {}
+        self._executor.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,77 @@
+from collections import OrderedDict
+import numpy as np
+
+# Kept free of psychopy imports, so the rasterizer can be tested without a display.
+
+
+def get_texture_size(aperture_radius, pix_per_deg):
+    """ Side of the (square, power-of-two) texture that covers the aperture at pix_per_deg. """
+    return int(2 ** np.ceil(np.log2(2 * aperture_radius * pix_per_deg)))
+
+
+def rasterize_dots(xys, dot_radius, aperture_radius, pix_per_deg):
+    """ Rasterizes dots into an anti-aliased coverage image (values 0-1).
+
+    The image is centered on (0, 0) and has get_texture_size() pixels per side,
+    so it spans size / pix_per_deg degrees. Row 0 is the bottom of the image
+    (lowest y), which is how OpenGL lays out numpy textures. """
+
+    xys = np.asarray(xys, dtype=float)
+    size = get_texture_size(aperture_radius, pix_per_deg)
+    image = np.zeros((size, size), dtype=np.float32)
+
+    if len(xys) == 0:
+        return image
+
+    # Dot centers and radius in pixel units (pixel (i, j) has its center at (j + .5, i + .5))
+    centers = xys * pix_per_deg + size / 2.
+    radius = dot_radius * pix_per_deg
+
+    # Every dot only touches the pixels in a small patch around its center
+    half_width = int(np.ceil(radius + 1))
+    offsets = np.arange(-half_width, half_width + 1)
+    cols = np.floor(centers[:, 0]).astype(int)[:, np.newaxis, np.newaxis] + offsets[np.newaxis, np.newaxis, :]
+    rows = np.floor(centers[:, 1]).astype(int)[:, np.newaxis, np.newaxis] + offsets[np.newaxis, :, np.newaxis]
+
+    distances = np.sqrt((cols + .5 - centers[:, 0, np.newaxis, np.newaxis])**2 +
+                        (rows + .5 - centers[:, 1, np.newaxis, np.newaxis])**2)
+
+    # Coverage falls off linearly over one pixel around the edge of the dot
+    coverage = np.clip(radius - distances + .5, 0, 1)
+
+    rows, cols = np.broadcast_arrays(rows, cols)
+    inside = (rows >= 0) & (rows < size) & (cols >= 0) & (cols < size) & (coverage > 0)
+    np.maximum.at(image, (rows[inside], cols[inside]), coverage[inside].astype(np.float32))
+
+    return image
+
+
+class TextureCache(object):
+    """ Least-recently-used cache that holds at most max_size textures.
+
+    create(key) is called for keys that are not (or no longer) cached. """
+
+    def __init__(self, create, max_size=4):
+        self.create = create
+        self.max_size = max_size
+        self._textures = OrderedDict()
+
+    def __contains__(self, key):
+        return key in self._textures
+
+    def __len__(self):
+        return len(self._textures)
+
+    def get(self, key):
+        if key in self._textures:
+            self._textures.move_to_end(key)
+        else:
+            self._textures[key] = self.create(key)
+
+            while len(self._textures) > self.max_size:
+                self._textures.popitem(last=False)
+
+        return self._textures[key]
+
+    def discard(self, key):
+        self._textures.pop(key, None)
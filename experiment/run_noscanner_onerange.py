@@ -4,12 +4,13 @@ from examples import ExampleTrial
 from feedback import FeedbackTrial
 from score import ScoreTrial, get_subject_stats
 from task import TaskTrial
-from utils import get_output_dir_str, get_settings, OutroTrial, DummyWaiterTrial
+from utils import get_output_dir_str, get_settings, OutroTrial, DummyWaiterTrial, TrialSpec, LazyTrialList
 import os.path as op
 from score import ScoreSession
 import datetime
 import numpy as np
 from instruction import InstructionTrial
+from design import create_design, get_trial_parameters, feedback_columns
 
 
 class OneRangeSession(EstimationSession):
@@ -31,7 +32,7 @@ class OneRangeSession(EstimationSession):
         ns[0] = self.settings['range'][0]
         ns[1] = self.settings['range'][1]
 
-        self.trials += [ExampleTrial(self, i+1, n=n) for i, n in enumerate(ns)]
+        self.trials += [TrialSpec(ExampleTrial, i+1, dict(n=n)) for i, n in enumerate(ns)]
 
         ######## FEEDBACK ######
 
@@ -40,10 +41,11 @@ class OneRangeSession(EstimationSession):
                                                                                             range_high=self.settings['range'][1]))
                                                                                             
         self.trials += [instruction_trial1, instruction_trial2]
-        n_examples = self.settings['feedback'].get('n_examples')
-        ns = np.random.randint(self.settings['range'][0], self.settings['range'][1] + 1, n_examples)
+        feedback_design = self.assign_layouts(create_design(self.settings, 'feedback', self.settings['range']))
+        self.save_design(feedback_design, 'feedback_design')
 
-        self.trials += [FeedbackTrial(self, i+1, n=n) for i, n in enumerate(ns)]
+        self.trials += [TrialSpec(FeedbackTrial, trial_nr, parameters)
+                        for trial_nr, parameters in get_trial_parameters(feedback_design, feedback_columns)]
 
         if not self.settings.get('skip_outro', False):
             self.trials.append(OutroTrial(session=self))
@@ -62,26 +64,21 @@ class OneRangeSession(EstimationSession):
         # if not include_instructions:
         #     self.trials = self.trials[1:]
 
-        n_trials = self.settings['task'].get('n_trials')
-        range = self.settings['range']
-        ns = np.random.randint(range[0], range[1] + 1, n_trials)
-
-        no_isi_no_jitter = self.settings.get('no_isi_no_jitter', False)
-        if no_isi_no_jitter:
-            self.trials += [TaskTrial(self, i+1, jitter=0, n=n, stimulus_series=self.settings['cloud']['stimulus_series']) for i,n in enumerate(ns)]
-        else:
-            possible_isis = self.settings['durations'].get('isi')
-            isis = possible_isis * int(np.ceil(n_trials / len(possible_isis)))
-            isis = isis[:n_trials]
-            np.random.shuffle(isis)
+        design = self.assign_layouts(create_design(self.settings, 'estimation_task', self.settings['range']))
+        self.save_design(design)
 
-            self.trials += [TaskTrial(self, i+1, jitter=jitter, n=n, stimulus_series=self.settings['cloud']['stimulus_series']) for i, (n, jitter) in enumerate(zip(ns, isis))]
+        self.trials += [TrialSpec(TaskTrial, trial_nr, dict(parameters,
+                                                            stimulus_series=self.settings['cloud']['stimulus_series']))
+                        for trial_nr, parameters in get_trial_parameters(design)]
 
         if not self.settings.get('skip_outro', False):
             self.trials.append(OutroTrial(session=self))
 
         self.trials.append(ScoreTrial(self, 0, keys=['q',]))
 
+        # Task trials build their successor during their ITI (see session.build_next_trial)
+        self.trials = LazyTrialList(self, self.trials, lookahead=0)
+
 
 
 def main(subject, session, range, settings, run_examples=True, run_feedback=True):
@@ -0,0 +1,95 @@
+from collections import namedtuple
+from psychopy import core
+from session import EstimationSession
+from stimuli import render_state
+from utils import get_output_dir_str
+
+# One block of the experiment: create_trials is the create_trials method of the session
+# class that would otherwise run the block (e.g., TaskSession.create_trials)
+Block = namedtuple('Block', ['task', 'run', 'range', 'create_trials', 'kwargs'])
+
+
+class BlockSession(EstimationSession):
+    """ Runs a queue of blocks in a single window, with a single eyetracker connection.
+
+    Every block gets its own events log, named as if it was run as a separate
+    session (see get_output_dir_str). """
+
+    def __init__(self, blocks, subject, session, settings_file=None, eyetracker_on=False, calibrate_eyetracker=False):
+
+        self.blocks = blocks
+        self.session_label = session
+
+        output_dir, output_str = get_output_dir_str(subject, session, blocks[0].task, blocks[0].run)
+
+        super().__init__(output_str, blocks[0].range, subject=subject, output_dir=output_dir,
+                         settings_file=settings_file, run=blocks[0].run, eyetracker_on=eyetracker_on,
+                         calibrate_eyetracker=calibrate_eyetracker)
+
+        self.session_clock = core.MonotonicClock()
+
+    def _start_block_clock(self):
+        self.exp_start = self.session_clock.getTime()
+        self.clock.reset()
+        self.timer.reset()
+
+    def start_block(self, block):
+
+        self.output_dir, self.output_str = get_output_dir_str(self.settings['subject'], self.session_label,
+                                                              block.task, block.run)
+        self.settings['run'] = block.run
+        self.settings['range'] = self.settings['ranges'].get(block.range)
+        self._setup_response_slider()
+
+        # The posterior carries over to the next block (of the same participant)
+        if self.adaptive_design is not None:
+            self.adaptive_design.set_range(self.settings['range'])
+
+        self.global_log.close()
+        self.global_log = self.create_event_log()
+        self.run_score.reset()
+        render_state.reset()
+        self.layout_correlations = None
+        self.n_requeued = 0
+        self.scheduler.reset()
+        self.nr_frames = 0
+        self.first_trial = True
+
+        block.create_trials(self, **block.kwargs)
+
+        # Onsets of every block are relative to the first flip of the block
+        self.win.callOnFlip(self._start_block_clock)
+        self.win.flip()
+
+    def save_block_log(self):
+        """ Writes the events log of the current block, like Session.close() does for the last one. """
+        self.save_events()
+        self.save_frames()
+        self.save_mouse()
+        self.save_posterior()
+
+    def run(self):
+        """ Runs all blocks. """
+        if self.eyetracker_on and self.show_eyetracker_calibration:
+            self.calibrate_eyetracker()
+
+        self.start_experiment()
+
+        if self.eyetracker_on:
+            self.start_recording_eyetracker()
+
+        for ix, block in enumerate(self.blocks):
+            print(f'Starting block {block.task}, run {block.run} ({block.range})')
+            self.start_block(block)
+
+            for trial_ix, trial in enumerate(self.trials):
+                self.run_trial(trial_ix, trial)
+
+            # Schedule, render state and layouts are summarized per block
+            self.print_stats()
+
+            # The log of the last block is written by close()
+            if ix < len(self.blocks) - 1:
+                self.save_block_log()
+
+        self.close()
@@ -0,0 +1,126 @@
+import numpy as np
+
+
+class ScannerTimeline(object):
+    """ Least-squares fit of the scanner's volume times (t = offset + volume * tr) to its sync triggers.
+
+    Every trigger is assigned the volume nearest to its time on the current fit, so missed
+    triggers leave a gap instead of shifting the count and repeated triggers of one volume
+    are ignored. Without triggers, the timeline is the session clock at the nominal TR. """
+
+    def __init__(self, tr):
+        self.nominal_tr = tr
+        self.first_trigger = None
+        self.n_triggers = 0
+        self.volumes = set()
+
+        # Running sums over (volume, time since the first trigger)
+        self._sums = np.zeros(5)
+
+    @property
+    def tr(self):
+        if self.n_triggers < 2:
+            return self.nominal_tr
+
+        n, sum_v, sum_t, sum_vv, sum_vt = self._sums
+        return (n * sum_vt - sum_v * sum_t) / (n * sum_vv - sum_v**2)
+
+    @property
+    def offset(self):
+        """ Time of volume 0 (the first trigger) on the session clock. """
+        if self.n_triggers == 0:
+            return 0.0 if self.first_trigger is None else self.first_trigger
+
+        n, sum_v, sum_t, _, _ = self._sums
+        return self.first_trigger + (sum_t - self.tr * sum_v) / n
+
+    def add_trigger(self, t):
+        if self.first_trigger is None:
+            self.first_trigger = t
+
+        volume = int(np.round(self.volume(t)))
+
+        if volume in self.volumes:
+            return
+
+        self.volumes.add(volume)
+        self.n_triggers += 1
+        t_ = t - self.first_trigger
+        self._sums += (1., volume, t_, volume**2, volume * t_)
+
+    def volume(self, t):
+        """ (Fractional) volume at time t on the session clock. """
+        return (t - self.offset) / self.tr
+
+    def time(self, volume):
+        """ Time of a (fractional) volume on the session clock. """
+        return self.offset + volume * self.tr
+
+
+class TrialScheduler(object):
+    """ Plans the onsets of fixed-duration trials on the scanner timeline.
+
+    The first scheduled trial fixes the volume at which the schedule starts; every
+    next trial is planned total_duration (nominal seconds, i.e. volumes * nominal TR)
+    after the previous one, and its predecessor's ITI is set to end at that onset on
+    the current fit of the timeline. Scanner triggers are read from the events log
+    (the 'pulse' rows that Trial.get_events() writes). """
+
+    def __init__(self, tr, trigger_event_type='pulse'):
+        # Without a trigger_event_type, the schedule runs on the session clock
+        self.timeline = ScannerTimeline(tr)
+        self.trigger_event_type = trigger_event_type
+        self.start_volume = None
+        self.elapsed = 0.0
+        self.schedule_errors = []
+        self._n_rows_read = 0
+
+    def reset(self):
+        self.__init__(self.timeline.nominal_tr, self.trigger_event_type)
+
+    def update(self, global_log):
+        """ Adds the triggers that were logged since the last update. """
+
+        if self.trigger_event_type is None:
+            return
+
+        n_rows = global_log.shape[0]
+
+        for ix in range(self._n_rows_read, n_rows):
+            if global_log.loc[ix, 'event_type'] == self.trigger_event_type:
+                self.timeline.add_trigger(global_log.loc[ix, 'onset'])
+
+        self._n_rows_read = n_rows
+
+    def get_onset(self, nominal_time):
+        """ Session clock time of nominal_time seconds after the start of the schedule. """
+        return self.timeline.time(self.start_volume + nominal_time / self.timeline.nominal_tr)
+
+    def start_trial(self, trial, onset):
+        """ Registers the onset of a scheduled trial; returns its planned onset. """
+
+        self.update(trial.session.global_log)
+
+        if self.start_volume is None:
+            self.start_volume = self.timeline.volume(onset)
+
+        trial.scheduled_start = self.elapsed
+        self.elapsed += trial.total_duration
+
+        planned_onset = self.get_onset(trial.scheduled_start)
+        self.schedule_errors.append(onset - planned_onset)
+
+        return planned_onset
+
+    def get_iti(self, trial, iti_onset, frame_duration=0.0):
+        """ ITI (s) that ends trial, of which the ITI starts at iti_onset, at the planned onset of the next trial,
+        and the correction (s) relative to running open-loop on the phase durations.
+
+        The next trial starts on the first flip after the ITI, so the ITI ends a frame early. """
+
+        self.update(trial.session.global_log)
+
+        planned_end = self.get_onset(trial.scheduled_start + trial.total_duration)
+        open_loop_end = trial.start_trial + trial.total_duration
+
+        return max(planned_end - iti_onset - frame_duration, 0.0), planned_end - open_loop_end
@@ -1,65 +1,21 @@
-import glob
 import os.path as op
 import argparse
 import pandas as pd
-import re
 from session import EstimationSession
 from instruction import InstructionTrial
 from utils import get_output_dir_str, get_settings
+from payouts import find_event_logs, read_event_logs, get_stats
 from exptools2.core import PylinkEyetrackerSession, Trial
 
 
 def get_subject_stats(subject, session, log_dir, max_reward=.1, reward_slope=.025, no_response_penalty=0.1):
-    feedback_log_files = glob.glob(op.join(log_dir, f'sub-{subject}', f'ses-{session}', '*task-feedback_run-*_events.tsv'))
-    estimation_log_files = glob.glob(op.join(log_dir, f'sub-{subject}', f'ses-{session}', '*task-estimation_task_run-*_events.tsv'))
-    print(op.join(log_dir, f'sub-{subject}', f'ses-{session}', '*task-feedback_run-*_events.tsv'))
-
-    reg = re.compile('.*/sub-(?P<subject>.+)_ses-(?P<session>[0-9]+)_task-(?P<task>[a-zA-Z_]+)_run-(?P<run>[0-9]+)_events.tsv')
-
-    stats = {}
-
-    feedback_df = []
-    for fn in feedback_log_files:
-        run = reg.match(fn).group('run')
-        d = pd.read_csv(fn, sep='\t')
-        d['run'] = run
-        feedback_df.append(d)
-
-    feedback_df = pd.concat(feedback_df).set_index(['run', 'trial_nr', 'event_type']).xs('feedback', level='event_type').astype({'n':float, 'response':float})
-    feedback_error = feedback_df['n'] - feedback_df['response']
-
-    stats['mean_error_feedback'] = feedback_error.mean()
-    stats['mean_abs_error_feedback'] = feedback_error.abs().mean()
-    stats['mean_squared_error_feedback'] = feedback_error.pow(2).mean()
-    stats['n_no_responses_feedback'] = feedback_error.isnull().sum()
-    stats['total_reward_feedback'] = stats['n_no_responses_feedback'] *  no_response_penalty
-    feedback_error = feedback_error[~feedback_error.isnull()]
-    stats['total_reward_feedback'] += (max_reward - feedback_error.pow(2) * reward_slope).sum()
-    stats['total_n_feedback_trials'] = len(feedback_error)
-
-    estimation_df = []
-
-    for fn in estimation_log_files:
-        run = reg.match(fn).group('run')
-        d = pd.read_csv(fn, sep='\t')
-        d['run'] = run
-        estimation_df.append(d)
-
-    estimation_df = pd.concat(estimation_df).set_index(['run', 'trial_nr', 'event_type']).xs('feedback', level='event_type').astype({'n':float, 'response':float})
-    estimation_error = estimation_df['n'] - estimation_df['response']
-
-    stats['mean_error_estimation'] = estimation_error.mean()
-    stats['mean_abs_error_estimation'] = estimation_error.abs().mean()
-    stats['mean_squared_error_estimation'] = estimation_error.pow(2).mean()
-    stats['n_no_responses_estimation'] = estimation_error.isnull().sum()
-    stats['total_reward_estimation'] = stats['n_no_responses_estimation'] *  no_response_penalty
-    estimation_error = estimation_error[~estimation_error.isnull()]
-    stats['total_reward_estimation'] += (max_reward - estimation_error.pow(2) * reward_slope).sum()
-    stats['total_n_estimation_trials'] = len(estimation_error)
-
-    return stats
-
-    
+    logs = find_event_logs(op.join(log_dir, f'sub-{subject}', f'ses-{session}'))
+    stats = get_stats(read_event_logs(sorted(logs), n_workers=1), max_reward, reward_slope, no_response_penalty)
+
+    # Column by column, so that counts stay integers
+    return {key: stats[key].iloc[0] for key in stats.columns if key != 'bonus'}
+
+
 class ScoreSession(EstimationSession):
 
     def create_trials(self, session):
@@ -95,7 +51,6 @@ class ScoreTrial(InstructionTrial):
         if phase_durations is None:
             phase_durations = [0.5, 5*60]
 
-        self.log = session.global_log
         self.show_reward = show_reward
 
         super().__init__(session=session, trial_nr=trial_nr, phase_durations=phase_durations, txt='',
@@ -112,27 +67,24 @@ class ScoreTrial(InstructionTrial):
         super().draw()
 
     def get_score(self):
-        self.log = self.session.global_log.copy()
-        print(self.log)
-        self.log = self.log.set_index(['trial_nr', 'event_type']).xs('feedback', level='event_type').astype({'n':float, 'response':float})
+        stats = self.session.run_score.get_stats()
 
-        self.error = self.log['n'] - self.log['response']
-        self.mean_error = self.error.mean()
-        self.mean_abs_error = self.error.abs().mean()
+        self.mean_error = stats['mean_error']
+        self.mean_abs_error = stats['mean_abs_error']
 
-        self.text.text = f'Thank you! On average your estimates were off by {self.mean_abs_error:.2f}.\n\n'
+        txt = f'Thank you! On average your estimates were off by {self.mean_abs_error:.2f}.\n\n'
 
-        max_reward = self.session.settings['score']['max_reward']
-        reward_slope = self.session.settings['score']['reward_slope']
-        self.total_reward = (max_reward - self.error.pow(2) * reward_slope).sum()
+        self.total_reward = stats['total_reward']
         self.parameters['total_reward'] = self.total_reward
 
         if self.show_reward:
-            self.text.text += f'You earned a bonus of ${self.total_reward:.2f}.'
+            txt += f'You earned a bonus of ${self.total_reward:.2f}.'
             print('•••••••••••', self.total_reward)
-            print(self.text.text)
+            print(txt)
             print('•••••••••••')
 
+        self.set_text(txt)
+
         
 
 def main(subject, session, settings):
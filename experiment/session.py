@@ -1,22 +1,79 @@
 from exptools2.core import PylinkEyetrackerSession, Trial
 from psychopy import event
-from stimuli import ResponseSlider, FixationLines
+from stimuli import ResponseSlider, FixationLines, TextStimPool, render_state
+from layout_bank import LayoutBank
+from layout_features import get_correlations, feature_names
+from rasterize import TextureCache
+from utils import _create_stimulus_array, _prepare_stimulus_array, LazyTrialList, get_pix_per_deg
+from prefetch import Prefetcher
+from instrumentation import FrameRecorder
+from event_log import EventLog, input_event_types
+from payouts import ScoreAccumulator
+from mouse_sampler import MouseSampler
+from gaze import GazeMonitor, EyeLinkSource, LockedTracker, ReplaySource, synthetic_gaze
+from utils import TrialSpec
+from scheduler import TrialScheduler
+from design import write_design
+from adaptive import AdaptiveDesign
+from compiled_settings import CompiledSettings, load_settings
 import yaml
+import logging
+import os
 import os.path as op
+import numpy as np
+import pandas as pd
 
 class EstimationSession(PylinkEyetrackerSession):
     def __init__(self, output_str, range, subject=None, output_dir=None, settings_file=None, run=None, eyetracker_on=False, calibrate_eyetracker=False):
 
         super().__init__(output_str, output_dir=output_dir, settings_file=settings_file, eyetracker_on=eyetracker_on)
 
+        # Parsed and validated once per settings file (see compiled_settings.py)
+        if settings_file is None:
+            self.compiled_settings = CompiledSettings(self.settings)
+        else:
+            self.compiled_settings = load_settings(settings_file)
+
+        self.global_log = self.create_event_log()
+
+        # Render-state changes are counted per run (and per block, see BlockSession.start_block)
+        render_state.reset()
+
+        # Error and reward of the trials of this run (see ScoreTrial)
+        self.run_score = ScoreAccumulator(max_reward=self.settings['score']['max_reward'],
+                                          reward_slope=self.settings['score']['reward_slope'],
+                                          no_response_penalty=self.settings['score']['no_response_penalty'])
+
+        self.frame_recorder = None
+        if self.settings.get('instrumentation', {}).get('record_frames', False):
+            self.frame_recorder = FrameRecorder(self)
+            self.frame_recorder.instrument_window(self.win)
+
         # self.win.color = (-.25, -.25, -.25)
 
         self.show_eyetracker_calibration = calibrate_eyetracker
 
         self.mouse = event.Mouse(visible=False)
 
+        self.mouse_sampler = None
+        mouse_sampling_rate = self.settings['interface'].get('mouse_sampling_rate', 0)
+        if mouse_sampling_rate:
+            self.mouse_sampler = MouseSampler(self.win, self.mouse, self.clock, rate=mouse_sampling_rate)
+            self.mouse_sampler.start()
+
+        self._setup_gaze_monitor()
+
+        # Onsets of fixed-duration trials, on the timeline of the scanner triggers if lock_to_triggers
+        self.scheduler = TrialScheduler(self.settings['mri'].get('TR', 2.0),
+                                        'pulse' if self.settings['mri'].get('lock_to_triggers', False) else None)
+
         self.instructions = yaml.safe_load(open(op.join(op.dirname(__file__), 'instruction_texts.yml'), 'r'))
 
+        self.text_pool = TextStimPool(self.win)
+
+        if self.frame_recorder is not None:
+            self.text_pool.on_create = self.frame_recorder.instrument
+
         self.settings['subject'] = subject
         self.settings['run'] = run
         self.settings['range'] = self.settings['ranges'].get(range)
@@ -27,26 +84,364 @@ class EstimationSession(PylinkEyetrackerSession):
                                             color=(1, -1, -1),
                                             **self.settings['fixation_lines'])
 
+        if self.frame_recorder is not None:
+            self.frame_recorder.instrument(self.fixation_lines)
+
         self._setup_response_slider()
+        self._setup_layout_bank()
+        self._setup_adaptive_design()
+        self._setup_prefetch()
+
+        self.texture_cache = TextureCache(lambda stimulus_array: stimulus_array.create_texture(),
+                                          max_size=self.settings['cloud'].get('texture_cache_size', 4))
+
+    def create_event_log(self):
+        """ Replaces the global_log DataFrame; rows are also streamed to <output_str>_events.jsonl. """
+        return EventLog(fn=op.join(self.output_dir, self.output_str + '_events.jsonl'))
+
+    def _setup_gaze_monitor(self):
+
+        self.gaze_monitor = None
+        self.n_requeued = 0
+        gaze_settings = self.settings.get('gaze', {})
+
+        if not gaze_settings.get('monitor', False):
+            return
+
+        source = gaze_settings.get('source', 'eyelink')
+
+        if source == 'eyelink':
+            if not self.eyetracker_on:
+                logging.warning('Gaze monitor needs a connected eyetracker (or a replay source); not monitoring')
+                return
+            # The monitor thread reads the link while the session sends messages over it
+            self.tracker = LockedTracker(self.tracker)
+            source = EyeLinkSource(self.tracker, self.win, self.clock)
+        elif source == 'synthetic':
+            source = ReplaySource(*synthetic_gaze(60 * 60, seed=gaze_settings.get('seed')), self.clock)
+        else:
+            source = ReplaySource.from_file(op.join(op.dirname(__file__), source), self.clock)
+
+        self.gaze_monitor = GazeMonitor(source, rate=gaze_settings.get('sampling_rate', 500.),
+                                        max_distance=gaze_settings.get('max_distance', 1.5))
+        self.gaze_monitor.start()
+
+    def monitor_fixation(self, trial, phase, stimulus_phases):
+        """ Called at the start of every phase of trial: sets the trial parameters fixation_break
+        and gaze_distance (deg) once the stimulus phases are over. """
+
+        if self.gaze_monitor is None:
+            return
+
+        if phase == stimulus_phases[0]:
+            trial.gaze_start_sample = self.gaze_monitor.start_interval()
+        elif phase == stimulus_phases[-1] + 1:
+            trial.parameters['fixation_break'], trial.parameters['gaze_distance'] = \
+                self.gaze_monitor.check_fixation(trial.gaze_start_sample)
+
+    def requeue_trial(self, trial):
+        """ Repeats trial (a trial that was built from a TrialSpec) after the last TrialSpec of the run. """
+
+        spec_ixs = self.trials.spec_ixs()
+        trial_nr = max(list.__getitem__(self.trials, ix).trial_nr for ix in spec_ixs) + 1
+
+        # The repeat shows the numerosity and layout the trial was built with, also when its spec had no n
+        # (adaptive designs) or layout seed, so it is a second observation of that n
+        parameters = dict(trial.spec.parameters, parameters={'repeat_of': trial.trial_nr},
+                          **{key: trial.parameters[key] for key in ['n', 'layout_seed', 'layout_ix']
+                             if trial.parameters.get(key) is not None})
+        self.trials.insert(spec_ixs[-1] + 1, TrialSpec(trial.spec.trial_class, trial_nr, parameters))
+        self.n_requeued += 1
+
+        logging.warning(f'Fixation break in trial {trial.trial_nr}: repeated as trial {trial_nr}')
+
+    def save_design(self, design, suffix='design'):
+        """ Writes the design table of the run next to the events log, as <output_str>_<suffix>.tsv. """
+        write_design(design, self.output_dir, self.output_str, suffix)
 
     def _setup_response_slider(self):
 
         position_slider = (0, 0)
-        max_range = self.settings['slider'].get('max_range')[1] - self.settings['slider'].get('max_range')[0]
-        prop_max_rating = (self.settings['range'][1] - self.settings['range'][0]) / max_range
-        length_line = prop_max_rating * self.settings['slider'].get('max_length')
+        slider = self.compiled_settings.slider
 
         self.response_slider = ResponseSlider(self.win,
                                          position_slider,
-                                         length_line,
-                                         self.settings['slider'].get('height'),
-                                         self.settings['slider'].get('color'),
-                                         self.settings['slider'].get('borderColor'),
+                                         self.compiled_settings.get_slider_length(self.settings['range']),
+                                         slider.height,
+                                         slider.color,
+                                         slider.borderColor,
                                          self.settings['range'],
                                          marker_position=None,
-                                         markerColor=self.settings['slider'].get('markerColor'),
-                                         borderWidth=self.settings['slider'].get('borderWidth'),
-                                         text_height=self.settings['slider'].get('text_height'))
+                                         markerColor=slider.markerColor,
+                                         borderWidth=slider.borderWidth,
+                                         text_height=slider.text_height)
+
+        if self.frame_recorder is not None:
+            self.frame_recorder.instrument(self.response_slider)
+
+    def _setup_adaptive_design(self):
+
+        self.adaptive_design = None
+        adaptive_settings = self.settings.get('adaptive', {})
+
+        if adaptive_settings.get('enabled', False):
+            self.adaptive_design = AdaptiveDesign(self.settings['range'],
+                                                  **{key: adaptive_settings[key] for key in ('bias', 'noise', 'regression')
+                                                     if key in adaptive_settings})
+
+    def select_n(self, trial):
+        """ Numerosity of an adaptive trial that was created with n=None (only the first one of a run;
+        update_adaptive_design chooses the others). """
+        n = self.adaptive_design.select()
+        trial.parameters['selection_time'] = self.adaptive_design.selection_time
+        return n
+
+    def update_adaptive_design(self, trial):
+        """ Adds the response of a trial to the posterior and logs the posterior as trial parameters. """
+
+        if self.adaptive_design is None:
+            return
+
+        self.adaptive_design.update(trial.parameters['n'], trial.parameters.get('response'))
+        trial.parameters.update(self.adaptive_design.get_summary())
+
+        # The posterior has every response now, so the n of the next trial can be chosen already,
+        # and its stimulus prepared before that trial starts (see prefetch_next and build_next_trial)
+        spec = self.trials.get_next_spec() if isinstance(self.trials, LazyTrialList) else None
+
+        if (spec is not None) and ('n' in spec.parameters) and (spec.parameters['n'] is None):
+            spec.parameters['n'] = self.adaptive_design.select()
+            spec.parameters['parameters'] = dict(spec.parameters.get('parameters') or {},
+                                                 selection_time=self.adaptive_design.selection_time)
+
+    def add_to_score(self, trial):
+        """ Adds the response of a trial (or its absence, which costs the no-response penalty) to the score of the
+        run that ScoreTrial shows. """
+        self.run_score.add(trial.parameters['n'], trial.parameters.get('response'))
+
+    def _setup_layout_bank(self):
+
+        self.layout_bank = None
+        # Correlations of the layout features with n in the current run (see assign_layouts and print_stats)
+        self.layout_correlations = None
+        layout_bank_fn = self.settings['cloud'].get('layout_bank')
+
+        if layout_bank_fn is not None:
+            self.layout_bank = LayoutBank(op.join(op.dirname(__file__), layout_bank_fn))
+            self.layout_bank.check_geometry(self.settings['cloud'].get('aperture_radius'),
+                                            self.settings['cloud'].get('dot_radius'))
+
+    def assign_layouts(self, design):
+        """ Picks the layout bank layout of every trial of a design (column layout_ix), with no layout
+        used twice for the same n in a run, and adds its features (see layout_features.py), decorrelated
+        from n for the features in cloud: decorrelate. The layouts follow from the layout seeds of the design.
+
+        Without a bank, with adaptive numerosities or with layouts assigned already (a design that is
+        run again), the design is returned as is. """
+
+        if (self.layout_bank is None) or ('layout_ix' in design) or design['n'].isna().any() or \
+                not all(n in self.layout_bank for n in design['n']):
+            return design
+
+        index = self.layout_bank.index
+        decorrelate = self.settings['cloud'].get('decorrelate', [])
+        ns = design['n'].values.astype(int)
+
+        if decorrelate and (index is None):
+            logging.warning(f'Layout bank {self.layout_bank.fn} has no layout features, '
+                            f'so {decorrelate} cannot be decorrelated from n')
+
+        if decorrelate and (index is not None):
+            layout_ixs = index.decorrelate(ns, decorrelate, rng=design['layout_seed'].values)
+        else:
+            layout_ixs = self.layout_bank.get_run_layouts(ns, seed=design['layout_seed'].values)
+
+        design = design.assign(layout_ix=layout_ixs)
+
+        if index is None:
+            return design
+
+        features = pd.DataFrame([index.get_features(n, ix) for n, ix in zip(ns, layout_ixs)], index=design.index)
+        design = pd.concat((design, features), axis=1)
+
+        self.layout_correlations = get_correlations(ns, {name: features[name].values for name in feature_names})
+
+        return design
+
+    def _setup_prefetch(self):
+
+        self.prefetcher = None
+
+        # Images are rasterized (texture renderer) with the resolution of the monitor
+        if self.settings['cloud'].get('renderer', 'element_array') == 'texture':
+            self.pix_per_deg = get_pix_per_deg(self.win)
+        else:
+            self.pix_per_deg = None
+
+        if self.settings['cloud'].get('prefetch', False):
+            self.prefetcher = Prefetcher(self.prepare_stimulus_array)
+
+    def build_next_trial(self):
+        """ Builds the next trial during the ITI of the current one, so its stimulus is not created
+        (and, with prefetching, not waited for) between trials. """
+        if isinstance(self.trials, LazyTrialList):
+            self.trials.build_next()
+
+    def prefetch_next(self):
+        """ Starts preparing the stimulus of the next trial on the prefetch thread. """
+
+        if (self.prefetcher is None) or not isinstance(self.trials, LazyTrialList):
+            return
+
+        spec = self.trials.get_next_spec()
+
+        if (spec is None) or not hasattr(spec.trial_class, 'get_stimulus_parameters'):
+            return
+
+        stimulus_parameters = spec.trial_class.get_stimulus_parameters(self, **spec.parameters)
+
+        if stimulus_parameters['n'] is not None:
+            self.prefetcher.submit(**stimulus_parameters)
+
+    def prepare_stimulus_array(self, n, layout_seed=None, layout_ix=None, transforms=None):
+        """ The CPU side of a stimulus (no GL calls, so it can run on the prefetch thread). """
+        rng = None if layout_seed is None else np.random.default_rng(layout_seed)
+        return _prepare_stimulus_array(n,
+                                       self.settings['cloud'].get('aperture_radius'),
+                                       self.settings['cloud'].get('dot_radius'),
+                                       layout_bank=self.layout_bank,
+                                       renderer=self.settings['cloud'].get('renderer', 'element_array'),
+                                       pix_per_deg=self.pix_per_deg,
+                                       rng=rng,
+                                       layout_ix=layout_ix,
+                                       transforms=transforms)
+
+    def create_stimulus_array(self, n, layout_seed=None, layout_ix=None, transforms=None, parameters=None):
+        """ The stimulus of a trial, from the prefetch thread if it was prefetched. The prep time
+        on that thread and how long the main thread waited for it are added to parameters. """
+
+        prefetched = None
+
+        if self.prefetcher is not None:
+            prefetched = self.prefetcher.get(n=n, layout_seed=layout_seed, layout_ix=layout_ix, transforms=transforms)
+
+        if prefetched is None:
+            prepared = self.prepare_stimulus_array(n, layout_seed, layout_ix, transforms)
+        else:
+            prepared, prep_time, prep_wait = prefetched
+
+            if parameters is not None:
+                parameters['prep_time'] = prep_time
+                parameters['prep_wait'] = prep_wait
+
+        stimulus_array = _create_stimulus_array(self.win, prepared,
+                                                self.settings['cloud'].get('aperture_radius'),
+                                                self.settings['cloud'].get('dot_radius'),
+                                                renderer=self.settings['cloud'].get('renderer', 'element_array'),
+                                                texture_cache=self.texture_cache)
+
+        if self.frame_recorder is not None:
+            self.frame_recorder.instrument(stimulus_array)
+
+        return stimulus_array
+
+    def run_trial(self, ix, trial):
+        self.current_trial_ix = ix
+        self.current_trial = trial
+
+        if self.mouse_sampler is not None:
+            start_sample = self.mouse_sampler.n_samples
+
+        trial.run()
+
+        if self.mouse_sampler is not None:
+            self.mouse_sampler.record_trial(ix, trial.trial_nr, start_sample)
+
+        gaze_settings = self.settings.get('gaze', {})
+        if (trial.parameters.get('fixation_break') and gaze_settings.get('requeue', False)
+                and hasattr(trial, 'spec') and self.n_requeued < gaze_settings.get('max_requeues', 5)):
+            self.requeue_trial(trial)
+
+        if self.frame_recorder is not None:
+            self.frame_recorder.record_trial(ix, trial)
+
+    def save_frames(self):
+        if (self.frame_recorder is not None) and (self.frame_recorder.n_frames > 0):
+            actual_framerate = getattr(self, 'actual_framerate', None)
+            frame_duration = 1. / actual_framerate if actual_framerate else None
+            self.frame_recorder.save(self.output_dir, self.output_str, frame_duration)
+            self.frame_recorder.reset()
+
+    def save_mouse(self):
+        if self.mouse_sampler is not None:
+            self.mouse_sampler.save(self.output_dir, self.output_str)
+
+    def save_posterior(self):
+        if self.adaptive_design is not None:
+            self.adaptive_design.save(self.output_dir, self.output_str)
+
+    def save_events(self):
+        """ Writes global_log to <output_str>_events.tsv in the same layout as Session.close(). """
+
+        global_log = self.global_log.to_frame() if isinstance(self.global_log, EventLog) else self.global_log
+        global_log = global_log.set_index('trial_nr')
+        global_log['onset_abs'] = global_log['onset'] + self.exp_start
+
+        # Only non-responses have a duration
+        nonresp_idx = ~global_log.event_type.isin(input_event_types)
+        last_phase_onset = global_log.loc[nonresp_idx, 'onset'].iloc[-1]
+        dur_last_phase = self.clock.getTime() - last_phase_onset
+        durations = np.append(global_log.loc[nonresp_idx, 'onset'].diff().values[1:], dur_last_phase)
+        global_log.loc[nonresp_idx, 'duration'] = durations
+
+        nr_frames = np.append(global_log.loc[nonresp_idx, 'nr_frames'].values[1:], self.nr_frames)
+        global_log.loc[nonresp_idx, 'nr_frames'] = nr_frames.astype(int)
+
+        os.makedirs(self.output_dir, exist_ok=True)
+        global_log.to_csv(op.join(self.output_dir, self.output_str + '_events.tsv'), sep='\t', index=True)
+
+        return global_log
+
+    def close(self):
+        self.save_frames()
+
+        if self.mouse_sampler is not None:
+            self.mouse_sampler.stop()
+            self.save_mouse()
+
+        if self.gaze_monitor is not None:
+            self.gaze_monitor.stop()
+
+        if self.prefetcher is not None:
+            self.prefetcher.close()
+
+        self.save_posterior()
+
+        if isinstance(self.global_log, EventLog):
+            self.global_log.close()
+            # Session.close() works on the DataFrame
+            self.global_log = self.global_log.to_frame()
+
+        super().close()
+
+    def print_stats(self):
+        """ Prints the summaries of the run (stimulus pool, render state, layouts, schedule, prefetching). """
+
+        print(f'TextStim pool: {len(self.text_pool)} stimuli, {self.text_pool.hits} hits, {self.text_pool.misses} misses')
+        print(f'Render state: {render_state.total} changes in {render_state.n_frames_with_changes} '
+              f'out of {render_state.n_frames} task frames')
+
+        if self.layout_correlations is not None:
+            print('Layout feature correlations with n: ' +
+                  ', '.join(f'{name} {correlation:.2f}' for name, correlation in self.layout_correlations.items()))
+
+        if len(self.scheduler.schedule_errors) > 0:
+            timeline = self.scheduler.timeline
+            print(f'Schedule: {timeline.n_triggers} triggers, TR {timeline.tr:.5f} s, trial onsets off by at most '
+                  f'{np.abs(self.scheduler.schedule_errors).max() * 1000:.1f} ms')
+
+        if self.prefetcher is not None:
+            print(self.prefetcher.get_summary())
 
     def run(self):
         """ Runs experiment. """
@@ -57,7 +452,9 @@ class EstimationSession(PylinkEyetrackerSession):
 
         if self.eyetracker_on:
             self.start_recording_eyetracker()
-        for trial in self.trials:
-            trial.run()
+        for ix, trial in enumerate(self.trials):
+            self.run_trial(ix, trial)
+
+        self.print_stats()
 
         self.close()
\ No newline at end of file
@@ -0,0 +1,295 @@
+import abc
+import argparse
+import os
+import os.path as op
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import yaml
+from headless import HeadlessBackend, run_headless_session
+from task import TaskSession, TaskTrial
+from compiled_settings import get_series, get_phase_names
+from feedback import FeedbackSession
+from payouts import get_error_stats
+from score import get_subject_stats
+from design import create_designs, _get_seed_sequence
+
+
+class Observer(abc.ABC):
+    """ Synthetic participant: turns displayed numerosities into slider responses and response times. """
+
+    @abc.abstractmethod
+    def sample(self, ns, range, rng):
+        """ Returns responses and response times (s) with the shape of ns. """
+
+
+class LogNormalObserver(Observer):
+    """ Log-normal estimation noise with regression towards the (log) centre of the range,
+    and log-normally distributed response times. """
+
+    def __init__(self, noise=0.15, regression=0.2, bias=0.0, rt_median=1.2, rt_sigma=0.35):
+        self.noise = noise
+        self.regression = regression
+        self.bias = bias
+        self.rt_median = rt_median
+        self.rt_sigma = rt_sigma
+
+    def sample(self, ns, range, rng):
+        ns = np.asarray(ns, dtype=float)
+
+        log_center = np.mean(np.log(range))
+        log_estimates = (1 - self.regression) * np.log(ns) + self.regression * log_center + self.bias + \
+            rng.normal(0, self.noise, ns.shape)
+
+        responses = np.clip(np.round(np.exp(log_estimates)), range[0], range[1])
+        rts = self.rt_median * np.exp(rng.normal(0, self.rt_sigma, ns.shape))
+
+        return responses, rts
+
+
+class PerfectObserver(Observer):
+    """ Always responds n, after a fixed response time. """
+
+    def __init__(self, rt=1.0):
+        self.rt = rt
+
+    def sample(self, ns, range, rng):
+        ns = np.asarray(ns, dtype=float)
+        return ns.copy(), np.full(ns.shape, self.rt)
+
+
+observers = {'lognormal': LogNormalObserver,
+             'perfect': PerfectObserver}
+
+
+class ObserverResponder(object):
+    """ Headless responder (see headless.py): in the response phase of a trial, moves the
+    mouse to the response of the observer and clicks after its response time. Outside
+    of response phases, clicks every click_interval seconds (e.g., to get through instructions). """
+
+    def __init__(self, observer, seed=None, click_interval=1.0):
+        self.observer = observer
+        self.rng = np.random.default_rng(seed)
+        self.click_interval = click_interval
+        self._trial = None
+        self._onset = self._response = self._rt = None
+
+    def update(self, mouse, session, t):
+        trial = getattr(session, 'current_trial', None)
+
+        if trial is None or 'n' not in trial.parameters:
+            mouse.pressed = (t % self.click_interval) < session.win.frame_duration
+            return
+
+        if trial.phase >= len(trial.phase_names) or trial.phase_names[trial.phase] != 'response':
+            mouse.pressed = False
+            return
+
+        if trial is not self._trial:
+            self._trial = trial
+            self._onset = t
+            response, rt = self.observer.sample([trial.parameters['n']], session.settings['range'], self.rng)
+            self._response, self._rt = response[0], rt[0]
+
+        # TaskTrial scales the mouse position, FeedbackTrial does not
+        multiplier = session.settings['interface']['mouse_multiplier'] if isinstance(trial, TaskTrial) else 1.
+
+        slider = session.response_slider
+        low, high = slider.range
+        marker_x = slider.bar.pos[0] - slider.bar.width / 2. + (self._response - low + .5) / (high - low) * slider.bar.width
+
+        mouse.x = marker_x * multiplier
+        mouse.pressed = (t - self._onset) >= self._rt
+
+
+def simulate_runs(settings, observer, n_runs, task='estimation_task', range='narrow', seed=None):
+    """ Simulates n_runs runs at once (without running the trials) and returns the
+    feedback rows of their events logs (onsets relative to the first trial of the run). """
+
+    design_seed, response_seed = _get_seed_sequence(seed).spawn(2)
+    rng = np.random.default_rng(response_seed)
+    range_ = settings['ranges'][range]
+    durations = settings['durations']
+
+    designs = create_designs(settings, n_runs, task, range, design_seed)
+    ns, jitters, start_marker_positions = designs['n'], designs['jitter'], designs['start_marker_position']
+    n_trials = ns.shape[1]
+
+    if task == 'feedback':
+        response_window = 120.  # Response phase of FeedbackTrial
+        feedback_phase = 4
+    else:
+        response_window = durations['response_screen']
+        n_stimulus_phases = len(get_series(settings['cloud'])[0]) if settings['cloud']['stimulus_series'] else 1
+        feedback_phase = get_phase_names(n_stimulus_phases).index('feedback')
+
+    responses, rts = observer.sample(ns, range_, rng)
+    too_late = rts > response_window
+    responses[too_late] = np.nan
+    rts[too_late] = np.nan
+
+    stimulus_duration = durations['first_fixation'] + durations['second_fixation'] + durations['array_duration']
+    response_duration = np.where(too_late, response_window, rts)
+
+    if task == 'feedback':
+        trial_durations = stimulus_duration + response_duration + durations['feedback']
+    else:
+        # Trials with a jitter last as long as if no response had been given (see TaskTrial)
+        trial_durations = np.where(jitters > 0,
+                                   stimulus_duration + jitters + response_window + durations['feedback'],
+                                   stimulus_duration + response_duration + durations['feedback'])
+
+    trial_onsets = np.cumsum(trial_durations, axis=1) - trial_durations
+    feedback_onsets = trial_onsets + stimulus_duration + jitters + response_duration
+
+    feedback = pd.DataFrame({'run': np.repeat(np.arange(1, n_runs + 1), n_trials),
+                             'trial_nr': np.tile(np.arange(1, n_trials + 1), n_runs),
+                             'onset': feedback_onsets.ravel(),
+                             'event_type': 'feedback',
+                             'phase': feedback_phase,
+                             'n': ns.ravel(),
+                             'jitter': jitters.ravel(),
+                             'start_marker_position': start_marker_positions.ravel(),
+                             'response': responses.ravel(),
+                             'response_time': rts.ravel()})
+
+    return feedback
+
+
+def _simulate_chunk(args):
+    settings, observer, n_runs, task, range, seed = args
+    return simulate_runs(settings, observer, n_runs, task, range, seed)
+
+
+def simulate_runs_parallel(settings, observer, n_runs, task='estimation_task', range='narrow', seed=None,
+                           n_workers=None, chunk_size=1000):
+    """ simulate_runs, split in chunks over a pool of processes. """
+
+    n_chunks = int(np.ceil(n_runs / chunk_size))
+    seeds = np.random.SeedSequence(seed).spawn(n_chunks)
+    chunks = [(settings, observer, min(chunk_size, n_runs - ix * chunk_size), task, range, seeds[ix])
+              for ix in np.arange(n_chunks)]
+
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        results = list(executor.map(_simulate_chunk, chunks))
+
+    for ix, feedback in enumerate(results):
+        feedback['run'] += ix * chunk_size
+
+    return pd.concat(results, ignore_index=True)
+
+
+def write_events(feedback, log_dir, subject, session, task, start_run=1):
+    """ Writes every run of simulated feedback rows as an events.tsv, where get_subject_stats finds them. """
+
+    output_dir = op.join(log_dir, f'sub-{subject}', f'ses-{session}')
+    os.makedirs(output_dir, exist_ok=True)
+
+    for run, d in feedback.groupby('run'):
+        fn = op.join(output_dir, f'sub-{subject}_ses-{session}_task-{task}_run-{start_run + run - 1}_events.tsv')
+        d.drop('run', axis=1).to_csv(fn, sep='\t', index=False)
+
+
+def simulate_headless(observer, settings='default', task='estimation_task', n_runs=1, range='narrow',
+                      subject='sim', session=1, log_dir=None, seed=None):
+    """ Runs the actual trials of n_runs runs on the headless backend, with the observer responding. """
+
+    session_cls = {'estimation_task': TaskSession, 'feedback': FeedbackSession}[task]
+
+    if log_dir is None:
+        log_dir = op.join(op.dirname(__file__), 'logs')
+
+    output_dir = op.join(log_dir, f'sub-{subject}', f'ses-{session}')
+
+    np.random.seed(seed)
+
+    for run in np.arange(1, n_runs + 1):
+        backend = HeadlessBackend(responder=ObserverResponder(observer, seed=None if seed is None else seed + run))
+        run_headless_session(session_cls, task=task, settings=settings, subject=subject, session=session,
+                             run=run, range=range, output_dir=output_dir, backend=backend,
+                             create_trials_kwargs=dict(seed=None if seed is None else seed + run))
+
+
+def get_simulated_stats(feedback, n_runs_per_subject, score_settings):
+    """ Error, too-late and reward statistics per simulated subject (consecutive runs). """
+
+    subject_ixs = (feedback['run'].values - 1) // n_runs_per_subject
+
+    return pd.DataFrame(get_error_stats(feedback['n'] - feedback['response'], score_settings['max_reward'],
+                                        score_settings['reward_slope'], score_settings['no_response_penalty'],
+                                        groups=subject_ixs))
+
+
+def main(settings, range, n_subjects, observer, n_workers=None, seed=None, response_screen=None, log_dir=None):
+
+    settings_fn = op.join(op.dirname(__file__), 'settings', f'{settings}.yml')
+
+    with open(settings_fn, 'r') as f:
+        settings = yaml.safe_load(f)
+
+    if response_screen is not None:
+        settings['durations']['response_screen'] = response_screen
+
+    n_runs = settings['main']['n_runs']
+
+    stats = {}
+
+    for task_ix, (task, n_runs_per_subject) in enumerate((('feedback', 1), ('estimation_task', n_runs))):
+        t0 = time.perf_counter()
+        feedback = simulate_runs_parallel(settings, observer, n_subjects * n_runs_per_subject, task, range,
+                                          seed=None if seed is None else [seed, task_ix], n_workers=n_workers)
+        duration = time.perf_counter() - t0
+
+        stats[task] = get_simulated_stats(feedback, n_runs_per_subject, settings['score'])
+
+        print(f'{task}: {n_subjects * n_runs_per_subject} runs in {duration:.2f} s '
+              f'({n_subjects * n_runs_per_subject / duration:.0f} runs/s)')
+        print(f'  "Too late!" rate: {feedback["response"].isnull().mean():.3f}')
+        print(f'  Mean abs. error: {stats[task]["mean_abs_error"].mean():.2f}')
+        print(f'  Reward per subject: {stats[task]["total_reward"].mean():.2f} '
+              f'(sd {stats[task]["total_reward"].std():.2f})')
+
+        if log_dir is not None:
+            subject_ixs = (feedback['run'] - 1) // n_runs_per_subject
+            for subject_ix, d in feedback.groupby(subject_ixs):
+                d = d.assign(run=d['run'] - subject_ix * n_runs_per_subject)
+                write_events(d, log_dir, f'sim{subject_ix:04d}', 1, task)
+
+    bonus = stats['feedback']['total_reward'] + stats['estimation_task']['total_reward']
+    print(f'Bonus per subject: mean {bonus.mean():.2f}, 5-95%: {bonus.quantile(.05):.2f} - {bonus.quantile(.95):.2f}')
+
+    if log_dir is not None:
+        print(get_subject_stats('sim0000', 1, log_dir, settings['score']['max_reward'], settings['score']['reward_slope'],
+                                settings['score']['no_response_penalty']))
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument('--settings', type=str, help='Settings label', default='default')
+    argparser.add_argument('--range', choices=['narrow', 'wide'], default='narrow')
+    argparser.add_argument('--n_subjects', type=int, default=1000)
+    argparser.add_argument('--observer', choices=list(observers), default='lognormal')
+    argparser.add_argument('--noise', type=float, default=0.15)
+    argparser.add_argument('--regression', type=float, default=0.2)
+    argparser.add_argument('--rt_median', type=float, default=1.2)
+    argparser.add_argument('--rt_sigma', type=float, default=0.35)
+    argparser.add_argument('--response_screen', type=float, default=None, help='Overrides durations: response_screen')
+    argparser.add_argument('--n_workers', type=int, default=None)
+    argparser.add_argument('--seed', type=int, default=None)
+    argparser.add_argument('--log_dir', type=str, default=None, help='Write the simulated events.tsv files here')
+    argparser.add_argument('--headless', type=int, default=0,
+                           help='Additionally run this many estimation runs of the actual trials on the headless backend')
+    args = argparser.parse_args()
+
+    if args.observer == 'lognormal':
+        observer = LogNormalObserver(args.noise, args.regression, rt_median=args.rt_median, rt_sigma=args.rt_sigma)
+    else:
+        observer = PerfectObserver(args.rt_median)
+
+    main(args.settings, args.range, args.n_subjects, observer, args.n_workers, args.seed, args.response_screen,
+         args.log_dir)
+
+    if args.headless:
+        simulate_headless(observer, args.settings, n_runs=args.headless, range=args.range,
+                          log_dir=args.log_dir, seed=args.seed)
@@ -1,7 +1,46 @@
-from psychopy.visual import Circle, Line, Rect, TextStim
+from psychopy.visual import Circle, Line, Rect, TextStim, ShapeStim
 import numpy as np
 
 
+class RenderStateCounter(object):
+    """ Counts the render-state changes (colors, positions) that stimuli actually apply. """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """ Starts counting from scratch (sessions reset it when they start, block sessions at every block). """
+        self.n_changes = 0
+        self.n_frames = 0
+        self.n_frames_with_changes = 0
+        self.total = 0
+
+    def count(self, n=1):
+        self.n_changes += n
+        self.total += n
+
+    def new_frame(self):
+        """ Closes the current frame and returns the number of changes it made. """
+        n_changes = self.n_changes
+
+        self.n_frames += 1
+        if n_changes > 0:
+            self.n_frames_with_changes += 1
+
+        self.n_changes = 0
+        return n_changes
+
+
+render_state = RenderStateCounter()
+
+
+def _same_value(value1, value2):
+    if isinstance(value1, str) or isinstance(value2, str) or (value1 is None) or (value2 is None):
+        return value1 == value2
+
+    return np.array_equal(np.asarray(value1, dtype=float), np.asarray(value2, dtype=float))
+
+
 class FixationLines(object):
 
     def __init__(self, win, circle_radius, color, center_fixation_size=0.25, plus_sign=False, draw_circle=True, draw_outer_cross=True, *args, **kwargs):
@@ -42,6 +81,9 @@ class FixationLines(object):
             self.aperture = Circle(win, radius=circle_radius * 1.1, fillColor=(0, 0, 0), lineColor=color, lineWidth=kwargs['lineWidth'])
             self.elements.append(self.aperture)
 
+        self._fixation_cross_color = color
+        self._elements_color = color
+
 
     def draw(self, draw_fixation_cross=True):
 
@@ -55,12 +97,17 @@ class FixationLines(object):
 
     def setColor(self, color, fixation_cross_only=False):
 
-        for line in self.fixation_cross:
-            line.lineColor = color
+        if not _same_value(color, self._fixation_cross_color):
+            for line in self.fixation_cross:
+                line.lineColor = color
+            self._fixation_cross_color = color
+            render_state.count(len(self.fixation_cross))
 
-        if not fixation_cross_only:
+        if (not fixation_cross_only) and (not _same_value(color, self._elements_color)):
             for line in self.elements:
                 line.lineColor = color
+            self._elements_color = color
+            render_state.count(len(self.elements))
 
 class RoundedRectangle(object):
 
@@ -166,6 +213,69 @@ class RoundedRectangleWithBorder(object):
         self.inner_rectangle.color = value
 
 
+def _rounded_rectangle_vertices(width, height, corner_radius, n_corner_edges=16):
+    """ Outline of a rounded rectangle centered on (0, 0), as a single vertex list. """
+
+    x, y = width/2 - max(corner_radius, 0), height/2 - max(corner_radius, 0)
+    corners = [(x, y), (-x, y), (-x, -y), (x, -y)]
+
+    if corner_radius <= 0:
+        return np.array(corners)
+
+    angles = np.linspace(0, np.pi / 2, n_corner_edges + 1)
+    vertices = [np.stack((cx + corner_radius * np.cos(angles + ix * np.pi / 2),
+                          cy + corner_radius * np.sin(angles + ix * np.pi / 2)), 1)
+                for ix, (cx, cy) in enumerate(corners)]
+
+    return np.concatenate(vertices)
+
+
+class RoundedRectangleMarker(object):
+    """ Rounded rectangle with a border, drawn as two ShapeStims whose outlines are built once.
+
+    Moving the marker only changes the position of the two shapes. """
+
+    def __init__(self, win, pos, width, height, corner_radius, inner_color, outer_color, borderWidth=0.05):
+        self.outer_rectangle = ShapeStim(win, vertices=_rounded_rectangle_vertices(width, height, corner_radius),
+                                         fillColor=outer_color, lineColor=None, lineWidth=0, pos=pos)
+        self.inner_rectangle = ShapeStim(win, vertices=_rounded_rectangle_vertices(width-borderWidth*2, height-borderWidth*2,
+                                                                                   corner_radius - borderWidth),
+                                         fillColor=inner_color, lineColor=None, lineWidth=0, pos=pos)
+        self._pos = pos
+        self._inner_color = inner_color
+
+    def draw(self):
+        self.outer_rectangle.draw()
+        self.inner_rectangle.draw()
+
+    @property
+    def pos(self):
+        return self._pos
+
+    @pos.setter
+    def pos(self, value):
+        if _same_value(value, self._pos):
+            return
+
+        self._pos = value
+        self.outer_rectangle.pos = value
+        self.inner_rectangle.pos = value
+        render_state.count(2)
+
+    @property
+    def inner_color(self):
+        return self._inner_color
+
+    @inner_color.setter
+    def inner_color(self, value):
+        if _same_value(value, self._inner_color):
+            return
+
+        self.inner_rectangle.fillColor = value
+        self._inner_color = value
+        render_state.count()
+
+
 class ResponseSlider(object):
 
     def __init__(self, win, position, length, height, color, borderColor, range, marker_position, show_marker=False,
@@ -195,8 +305,9 @@ class ResponseSlider(object):
         self.bar = Rect(win, width=length, height=height, pos=position,
                         lineColor=borderColor, color=color)
 
-        self.marker = RoundedRectangleWithBorder(win, position, height*.5, height*1.5, height*.15, markerColor, borderColor, borderWidth=0.1)
+        self.marker = RoundedRectangleMarker(win, position, height*.5, height*1.5, height*.15, markerColor, borderColor, borderWidth=0.1)
 
+        self.marker_position = None
         self.setMarkerPosition(marker_position)
 
 
@@ -207,13 +318,18 @@ class ResponseSlider(object):
             self.marker.draw()
 
             if self.show_number:
-                self.number.text = str(self.marker_position)
                 self.number.draw()
 
     def setMarkerPosition(self, number):
         number = np.clip(number, self.range[0], self.range[1])
         position = self.bar.pos[0] + (number - self.range[0]) / (self.range[1] - self.range[0]) * self.bar.width - self.bar.width/2., self.bar.pos[1]
         self.marker.pos = position
+
+        # Only lay out the number again when it changes
+        if self.show_number and (number != self.marker_position):
+            self.number.text = str(number)
+            render_state.count()
+
         self.marker_position = number
 
     def mouseToMarkerPosition(self, mouse_pos):
@@ -233,4 +349,47 @@ class ResponseSlider(object):
         self.setMarkerPosition(self.marker_position)
 
         if self.show_number:
-            self.number.pos = (self._pos[0], self._pos[1] - self.bar.height*1.75)
\ No newline at end of file
+            self.number.pos = (self._pos[0], self._pos[1] - self.bar.height*1.75)
+
+
+def _hashable(value):
+    if value is None or isinstance(value, str):
+        return value
+
+    return tuple(np.ravel(value).tolist())
+
+
+class TextStimPool(object):
+    """ Hands out shared TextStims, so every distinct text is only laid out once.
+
+    Stimuli are shared between all callers with the same arguments, so they
+    should not be modified (e.g., by setting .text) after they are handed out. """
+
+    def __init__(self, win):
+        self.win = win
+        self.hits = 0
+        self.misses = 0
+        self._stimuli = {}
+
+        # Called with every newly created stimulus (e.g., to instrument it)
+        self.on_create = None
+
+    def get(self, text, height=None, color=(1, 1, 1), wrapWidth=None, pos=(0, 0), **kwargs):
+        text = str(text)
+        key = (text, height, _hashable(color), wrapWidth, _hashable(pos),
+               tuple(sorted((k, _hashable(v)) for k, v in kwargs.items())))
+
+        if key in self._stimuli:
+            self.hits += 1
+        else:
+            self.misses += 1
+            self._stimuli[key] = TextStim(self.win, text=text, height=height, color=color, wrapWidth=wrapWidth,
+                                          pos=pos, **kwargs)
+
+            if self.on_create is not None:
+                self.on_create(self._stimuli[key])
+
+        return self._stimuli[key]
+
+    def __len__(self):
+        return len(self._stimuli)
@@ -3,69 +3,109 @@ import os.path as op
 from psychopy.visual import Slider
 from psychopy import event
 from exptools2.core import PylinkEyetrackerSession, Trial
-from utils import _create_stimulus_array, get_output_dir_str, DummyWaiterTrial, OutroTrial, get_settings
+from utils import get_output_dir_str, DummyWaiterTrial, OutroTrial, get_settings, TrialSpec, LazyTrialList
 from instruction import InstructionTrial
-from stimuli import FixationLines, ResponseSlider
+from stimuli import FixationLines, ResponseSlider, render_state
 import numpy as np
 import logging
-from psychopy.visual import Line, Rect, TextStim
+from psychopy.visual import Line, Rect
 from session import EstimationSession
 from score import ScoreTrial
+from design import create_design, check_design, read_design, get_trial_parameters
 import datetime
 
 class TaskTrial(Trial):
     def __init__(self, session, trial_nr, phase_durations=None,
                 jitter=1,
                 stimulus_series=False,
-                n=15, **kwargs):
-
-        if phase_durations is None:
-            if stimulus_series:
-                phase_durations = [session.settings['durations']['first_fixation'],
-                                session.settings['durations']['second_fixation'],
-                                session.settings['durations']['array_duration'] / 4.,
-                                session.settings['durations']['array_duration'] / 4.,
-                                session.settings['durations']['array_duration'] / 4.,
-                                session.settings['durations']['array_duration'] / 4.,
-                                jitter,
-                                session.settings['durations']['response_screen'],
-                                session.settings['durations']['feedback'],
-                                0.0]
-            else:
-                phase_durations = [session.settings['durations']['first_fixation'],
-                                session.settings['durations']['second_fixation'],
-                                session.settings['durations']['array_duration'],
-                                jitter,
-                                session.settings['durations']['response_screen'],
-                                session.settings['durations']['feedback'],
-                                0.0]
-
-        self.total_duration = np.sum(phase_durations)
+                n=15, start_marker_position=None, layout_seed=None, layout_ix=None, **kwargs):
 
+        # With a stimulus series, the stimulus is split into sub-phases, each with a layout of its own
         self.stimulus_series = stimulus_series
+        self.series_transforms = session.compiled_settings.series_transforms if stimulus_series else None
+
+        trial_type = 'task_series' if stimulus_series else 'task'
 
-        self.stimulus_phase = [2]
-        self.response_phase = 4
-        self.feedback_phase = 5
+        if phase_durations is None:
+            phase_durations = session.compiled_settings.get_phase_durations(trial_type, jitter)
 
-        if self.stimulus_series:
-            self.stimulus_phase += [3, 4, 5]
-            self.response_phase = 7
-            self.feedback_phase = 8
+        self.total_duration = np.sum(phase_durations)
 
-        phase_names = ['fixation1', 'fixation2', 'stimulus', 'jitter', 'response', 'feedback', 'iti']
+        phase_names = session.compiled_settings.phase_names[trial_type]
 
-        if self.stimulus_series:
-            phase_names = ['fixation1', 'fixation2', 'stimulus1', 'stimulus2', 'stimulus3', 'stimulus4', 'jitter', 'response', 'feedback', 'iti']
+        self.stimulus_phase = [i for i, name in enumerate(phase_names) if name.startswith('stimulus')]
+        self.response_phase = phase_names.index('response')
+        self.feedback_phase = phase_names.index('feedback')
+        self.iti_phase = phase_names.index('iti')
+        self.jitter_phase = phase_names.index('jitter')
 
         super().__init__(session, trial_nr, phase_durations, phase_names=phase_names, **kwargs)
 
+        # The first adaptive trial of a run (see session.update_adaptive_design)
+        if n is None:
+            n = self.session.select_n(self)
+
         self.parameters['n'] = n
         self.parameters['jitter'] = jitter
-        self.stimulus_array = _create_stimulus_array(self.session.win, n, self.session.settings['cloud'].get('aperture_radius'), self.session.settings['cloud'].get('dot_radius'),)
+        self.parameters['layout_seed'] = layout_seed
+        self.parameters['layout_ix'] = layout_ix
+        self.stimulus_array = self.session.create_stimulus_array(n, layout_seed, layout_ix, self.series_transforms,
+                                                                 parameters=self.parameters)
+
+        self.too_late_stimulus = self.session.text_pool.get('Too late!', pos=(0, 0), color=(1, -1, -1), height=0.5)
+
+        if start_marker_position is None:
+            start_marker_position = np.random.randint(self.session.settings['range'][0], self.session.settings['range'][1] + 1)
+
+        self.parameters['start_marker_position'] = start_marker_position
+
+    @staticmethod
+    def get_stimulus_parameters(session, n=None, layout_seed=None, layout_ix=None, stimulus_series=False, **kwargs):
+        """ Arguments of session.create_stimulus_array for a trial with these parameters (to prefetch its stimulus). """
+        return dict(n=n, layout_seed=layout_seed, layout_ix=layout_ix,
+                    transforms=session.compiled_settings.series_transforms if stimulus_series else None)
+
+    def log_phase_info(self, phase=None):
+        phase = self.phase if phase is None else phase
+
+        # Before logging, so the row of the phase after the stimulus has the fixation parameters
+        self.session.monitor_fixation(self, phase, self.stimulus_phase)
+
+        # The next trial's stimulus is prepared in the background during the jitter and response phases
+        if phase in (self.jitter_phase, self.response_phase):
+            self.session.prefetch_next()
 
-        self.too_late_stimulus = TextStim(self.session.win, text='Too late!', pos=(0, 0), color=(1, -1, -1), height=0.5)
-        self.parameters['start_marker_position'] = np.random.randint(self.session.settings['range'][0], self.session.settings['range'][1] + 1)
+        # Here we assume that if there is a jitter then it must mean that we have a fixed total duration,
+        # so the ITI (after a response) ends the trial at its onset on the scanner timeline
+        if self.parameters['jitter'] > 0.:
+            self.schedule(phase)
+
+        if phase == self.feedback_phase:
+            self.session.update_adaptive_design(self)
+            self.session.add_to_score(self)
+            # With an adaptive design, the n of the next trial is only known now
+            self.session.prefetch_next()
+
+        super().log_phase_info(phase=phase)
+
+        # After logging, so the ITI onset is not delayed by the build
+        if phase == self.iti_phase:
+            self.session.build_next_trial()
+
+    def schedule(self, phase):
+        scheduler = self.session.scheduler
+
+        if phase == 0:
+            self.parameters['planned_onset'] = scheduler.start_trial(self, self.session.clock.getTime())
+        elif phase == self.feedback_phase:
+            # The feedback phase ends when the session timer reaches 0
+            feedback_end = self.session.clock.getTime() - self.session.timer.getTime()
+            actual_framerate = getattr(self.session, 'actual_framerate', None)
+            iti, drift_correction = scheduler.get_iti(self, feedback_end, 1. / actual_framerate if actual_framerate else 0.)
+
+            self.phase_durations[self.iti_phase] = iti
+            self.parameters['drift_correction'] = drift_correction
+            self.parameters['tr_estimate'] = scheduler.timeline.tr
 
     def get_events(self):
 
@@ -84,12 +124,12 @@ class TaskTrial(Trial):
                 except Exception as e:
                     print(e)
 
-            self.last_mouse_pos = self.session.mouse.getPos()[0]/self.session.settings['interface']['mouse_multiplier']
+            self.last_mouse_pos = self.session.mouse.getPos()[0]/self.session.compiled_settings.interface.mouse_multiplier
 
         elif self.phase == self.response_phase:
 
             if not hasattr(self, 'response_onset'):
-                current_mouse_pos = self.session.mouse.getPos()[0]/self.session.settings['interface']['mouse_multiplier']
+                current_mouse_pos = self.session.mouse.getPos()[0]/self.session.compiled_settings.interface.mouse_multiplier
                 if np.abs(self.last_mouse_pos - current_mouse_pos) > response_slider.delta_rating_deg:
                     marker_position = response_slider.mouseToMarkerPosition(current_mouse_pos)
                     response_slider.setMarkerPosition(marker_position)
@@ -97,19 +137,26 @@ class TaskTrial(Trial):
                     response_slider.show_marker = True
                 
                 if self.session.mouse.getPressed()[0]:
+                    response_phase_onset = self.session.global_log.last_onset(self.phase_names[self.response_phase])
                     self.response_onset = self.session.clock.getTime()
-                    self.parameters['response_time'] = self.response_onset - self.session.global_log.iloc[-1]['onset']
+
+                    # Sub-frame onset of the click
+                    if self.session.mouse_sampler is not None:
+                        press_onset = self.session.mouse_sampler.get_press_onset(since=response_phase_onset)
+                        if press_onset is not None:
+                            self.response_onset = press_onset
+
+                    self.parameters['response_time'] = self.response_onset - response_phase_onset
                     self.parameters['response'] = response_slider.marker_position
 
-                    if self.parameters['jitter']>0.: # here we assume that if there is a jitter then it must mean that we have a fixed total duration 
-                        time_so_far = self.session.clock.getTime() - self.start_trial
-                        self.phase_durations[6] = self.total_duration - time_so_far - self.phase_durations[5]
                     self.stop_phase()
 
         #super().get_events()
 
     def draw(self):
 
+        render_state.new_frame()
+
         if self.session.win.mouseVisible:
             self.session.win.mouseVisible = False
 
@@ -122,44 +169,38 @@ class TaskTrial(Trial):
 
         if self.phase == 0:
             self.session.fixation_lines.setColor((-1, .5, -1), fixation_cross_only=True)
+            self.stimulus_array.prepare()
         elif self.phase == 1:
             self.session.fixation_lines.setColor((1, -1, -1), fixation_cross_only=True)
         elif self.phase in self.stimulus_phase:
 
             if self.stimulus_series:
-                if self.previous_phase != self.phase:
-                    if self.phase == 3:
-                        self.stimulus_array.xys[:, 0] *= -1
-                    if self.phase == 4:
-                        self.stimulus_array.xys[:, 1] *= -1
-                    if self.phase == 5:
-                        self.stimulus_array.xys[:, 0] *= -1
-
-            self.stimulus_array.draw()
+                self.stimulus_array.draw(self.stimulus_phase.index(self.phase))
+            else:
+                self.stimulus_array.draw()
 
         if (self.phase == (self.response_phase - 1)) or (self.parameters['jitter']==0. and self.phase in self.stimulus_phase):
             response_slider.setMarkerPosition(self.parameters['start_marker_position'])
             response_slider.show_marker = False
 
         elif self.phase == self.response_phase:
-            response_slider.marker.inner_color = self.session.settings['slider'].get('color')
+            response_slider.marker.inner_color = self.session.compiled_settings.slider.color
             response_slider.draw()
 
         elif self.phase == self.feedback_phase:
             if hasattr(self, 'response_onset'):
-                response_slider.marker.inner_color = self.session.settings['slider'].get('feedbackColor')
+                response_slider.marker.inner_color = self.session.compiled_settings.slider.feedbackColor
                 response_slider.draw()
             else:
                 self.too_late_stimulus.draw()
                     
-        self.previous_phase = self.phase
         #self.session.mouse.clickReset()
 
 class TaskSession(EstimationSession):
 
 
-    def create_trials(self, include_instructions=True):
-        """Create trials."""
+    def create_trials(self, include_instructions=True, design=None, seed=None):
+        """Create trials, from a design table (see design.py) or a new design of seed."""
 
 
         instruction_trial1 = InstructionTrial(self, 0, self.instructions['intro_part3'].format(run=self.settings['run']))
@@ -173,29 +214,33 @@ class TaskSession(EstimationSession):
         if not include_instructions:
             self.trials = self.trials[1:]
 
-        n_trials = self.settings['task'].get('n_trials')
-        range = self.settings['range']
-        ns = np.random.randint(range[0], range[1] + 1, n_trials)
+        if design is None:
+            design = create_design(self.settings, 'estimation_task', self.settings['range'], seed)
 
-        no_isi_no_jitter = self.settings.get('no_isi_no_jitter', False)
-        if no_isi_no_jitter:
-            self.trials += [TaskTrial(self, i+1, jitter=0, n=n, stimulus_series=self.settings['cloud']['stimulus_series']) for i,n in enumerate(ns)]
-        else:
-            possible_isis = self.settings['durations'].get('isi')
-            isis = possible_isis * int(np.ceil(n_trials / len(possible_isis)))
-            isis = isis[:n_trials]
-            np.random.shuffle(isis)
+        check_design(design, self.settings['range'], adaptive=self.adaptive_design is not None)
 
-            self.trials += [TaskTrial(self, i+1, jitter=jitter, n=n, stimulus_series=self.settings['cloud']['stimulus_series']) for i, (n, jitter) in enumerate(zip(ns, isis))]
+        # Adaptive trials get their n once the trial before them has a response
+        if self.adaptive_design is not None:
+            design = design.assign(n=None)
+
+        design = self.assign_layouts(design)
+        self.save_design(design)
+
+        self.trials += [TrialSpec(TaskTrial, trial_nr, dict(parameters,
+                                                            stimulus_series=self.settings['cloud']['stimulus_series']))
+                        for trial_nr, parameters in get_trial_parameters(design)]
 
         if not self.settings.get('skip_outro', False):
             self.trials.append(OutroTrial(session=self))
 
         self.trials.append(ScoreTrial(self, 0))
 
+        # Task trials build their successor during their ITI (see session.build_next_trial)
+        self.trials = LazyTrialList(self, self.trials, lookahead=0)
+
 
 
-def main(subject, session, run, range, settings='default', calibrate_eyetracker=False):
+def main(subject, session, run, range, settings='default', calibrate_eyetracker=False, design=None):
 
 
     output_dir, output_str = get_output_dir_str(subject, session, 'estimation_task', run)
@@ -208,7 +253,7 @@ def main(subject, session, run, range, settings='default', calibrate_eyetracker=
                           calibrate_eyetracker=calibrate_eyetracker)
     print(datetime.datetime.now(), 'Create session: done.')
     print(datetime.datetime.now(), 'Create trials')
-    session.create_trials()
+    session.create_trials(design=None if design is None else read_design(design))
     print(datetime.datetime.now(), 'Create trials: done.')
     print(datetime.datetime.now(), 'Run session')
     session.run()
@@ -222,8 +267,10 @@ if __name__ == "__main__":
     argparser.add_argument('range', choices=['narrow', 'wide'], help='Range (either narrow or wide)')
     argparser.add_argument('--settings', type=str, help='Settings label', default='default')
     argparser.add_argument('--calibrate_eyetracker', action='store_true', dest='calibrate_eyetracker')
+    argparser.add_argument('--design', type=str, default=None, help='Design table (tsv) to run (see design.py)')
 
 
     args = argparser.parse_args()
 
-    main(args.subject, args.session, args.run, args.range, args.settings, calibrate_eyetracker=args.calibrate_eyetracker)
\ No newline at end of file
+    main(args.subject, args.session, args.run, args.range, args.settings, calibrate_eyetracker=args.calibrate_eyetracker,
+         design=args.design)
\ No newline at end of file
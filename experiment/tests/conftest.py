@@ -0,0 +1,9 @@
+import os.path as op
+import sys
+import pyglet
+
+# The experiment modules are imported by name (from utils import ...), as when running from experiment/
+sys.path.insert(0, op.dirname(op.dirname(op.abspath(__file__))))
+
+# Without a display, importing psychopy.visual fails while pyglet creates its shadow window
+pyglet.options['shadow_window'] = False
@@ -0,0 +1,77 @@
+import glob
+import os.path as op
+import numpy as np
+import pandas as pd
+import pytest
+import yaml
+from feedback import FeedbackSession
+from headless import HeadlessBackend, run_headless_session
+from task import TaskSession
+
+framerate = 60.
+
+with open(op.join(op.dirname(op.dirname(op.abspath(__file__))), 'settings', 'default.yml'), 'r') as f:
+    settings = yaml.safe_load(f)
+
+
+def run(session_cls, task, output_dir):
+    backend = HeadlessBackend(framerate=framerate)
+    run_headless_session(session_cls, task=task, output_dir=str(output_dir), backend=backend,
+                         create_trials_kwargs=dict(seed=1))
+
+    events, = glob.glob(op.join(str(output_dir), f'*_task-{task}_run-1_events.tsv'))
+    return pd.read_csv(events, sep='\t')
+
+
+def get_onsets(events, event_type):
+    return events[events['event_type'] == event_type].set_index('trial_nr')['onset']
+
+
+def test_task_session(tmp_path):
+    events = run(TaskSession, 'estimation_task', tmp_path)
+    n_trials = settings['task']['n_trials']
+    durations = settings['durations']
+
+    assert {'trial_nr', 'onset', 'event_type', 'phase', 'response', 'n', 'jitter', 'layout_seed',
+            'start_marker_position', 'planned_onset', 'build_time'}.issubset(events.columns)
+
+    for phase in ['fixation1', 'fixation2', 'stimulus', 'jitter', 'response', 'feedback', 'iti']:
+        assert (events['event_type'] == phase).sum() == n_trials
+
+    trials = events[events['event_type'] == 'fixation1'].set_index('trial_nr')
+    assert list(trials.index) == list(range(1, n_trials + 1))
+    assert trials['n'].between(*settings['ranges']['narrow']).all()
+
+    # Phases last their durations, to the frame
+    stimulus_onsets = get_onsets(events, 'stimulus')
+    assert np.allclose(stimulus_onsets - trials['onset'], durations['first_fixation'] + durations['second_fixation'],
+                       atol=1.01 / framerate)
+    assert np.allclose(get_onsets(events, 'jitter') - stimulus_onsets, durations['array_duration'], atol=1.01 / framerate)
+
+    # Trials start on their planned onsets (see scheduler.py)
+    assert np.all(np.diff(trials['onset']) > 0)
+    assert np.allclose(trials['onset'], trials['planned_onset'], atol=1.01 / framerate)
+
+
+def test_feedback_session(tmp_path):
+    events = run(FeedbackSession, 'feedback', tmp_path)
+    n_trials = settings['feedback']['n_examples']
+    durations = settings['durations']
+
+    assert {'trial_nr', 'onset', 'event_type', 'phase', 'response', 'n', 'layout_seed', 'build_time'}.issubset(events.columns)
+
+    for phase in ['fixation1', 'fixation2', 'stimulus', 'response', 'feedback']:
+        assert (events['event_type'] == phase).sum() == n_trials
+
+    trials = events[events['event_type'] == 'fixation1'].set_index('trial_nr')
+    assert list(trials.index) == list(range(1, n_trials + 1))
+
+    stimulus_onsets = get_onsets(events, 'stimulus')
+    assert np.allclose(stimulus_onsets - trials['onset'], durations['first_fixation'] + durations['second_fixation'],
+                       atol=1.01 / framerate)
+    assert np.allclose(get_onsets(events, 'response') - stimulus_onsets, durations['array_duration'],
+                       atol=1.01 / framerate)
+
+    # Every trial starts once the feedback of the one before it has been shown
+    feedback_durations = trials['onset'].values[1:] - get_onsets(events, 'feedback').values[:-1]
+    assert feedback_durations == pytest.approx(durations['feedback'], abs=1.01 / framerate)
@@ -0,0 +1,40 @@
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pytest
+from layout_bank import create_layout_bank, save_layout_bank, LayoutBank
+from utils import _prepare_stimulus_array
+
+
+@pytest.fixture(scope='module')
+def layout_bank(tmp_path_factory):
+    fn = str(tmp_path_factory.mktemp('layouts') / 'bank.npz')
+    ns, layouts, features = create_layout_bank([10, 11], 20, 2.5, .1, seed=1)
+    save_layout_bank(fn, ns, layouts, 2.5, .1, features)
+    return LayoutBank(fn)
+
+
+def test_run_layouts_are_unique_and_reproducible(layout_bank):
+    ns = np.array([10, 11] * 15)
+    layout_ixs = layout_bank.get_run_layouts(ns, seed=[1, 2, 3])
+
+    assert layout_ixs == layout_bank.get_run_layouts(ns, seed=[1, 2, 3])
+    for n in [10, 11]:
+        assert len(set(np.array(layout_ixs)[ns == n])) == 15
+
+
+def test_new_layouts_differ_from_the_base_layout(layout_bank):
+    transforms = ['identity', 'new', 'new', 'new']
+
+    for seed in range(10):
+        prepared = _prepare_stimulus_array(10, 2.5, .1, layout_bank, rng=np.random.default_rng(seed), layout_ix=3,
+                                           transforms=transforms)
+        first_dots = {tuple(layout[0]) for layout in prepared.layouts}
+        assert len(first_dots) == len(transforms)
+        assert np.array_equal(prepared.layouts[0], layout_bank.draw(10, ix=3)[0])
+
+
+def test_unseeded_draws_are_thread_safe(layout_bank):
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        ixs = sum(executor.map(lambda _: layout_bank.get_ixs(11, n_draws=4), range(5)), [])
+
+    assert sorted(ixs) == list(range(20))
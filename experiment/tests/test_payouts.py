@@ -0,0 +1,28 @@
+import numpy as np
+from payouts import get_error_stats, ScoreAccumulator
+
+score_settings = dict(max_reward=.07, reward_slope=.00344827586, no_response_penalty=.1)
+
+
+def test_misses_score_lower_than_answers():
+    answered = get_error_stats([0., 2., 5.], **score_settings)
+    missed = get_error_stats([0., 2., np.nan], **score_settings)
+
+    assert missed['n_no_responses'] == 1
+    assert missed['total_reward'] < answered['total_reward']
+    assert np.isclose(missed['total_reward'], .07 + (.07 - 4 * .00344827586) - .1)
+
+
+def test_accumulator_matches_error_stats():
+    ns = [10, 15, 20, 25]
+    responses = [12, None, 20, np.nan]
+
+    accumulator = ScoreAccumulator(**score_settings)
+    for n, response in zip(ns, responses):
+        accumulator.add(n, response)
+
+    error = np.array(ns, dtype=float) - np.array(responses, dtype=float)
+    expected = get_error_stats(error, **score_settings)
+
+    for key, value in accumulator.get_stats().items():
+        assert np.isclose(value, expected[key]), key
@@ -0,0 +1,54 @@
+import numpy as np
+from rasterize import get_texture_size, rasterize_dots, TextureCache
+
+pix_per_deg = 40.
+aperture_radius = 2.5
+dot_radius = .1
+
+
+def test_dots_cover_their_centers_only():
+    xys = np.array([[0., 0.], [1., -1.], [-2., 1.5]])
+    image = rasterize_dots(xys, dot_radius, aperture_radius, pix_per_deg)
+
+    size = get_texture_size(aperture_radius, pix_per_deg)
+    assert image.shape == (size, size)
+
+    # Row is y, column is x, with (0, 0) in the middle of the image
+    rows = np.floor(xys[:, 1] * pix_per_deg + size / 2).astype(int)
+    cols = np.floor(xys[:, 0] * pix_per_deg + size / 2).astype(int)
+    assert np.all(image[rows, cols] == 1.)
+    assert image[cols[1], rows[1]] == 0.
+
+    # Nothing beyond the anti-aliased edge of the dots
+    y, x = (np.mgrid[:size, :size] + .5 - size / 2) / pix_per_deg
+    distances = np.sqrt((x[..., np.newaxis] - xys[:, 0])**2 + (y[..., np.newaxis] - xys[:, 1])**2).min(2)
+    assert np.all(image[distances > dot_radius + 1. / pix_per_deg] == 0.)
+    assert np.all(image[distances < dot_radius - 1. / pix_per_deg] == 1.)
+
+    # Every dot covers about the area of a disk
+    assert np.isclose(image.sum(), len(xys) * np.pi * (dot_radius * pix_per_deg)**2, rtol=.05)
+
+
+def test_no_dots():
+    assert rasterize_dots(np.zeros((0, 2)), dot_radius, aperture_radius, pix_per_deg).sum() == 0
+
+
+def test_texture_cache_evicts_least_recently_used():
+    created = []
+    cache = TextureCache(lambda key: created.append(key) or key, max_size=2)
+
+    cache.get('a')
+    cache.get('b')
+    cache.get('a')
+    cache.get('c')
+
+    assert 'b' not in cache
+    assert ('a' in cache) and ('c' in cache)
+    assert len(cache) == 2
+
+    cache.get('b')
+    assert 'a' not in cache
+    assert created == ['a', 'b', 'c', 'b']
+
+    cache.discard('c')
+    assert len(cache) == 1
@@ -0,0 +1,115 @@
+from types import SimpleNamespace
+import numpy as np
+import pandas as pd
+import pytest
+from scheduler import ScannerTimeline, TrialScheduler
+
+tr = 2.004
+offset = 3.0
+
+
+def get_triggers(n_volumes=100, jitter=0., missed=(), repeated=(), seed=0):
+    rng = np.random.default_rng(seed)
+    volumes = np.setdiff1d(np.arange(n_volumes), missed)
+    triggers = offset + volumes * tr + rng.normal(0, jitter, len(volumes)) if jitter else offset + volumes * tr
+
+    # A repeated trigger arrives a few ms after the first one of its volume
+    repeats = [offset + volume * tr + .003 for volume in repeated]
+    return np.sort(np.concatenate((triggers, repeats)))
+
+
+def get_timeline(triggers, nominal_tr=2.):
+    timeline = ScannerTimeline(nominal_tr)
+    for t in triggers:
+        timeline.add_trigger(t)
+    return timeline
+
+
+def test_timeline_without_triggers_is_nominal():
+    timeline = ScannerTimeline(2.)
+    assert timeline.tr == 2.
+    assert timeline.offset == 0.
+    assert timeline.time(5) == 10.
+
+
+def test_timeline_fits_tr_and_offset():
+    timeline = get_timeline(get_triggers())
+
+    assert timeline.n_triggers == 100
+    assert timeline.tr == pytest.approx(tr)
+    assert timeline.offset == pytest.approx(offset)
+    assert timeline.volume(offset + 50 * tr) == pytest.approx(50)
+
+
+def test_timeline_with_jitter():
+    timeline = get_timeline(get_triggers(jitter=.005))
+
+    assert timeline.tr == pytest.approx(tr, abs=1e-4)
+    assert timeline.offset == pytest.approx(offset, abs=.005)
+
+
+def test_timeline_with_missed_and_repeated_triggers():
+    missed = [1, 2, 10, 11, 12, 40, 77]
+    timeline = get_timeline(get_triggers(missed=missed, repeated=[0, 5, 30, 31]))
+
+    # Missed volumes leave a gap and repeats are ignored, so the count is not shifted
+    assert timeline.n_triggers == 100 - len(missed)
+    assert timeline.volumes == set(range(100)) - set(missed)
+    assert timeline.tr == pytest.approx(tr)
+    assert timeline.offset == pytest.approx(offset)
+
+
+def get_trial(global_log, start_trial, total_duration=10.):
+    session = SimpleNamespace(global_log=global_log)
+    return SimpleNamespace(session=session, start_trial=start_trial, total_duration=total_duration)
+
+
+def get_log(triggers):
+    return pd.DataFrame({'event_type': 'pulse', 'onset': triggers})
+
+
+def test_scheduler_corrects_the_iti_for_the_scanner_tr():
+    triggers = get_triggers(n_volumes=10)
+    scheduler = TrialScheduler(2.)
+
+    onset = offset + 2 * tr
+    trial = get_trial(get_log(triggers), onset)
+    assert scheduler.start_trial(trial, onset) == pytest.approx(onset)
+
+    # The trial takes 5 nominal volumes of 2 s, which end 5 * 4 ms later on the scanner
+    planned_end = offset + 7 * tr
+    iti, correction = scheduler.get_iti(trial, planned_end - 1.5, frame_duration=1 / 60.)
+
+    assert iti == pytest.approx(1.5 - 1 / 60.)
+    assert correction == pytest.approx(5 * (tr - 2.))
+
+    # The next trial is planned another 5 volumes on
+    next_trial = get_trial(trial.session.global_log, planned_end)
+    assert scheduler.start_trial(next_trial, planned_end) == pytest.approx(planned_end)
+    assert scheduler.get_onset(next_trial.scheduled_start + 10.) == pytest.approx(offset + 12 * tr)
+    assert np.allclose(scheduler.schedule_errors, 0.)
+
+
+def test_scheduler_reads_new_triggers_only():
+    triggers = get_triggers(n_volumes=20, repeated=[3])
+    scheduler = TrialScheduler(2.)
+    global_log = get_log(triggers[:5])
+
+    scheduler.update(global_log)
+    assert scheduler.timeline.n_triggers == 4
+
+    global_log = get_log(triggers)
+    scheduler.update(global_log)
+    scheduler.update(global_log)
+    assert scheduler.timeline.n_triggers == 20
+
+
+def test_scheduler_without_triggers_runs_on_the_session_clock():
+    scheduler = TrialScheduler(2., trigger_event_type=None)
+    trial = get_trial(get_log(get_triggers(n_volumes=10)), 1.)
+
+    scheduler.start_trial(trial, 1.)
+    iti, correction = scheduler.get_iti(trial, 9.)
+
+    assert iti == pytest.approx(2.)
+    assert correction == pytest.approx(0.)
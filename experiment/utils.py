@@ -1,32 +1,99 @@
 import numpy as np
-from psychopy.visual import ElementArrayStim, RadialStim, Circle
+from collections import namedtuple
+from psychopy.visual import ElementArrayStim, RadialStim, Circle, GratingStim
+from psychopy.tools.monitorunittools import deg2pix
 import os.path as op
 import logging
+import time
 from exptools2.core import Trial
-import yaml
 from instruction import InstructionTrial
+from rasterize import rasterize_dots
+from compiled_settings import load_settings, get_settings_fn
 
-def _sample_dot_positions(n=10, circle_radius=20, dot_radius=1, min_ecc=0.2, max_n_tries=10000):
+# Random sequential packing of disks jams at ~0.547 of the plane; stay well below
+# that so layouts can still be found in a reasonable number of candidates.
+_MAX_PACKING_DENSITY = 0.45
 
-    coords = np.zeros((0, 2))
+# Candidates within a batch are checked pairwise, so keep batches small
+_MAX_BATCH_SIZE = 256
+
+
+def _max_n_dots(circle_radius, dot_radius, min_ecc=0.2):
+    """ Upper bound on the number of dots that can be placed in the aperture. """
+
+    min_distance = (dot_radius * 2) * 1.1
+    min_ecc_frac = min_ecc / circle_radius
+    max_ecc = circle_radius - dot_radius
+    min_ecc_ = np.sqrt(min_ecc_frac / (1. + min_ecc_frac)) * max_ecc
+
+    # Every dot claims a disk of radius min_distance / 2 around its center
+    area = np.pi * ((max_ecc + min_distance / 2.)**2 - max(min_ecc_ - min_distance / 2., 0)**2)
+    return int(_MAX_PACKING_DENSITY * area / (np.pi * (min_distance / 2.)**2))
+
+
+def _sample_dot_positions(n=10, circle_radius=20, dot_radius=1, min_ecc=0.2, max_n_tries=None, rng=None):
+
+    if dot_radius >= circle_radius:
+        raise ValueError(f'dot_radius ({dot_radius}) should be smaller than circle_radius ({circle_radius})')
+
+    max_n = _max_n_dots(circle_radius, dot_radius, min_ecc)
+    if n > max_n:
+        raise ValueError(f'Cannot place {n} dots of radius {dot_radius} in an aperture of radius {circle_radius} '
+                         f'(at most {max_n} dots fit)')
+
+    if max_n_tries is None:
+        max_n_tries = max(10000, 100 * n)
+
+    # A numpy Generator makes the layout reproducible (see design.py)
+    random = np.random.rand if rng is None else rng.random
+
+    # Make the radius slightly larger
+    min_distance = (dot_radius * 2) * 1.1
+    min_ecc_frac = min_ecc / circle_radius
+    max_ecc = circle_radius - dot_radius
+
+    # Grid cells are small enough to hold at most one dot, so any conflicting
+    # dot is in the 5x5 block of cells around a candidate.
+    cell_size = min_distance / np.sqrt(2)
+    n_cells = int(np.ceil(2 * max_ecc / cell_size)) + 1
+    grid = np.full((n_cells + 4, n_cells + 4), -1, dtype=int)
+    offsets = np.arange(-2, 3)
+
+    coords = np.zeros((n, 2))
+    n_accepted = 0
     tries = 0
 
-    while((coords.shape[0] < n) & (tries < max_n_tries)):
-        radius = np.random.rand() * np.pi * 2
-        min_ecc_frac = min_ecc / circle_radius
-        ecc = np.sqrt((np.random.rand() + min_ecc_frac) / (1.+min_ecc_frac))  * (circle_radius - dot_radius)
-        coord = np.array([[np.cos(radius), np.sin(radius)]]) * ecc
+    while (n_accepted < n) & (tries < max_n_tries):
+        batch_size = min(max(2 * (n - n_accepted), 16), _MAX_BATCH_SIZE, max_n_tries - tries)
+        tries += batch_size
+
+        radius = random(batch_size) * np.pi * 2
+        ecc = np.sqrt((random(batch_size) + min_ecc_frac) / (1.+min_ecc_frac)) * max_ecc
+        candidates = np.stack((np.cos(radius), np.sin(radius)), 1) * ecc[:, np.newaxis]
+
+        cells = ((candidates + max_ecc) / cell_size).astype(int) + 2
 
-        distances = np.sqrt(((coords - coord)**2).sum(1))
+        # Conflicts with dots that were already accepted
+        neighbours = grid[cells[:, 0, np.newaxis, np.newaxis] + offsets[np.newaxis, :, np.newaxis],
+                          cells[:, 1, np.newaxis, np.newaxis] + offsets[np.newaxis, np.newaxis, :]].reshape(batch_size, -1)
+        distances = np.sqrt(((coords[neighbours] - candidates[:, np.newaxis, :])**2).sum(2))
+        free = ((distances > min_distance) | (neighbours == -1)).all(1)
 
-        # Make the radius slightly larger
-        if (distances > (dot_radius * 2) * 1.1).all():
-            coords = np.vstack((coords, coord))
+        # Conflicts within the batch: keep a candidate only if it does not
+        # collide with any earlier candidate of the same batch
+        candidates, cells = candidates[free], cells[free]
+        distances = np.sqrt(((candidates[:, np.newaxis, :] - candidates[np.newaxis, :, :])**2).sum(2))
+        free = ~np.tril(distances <= min_distance, -1).any(1)
 
-        tries += 1
+        new = candidates[free][:n - n_accepted]
+        new_cells = cells[free][:n - n_accepted]
 
-    if tries == max_n_tries:
-        raise Exception
+        grid[new_cells[:, 0], new_cells[:, 1]] = np.arange(n_accepted, n_accepted + len(new))
+        coords[n_accepted:n_accepted + len(new)] = new
+        n_accepted += len(new)
+
+    if n_accepted < n:
+        raise RuntimeError(f'Could only place {n_accepted} out of {n} dots after {tries} candidates')
 
     return coords
 
@@ -37,14 +104,234 @@ class RadialStimArray(object):
         self.stimulus = Circle(win, radius=sizes, edges=128, fillColor=[1, 1, 1])
         self.xys = xys
 
+    def prepare(self):
+        pass
+
     def draw(self):
         for pos in self.xys:
             self.stimulus.pos = pos
             self.stimulus.draw()
 
-def _create_stimulus_array(win, n_dots, circle_radius, dot_radius):
-    xys = _sample_dot_positions(n_dots, circle_radius, dot_radius)
-    return RadialStimArray(win, xys, dot_radius)
+
+class DotArrayStim(object):
+    """ Draws the whole dot cloud with one ElementArrayStim (a single draw call). """
+
+    def __init__(self, win, xys, sizes):
+        # ElementArrayStim sizes are diameters
+        self.stimulus = ElementArrayStim(win, nElements=len(xys), xys=xys, sizes=sizes * 2,
+                                         elementTex=None, elementMask='circle', texRes=128,
+                                         colors=[1, 1, 1])
+        self._xys = xys
+
+    @property
+    def xys(self):
+        return self._xys
+
+    @xys.setter
+    def xys(self, value):
+        # Assigning (rather than modifying in place) re-uploads the positions
+        self._xys = value
+        self.stimulus.xys = value
+
+    def prepare(self):
+        pass
+
+    def draw(self):
+        self.stimulus.draw()
+
+
+def get_pix_per_deg(win):
+    """ Pixels per degree of the monitor of win (the resolution of rasterized dot clouds). """
+    return deg2pix(1., win.monitor)
+
+
+class RasterizedDotArray(object):
+    """ Dot cloud rasterized once on the CPU and shown as a single textured quad.
+
+    The GL texture is created on prepare() (or on the first draw) and kept in a
+    shared TextureCache, which bounds how many textures exist at the same time. """
+
+    def __init__(self, win, xys, sizes, aperture_radius, texture_cache, image=None):
+        self.win = win
+        self.xys = xys
+        self.texture_cache = texture_cache
+        self.pix_per_deg = get_pix_per_deg(win)
+
+        # The image can be rasterized beforehand (see _prepare_stimulus_array)
+        self.image = rasterize_dots(xys, sizes, aperture_radius, self.pix_per_deg) if image is None else image
+
+    def create_texture(self):
+        # The coverage image is the alpha mask of a white quad (psychopy masks run from -1 to 1)
+        return GratingStim(self.win, tex=None, mask=self.image * 2 - 1, size=self.image.shape[0] / self.pix_per_deg,
+                           color=[1, 1, 1])
+
+    def prepare(self):
+        self.texture_cache.get(self)
+
+    def draw(self):
+        self.texture_cache.get(self).draw()
+
+
+class StimulusSequence(object):
+    """ Dot clouds shown one after the other (the sub-phases of the stimulus with
+    stimulus_series), all built up front so that drawing only picks one of them. """
+
+    def __init__(self, stimulus_arrays):
+        self.stimulus_arrays = stimulus_arrays
+
+    def __len__(self):
+        return len(self.stimulus_arrays)
+
+    @property
+    def xys(self):
+        return self.stimulus_arrays[0].xys
+
+    def prepare(self):
+        for stimulus_array in self.stimulus_arrays:
+            stimulus_array.prepare()
+
+    def draw(self, frame=0):
+        self.stimulus_arrays[frame].draw()
+
+
+_renderers = {'element_array': DotArrayStim,
+              'circles': RadialStimArray}
+
+
+def _transform_layout(xys, transform):
+    """ xys mirrored (mirror_x, mirror_y), rotated (rotate_<degrees>) or unchanged (identity). """
+
+    if transform == 'identity':
+        return xys.copy()
+    elif transform == 'mirror_x':
+        return xys * [-1., 1.]
+    elif transform == 'mirror_y':
+        return xys * [1., -1.]
+    elif transform.startswith('rotate_'):
+        angle = np.deg2rad(float(transform[len('rotate_'):]))
+        return xys @ np.array([[np.cos(angle), np.sin(angle)], [-np.sin(angle), np.cos(angle)]])
+
+    raise ValueError(f'Unknown layout transform {transform} (identity, mirror_x, mirror_y, rotate_<degrees> or new)')
+
+
+def _draw_layouts(n_dots, n_layouts, circle_radius, dot_radius, layout_bank=None, rng=None, layout_ix=None):
+    """ n_layouts different layouts (from the layout bank if it has n_dots; the first one is layout_ix if given). """
+
+    if (layout_bank is not None) and (n_dots in layout_bank):
+        return layout_bank.draw(n_dots, rng=rng, ix=layout_ix, n_draws=n_layouts)
+
+    return [_sample_dot_positions(n_dots, circle_radius, dot_radius, rng=rng) for _ in np.arange(n_layouts)]
+
+
+# The CPU side of a dot cloud or stimulus sequence: its layouts and, for the texture renderer, their images
+PreparedStimulus = namedtuple('PreparedStimulus', ['layouts', 'images', 'sequence'])
+
+
+def _prepare_stimulus_array(n_dots, circle_radius, dot_radius, layout_bank=None, renderer='element_array',
+                            pix_per_deg=None, rng=None, layout_ix=None, transforms=None):
+    """ Layouts (one per transform, new: a fresh layout drawn with the same rng, which differs from
+    the others) and images of a stimulus. Makes no GL calls, so it can run on a worker thread
+    (see prefetch.py). """
+
+    n_new = 0 if transforms is None else transforms.count('new')
+    xys, *new_layouts = _draw_layouts(n_dots, 1 + n_new, circle_radius, dot_radius, layout_bank, rng, layout_ix)
+
+    if transforms is None:
+        layouts = [xys]
+    else:
+        new_layouts = iter(new_layouts)
+        layouts = [next(new_layouts) if transform == 'new' else _transform_layout(xys, transform)
+                   for transform in transforms]
+
+    if renderer == 'texture':
+        images = [rasterize_dots(layout, dot_radius, circle_radius, pix_per_deg) for layout in layouts]
+    else:
+        images = [None] * len(layouts)
+
+    return PreparedStimulus(layouts, images, transforms is not None)
+
+
+def _create_stimulus_array(win, prepared, circle_radius, dot_radius, renderer='element_array', texture_cache=None):
+    """ The dot cloud (or StimulusSequence) of a PreparedStimulus; must run on the main thread. """
+
+    if renderer == 'texture':
+        stimulus_arrays = [RasterizedDotArray(win, xys, dot_radius, circle_radius, texture_cache, image)
+                           for xys, image in zip(prepared.layouts, prepared.images)]
+    else:
+        stimulus_arrays = [_renderers[renderer](win, xys, dot_radius) for xys in prepared.layouts]
+
+    return StimulusSequence(stimulus_arrays) if prepared.sequence else stimulus_arrays[0]
+
+
+# Compact description of a trial that is only turned into a Trial object just before it runs
+TrialSpec = namedtuple('TrialSpec', ['trial_class', 'trial_nr', 'parameters'])
+
+
+class LazyTrialList(list):
+    """ List of trials (or TrialSpecs) that builds TrialSpecs just in time.
+
+    While iterating, at most lookahead trials beyond the current one are built
+    when a trial starts (trials can also build their successor earlier, during
+    their ITI, with build_next), and trials are released once they have run, so
+    startup time and memory do not grow with the number of trials. """
+
+    def __init__(self, session, trials=(), lookahead=1):
+        super().__init__(trials)
+        self.session = session
+        self.lookahead = lookahead
+        self._built = {}
+        self._ix = -1
+
+    def build(self, ix):
+        trial = list.__getitem__(self, ix)
+
+        if isinstance(trial, TrialSpec):
+            spec = trial
+            t0 = time.perf_counter()
+            trial = spec.trial_class(self.session, spec.trial_nr, **spec.parameters)
+            trial.spec = spec
+            trial.parameters['build_time'] = time.perf_counter() - t0
+
+        return trial
+
+    def get_next_spec(self):
+        """ The TrialSpec after the current trial, if it has not been built yet (else None). """
+
+        ix = self._ix + 1
+
+        if (ix < len(self)) and (ix not in self._built) and isinstance(list.__getitem__(self, ix), TrialSpec):
+            return list.__getitem__(self, ix)
+
+    def build_next(self):
+        """ Builds the trial after the current one now, rather than when it starts. """
+
+        ix = self._ix + 1
+
+        if (ix < len(self)) and (ix not in self._built):
+            self._built[ix] = self.build(ix)
+
+    def insert(self, ix, trial):
+        """ Inserts a trial; also while iterating, as long as ix is after the current trial. """
+        super().insert(ix, trial)
+        self._built = {(ix_ + 1 if ix_ >= ix else ix_): built for ix_, built in self._built.items()}
+
+    def spec_ixs(self):
+        """ Indices of the trials that are (or were built from) TrialSpecs. """
+        return [ix for ix, trial in enumerate(list.__iter__(self)) if isinstance(trial, TrialSpec)]
+
+    def __iter__(self):
+        self._built = {}
+        ix = 0
+
+        # len(self) is re-evaluated, so trials can be added while running
+        while ix < len(self):
+            for ix_ in range(ix, min(ix + self.lookahead + 1, len(self))):
+                if ix_ not in self._built:
+                    self._built[ix_] = self.build(ix_)
+
+            self._ix = ix
+            yield self._built.pop(ix)
+            ix += 1
 
 
 def get_output_dir_str(subject, session, task, run):
@@ -116,12 +403,12 @@ class OutroTrial(InstructionTrial):
 
 
 def get_settings(settings):
-    settings_fn = op.join(op.dirname(__file__), 'settings', f'{settings}.yml')
+    settings_fn = get_settings_fn(settings)
     print(settings_fn)
 
-    with open(settings_fn, 'r') as f:
-        settings = yaml.safe_load(f)
+    # Parsed and validated before anything is shown, so mistakes in the settings do not show up mid-run
+    settings = load_settings(settings)
 
-    use_eyetracker = 'eyetracker' in settings.keys()
+    use_eyetracker = 'eyetracker' in settings.raw.keys()
 
     return settings_fn, use_eyetracker
\ No newline at end of file